@@ -1,17 +1,25 @@
 import logging
+import math
 import os
 import time
+import weakref
 from pathlib import Path
+from typing import AsyncGenerator, Awaitable, Callable, Optional
+
+from core.startup import HEAVY_IMPORTS, StartupTimer, import_timed
+
+# The heavy dependencies are imported one at a time ahead of the imports below, which then find them loaded,
+# so the startup report can break the import cost down per package
+IMPORT_DURATIONS = import_timed(HEAVY_IMPORTS)
 
 import openai
 from azure.identity.aio import DefaultAzureCredential
-from azure.monitor.opentelemetry import configure_azure_monitor
-from opentelemetry.instrumentation.aiohttp_client import AioHttpClientInstrumentor
 from opentelemetry.instrumentation.asgi import OpenTelemetryMiddleware
 from quart import (
     Blueprint,
     Quart,
     current_app,
+    abort,
     jsonify,
     make_response,
     request,
@@ -20,12 +28,40 @@ from quart import (
 from quart_cors import cors
 
 from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
+from core.admission import AdmissionController, AdmissionRejected, AdmissionTicket
 from core.authentication import AuthenticationHelper
+from core.cache import create_cache_backend
+from core.contentcache import ContentCache
+from core.contentfetcher import ContentFetcher
+from core.conversationstore import ConversationNotFound, ConversationStore
+from core.deploymentscheduler import Deployment, DeploymentScheduler, RateLimitExceeded, parse_deployments
+from core.graphclientbuilder import GraphClientCache, import_graph_sdk
+from core.graphsearch import GraphSearch, SearchResultCache
+from core.httpclientpool import HttpClientPool
+from core.metrics import ChatMetrics, MetricsRegistry
+from core.modelhelper import get_encoding, set_vocabulary_dir, token_count_cache
+from core.ndjson import NDJSONStreamWriter, dumps
+from core.querycache import QueryRewriteCache
+from core.reranker import BM25Reranker
+from core.singleflight import SingleFlight
+from core.tokenrefresher import TokenRefresher
 
 CONFIG_OPENAI_TOKEN = "openai_token"
 CONFIG_CREDENTIAL = "azure_credential"
 CONFIG_CHAT_APPROACH = "chat_approach"
 CONFIG_AUTH_CLIENT = "auth_client"
+CONFIG_GRAPH_CLIENT_CACHE = "graph_client_cache"
+CONFIG_HTTP_CLIENT_POOL = "http_client_pool"
+CONFIG_QUERY_CACHE = "query_cache"
+CONFIG_SEARCH_CACHE = "search_cache"
+CONFIG_CONVERSATION_STORE = "conversation_store"
+CONFIG_STREAM_WRITER = "stream_writer"
+CONFIG_TOKEN_REFRESHER = "openai_token_refresher"
+CONFIG_METRICS = "metrics"
+CONFIG_STARTUP_TIMER = "startup_timer"
+CONFIG_ADMISSION = "admission_controller"
+CONFIG_BATCH_MAX_ITEMS = "batch_max_items"
+CONFIG_BATCH_CONCURRENCY = "batch_concurrency"
 
 bp = Blueprint("routes", __name__, static_folder="static")
 
@@ -49,6 +85,48 @@ async def favicon():
 async def assets(path):
     return await send_from_directory(Path(__file__).resolve().parent / "static" / "assets", path)
 
+async def format_as_ndjson(
+    r: AsyncGenerator[dict, None], writer: NDJSONStreamWriter, ticket: Optional[AdmissionTicket] = None
+) -> AsyncGenerator[bytes, None]:
+    # The body is generated after the view returns, outside of the app context, so the writer is passed in
+    try:
+        async for frame in writer.frames(r):
+            yield frame
+    except Exception as e:
+        logging.exception("Exception while generating response stream")
+        yield dumps({"error": str(e)}) + b"\n"
+    finally:
+        # A streamed request keeps its admission slot until the answer is complete
+        if ticket is not None:
+            ticket.release()
+
+
+def get_admitter(obo_token: str) -> Optional[Callable[[], Awaitable[AdmissionTicket]]]:
+    # Admits a request of the caller, also once the view has returned (e.g. the items of a batch)
+    admission = current_app.config[CONFIG_ADMISSION]
+    if admission is None:
+        return None
+    # Queues are per user assertion: its claims are not validated yet, so a client could pick any oid it likes
+    user_id = AuthenticationHelper.get_cache_scope(obo_token)
+    return lambda: admission.acquire(user_id)
+
+
+async def admit(obo_token: str) -> Optional[AdmissionTicket]:
+    admitter = get_admitter(obo_token)
+    return await admitter() if admitter is not None else None
+
+
+async def make_ndjson_response(result: AsyncGenerator[dict, None], ticket: Optional[AdmissionTicket]):
+    body = format_as_ndjson(result, current_app.config[CONFIG_STREAM_WRITER], ticket)
+    if ticket is not None:
+        # The body only releases the slot once it has started, e.g. not when the client is gone before that
+        weakref.finalize(body, ticket.release)
+    response = await make_response(body)
+    response.timeout = None  # type: ignore
+    response.mimetype = "application/x-ndjson"
+    return response
+
+
 @bp.route("/chat", methods=["POST"])
 async def chat():
     if not request.is_json:
@@ -57,7 +135,11 @@ async def chat():
     context = request_json.get("context", {})
     auth_helper = current_app.config[CONFIG_AUTH_CLIENT]
     context["obo_token"] = auth_helper.get_token_auth_header(request.headers)
+    # With delta, messages are only the new messages of the stored conversation session_state refers to
+    context["delta"] = bool(request_json.get("delta", False))
+    ticket = None
     try:
+        ticket = await admit(context["obo_token"])
         approach = current_app.config[CONFIG_CHAT_APPROACH]
         result = await approach.run(
             request_json["messages"],
@@ -68,12 +150,74 @@ async def chat():
         if isinstance(result, dict):
             return jsonify(result)
         else:
-            response = await make_response(format_as_ndjson(result))
-            response.timeout = None  # type: ignore
+            response = await make_ndjson_response(result, ticket)
+            ticket = None
             return response
+    except AdmissionRejected as e:
+        logging.warning("Rejected /chat request: %s", e)
+        return jsonify({"error": str(e)}), e.status_code, {"Retry-After": str(math.ceil(e.retry_after))}
+    except ConversationNotFound as e:
+        # The client posts the full history again
+        return jsonify({"error": str(e), "code": "conversation_not_found"}), 409
+    except RateLimitExceeded as e:
+        logging.warning("Rate limited in /chat: %s", e)
+        return jsonify({"error": str(e)}), 429, {"Retry-After": str(math.ceil(e.retry_after))}
+    except openai.error.RateLimitError as e:
+        logging.warning("Rate limited in /chat: %s", e)
+        retry_after = DeploymentScheduler.get_retry_after(e)
+        return jsonify({"error": str(e)}), 429, {"Retry-After": str(math.ceil(retry_after))}
     except Exception as e:
         logging.exception("Exception in /chat")
         return jsonify({"error": str(e)}), 500
+    finally:
+        if ticket is not None:
+            ticket.release()
+
+
+# Many conversations in one request, answered as NDJSON lines in completion order.
+# At most CHAT_BATCH_CONCURRENCY items run at once, and each running item holds an admission slot.
+@bp.route("/chat/batch", methods=["POST"])
+async def chat_batch():
+    if not request.is_json:
+        return jsonify({"error": "request must be json"}), 415
+    request_json = await request.get_json()
+    items = request_json.get("items")
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "items must be a non-empty list"}), 400
+    if not all(isinstance(item, dict) and "messages" in item for item in items):
+        return jsonify({"error": "every item must be an object with messages"}), 400
+    if len(items) > current_app.config[CONFIG_BATCH_MAX_ITEMS]:
+        return jsonify({"error": f"at most {current_app.config[CONFIG_BATCH_MAX_ITEMS]} items per batch"}), 413
+    context = request_json.get("context", {})
+    auth_helper = current_app.config[CONFIG_AUTH_CLIENT]
+    context["obo_token"] = auth_helper.get_token_auth_header(request.headers)
+    batch_concurrency = current_app.config[CONFIG_BATCH_CONCURRENCY]
+    max_concurrency = request_json.get("max_concurrency", batch_concurrency)
+    if not isinstance(max_concurrency, int) or isinstance(max_concurrency, bool) or max_concurrency < 1:
+        return jsonify({"error": "max_concurrency must be a positive integer"}), 400
+    max_concurrency = min(max_concurrency, batch_concurrency)
+    try:
+        # The batch is rejected up front when the worker is saturated; the slot it gets goes to its first item
+        admitter = get_admitter(context["obo_token"])
+        ticket = await admitter() if admitter is not None else None
+        approach = current_app.config[CONFIG_CHAT_APPROACH]
+        result = approach.run_batch(items, context, max_concurrency, ticket=ticket, admit=admitter)
+        return await make_ndjson_response(result, ticket)
+    except AdmissionRejected as e:
+        logging.warning("Rejected /chat/batch request: %s", e)
+        return jsonify({"error": str(e)}), e.status_code, {"Retry-After": str(math.ceil(e.retry_after))}
+    except Exception as e:
+        logging.exception("Exception in /chat/batch")
+        return jsonify({"error": str(e)}), 500
+
+
+# Prometheus-style metrics of this worker process
+@bp.route("/metrics", methods=["GET"])
+async def metrics():
+    registry = current_app.config[CONFIG_METRICS]
+    if registry is None:
+        abort(404)
+    return registry.render(), 200, {"Content-Type": MetricsRegistry.CONTENT_TYPE}
 
 
 # Send MSAL.js settings to the client UI
@@ -87,13 +231,8 @@ def auth_setup():
 async def ensure_openai_token():
     if openai.api_type != "azure_ad":
         return
-    openai_token = current_app.config[CONFIG_OPENAI_TOKEN]
-    if openai_token.expires_on < time.time() + 60:
-        openai_token = await current_app.config[CONFIG_CREDENTIAL].get_token(
-            "https://cognitiveservices.azure.com/.default"
-        )
-        current_app.config[CONFIG_OPENAI_TOKEN] = openai_token
-        openai.api_key = openai_token.token
+    # The token is refreshed ahead of expiry in the background, this only waits if it has really expired
+    await current_app.config[CONFIG_TOKEN_REFRESHER].ensure_valid()
 
 
 @bp.before_app_serving
@@ -105,6 +244,24 @@ async def setup_clients():
     # Used with Azure OpenAI deployments
     AZURE_OPENAI_SERVICE = os.getenv("AZURE_OPENAI_SERVICE")
     AZURE_OPENAI_CHATGPT_DEPLOYMENT = os.getenv("AZURE_OPENAI_CHATGPT_DEPLOYMENT")
+    # Defaults to https://{AZURE_OPENAI_SERVICE}.openai.azure.com
+    AZURE_OPENAI_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT") or f"https://{AZURE_OPENAI_SERVICE}.openai.azure.com"
+    # When set, Azure OpenAI is called with this API key instead of a Microsoft Entra ID token
+    AZURE_OPENAI_KEY = os.getenv("AZURE_OPENAI_KEY")
+    # Quota of the deployment (0 = unknown, only 429 responses limit it)
+    AZURE_OPENAI_CHATGPT_TPM = int(os.getenv("AZURE_OPENAI_CHATGPT_TPM", "0"))
+    AZURE_OPENAI_CHATGPT_RPM = int(os.getenv("AZURE_OPENAI_CHATGPT_RPM", "0"))
+    # Pool of deployments (JSON list) used instead of the single deployment above
+    AZURE_OPENAI_DEPLOYMENTS = os.getenv("AZURE_OPENAI_DEPLOYMENTS")
+    # Model of the query rewrite, and its deployment, quota and pool like the ones above. The rewrite only returns
+    # a few keywords, it can go to a smaller and faster model; it uses the answer's model and deployments by default
+    AZURE_OPENAI_QUERY_MODEL = os.getenv("AZURE_OPENAI_QUERY_MODEL") or OPENAI_CHATGPT_MODEL
+    AZURE_OPENAI_QUERY_DEPLOYMENT = os.getenv("AZURE_OPENAI_QUERY_DEPLOYMENT")
+    AZURE_OPENAI_QUERY_TPM = int(os.getenv("AZURE_OPENAI_QUERY_TPM", "0"))
+    AZURE_OPENAI_QUERY_RPM = int(os.getenv("AZURE_OPENAI_QUERY_RPM", "0"))
+    AZURE_OPENAI_QUERY_DEPLOYMENTS = os.getenv("AZURE_OPENAI_QUERY_DEPLOYMENTS")
+    # Seconds a call may wait for a deployment with free quota before /chat answers 429
+    OPENAI_RATE_LIMIT_MAX_WAIT = float(os.getenv("OPENAI_RATE_LIMIT_MAX_WAIT", "10"))
 
     # Used only with non-Azure OpenAI deployments
     OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
@@ -117,6 +274,106 @@ async def setup_clients():
     AZURE_CLIENT_APP_ID = os.getenv("AZURE_CLIENT_APP_ID")
     AZURE_TENANT_ID = os.getenv("AZURE_TENANT_ID")
     TOKEN_CACHE_PATH = os.getenv("TOKEN_CACHE_PATH")
+    # Sovereign clouds (or local stand-ins) use other sign-in and Graph endpoints
+    AZURE_AUTHORITY_HOST = os.getenv("AZURE_AUTHORITY_HOST", "https://login.microsoftonline.com")
+    GRAPH_ENDPOINT = os.getenv("GRAPH_ENDPOINT", "https://graph.microsoft.com")
+    MSAL_THREAD_POOL_SIZE = int(os.getenv("MSAL_THREAD_POOL_SIZE", "4"))
+    # Cache of On-Behalf-Of tokens by user assertion: "memory" (per worker), "sqlite" (shared by workers),
+    # "tiered" (memory in front of sqlite) or "none"
+    OBO_TOKEN_CACHE_BACKEND = os.getenv("OBO_TOKEN_CACHE_BACKEND", "memory")
+    OBO_TOKEN_CACHE_PATH = os.getenv("OBO_TOKEN_CACHE_PATH")
+    OBO_TOKEN_CACHE_SIZE = int(os.getenv("OBO_TOKEN_CACHE_SIZE", "1024"))
+
+    # Number of per-user Graph clients kept warm in each worker
+    GRAPH_CLIENT_CACHE_SIZE = int(os.getenv("GRAPH_CLIENT_CACHE_SIZE", "256"))
+
+    # Connection pool shared by all requests of a worker
+    HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "100"))
+    HTTP_POOL_LIMIT_PER_HOST = int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", "0"))
+    HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "30"))
+    HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", "300"))
+    HTTP_PREWARM = os.getenv("HTTP_PREWARM", "").lower() == "true"
+
+    # Cache of LLM-generated search queries: "memory" (per worker), "sqlite" (shared by workers),
+    # "tiered" (memory in front of sqlite) or "none"
+    QUERY_CACHE_BACKEND = os.getenv("QUERY_CACHE_BACKEND", "memory")
+    QUERY_CACHE_PATH = os.getenv("QUERY_CACHE_PATH")
+    QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "1024"))
+    QUERY_CACHE_TTL = float(os.getenv("QUERY_CACHE_TTL", "3600"))
+
+    # Per-user cache of Microsoft Search results, kept short so permission and content changes show up quickly
+    SEARCH_CACHE_BACKEND = os.getenv("SEARCH_CACHE_BACKEND", "memory")
+    SEARCH_CACHE_PATH = os.getenv("SEARCH_CACHE_PATH")
+    SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "1024"))
+    SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "60"))
+
+    # Retrieval shortcuts, both disabled by default
+    SPECULATIVE_RETRIEVAL = os.getenv("SPECULATIVE_RETRIEVAL", "").lower() == "true"
+    SKIP_REWRITE_MAX_CHARS = int(os.getenv("SKIP_REWRITE_MAX_CHARS", "0"))
+
+    # Grounding sources: hits to retrieve, hits whose full content is fetched and how the prompt budget is split
+    SEARCH_TOP = int(os.getenv("SEARCH_TOP", "5"))
+    # Entity types searched (comma-separated Graph entityType values) and the seconds each group of types may spend
+    # on all of its pages before the answer goes ahead without it
+    SEARCH_ENTITY_TYPES = os.getenv("SEARCH_ENTITY_TYPES", "listItem")
+    SEARCH_TIMEOUT = float(os.getenv("SEARCH_TIMEOUT", "10"))
+    # Hits per search request; more pages are only requested while the hits don't fill the prompt yet
+    SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", "25"))
+    CONTENT_FETCH_TOP = int(os.getenv("CONTENT_FETCH_TOP", "3"))
+    CONTENT_FETCH_CONCURRENCY = int(os.getenv("CONTENT_FETCH_CONCURRENCY", "4"))
+    # Directory caching the extracted text of fetched documents by eTag, shared by the workers (unset disables)
+    CONTENT_CACHE_DIR = os.getenv("CONTENT_CACHE_DIR")
+    CONTENT_CACHE_MAX_MB = int(os.getenv("CONTENT_CACHE_MAX_MB", "512"))
+    CHUNK_TOKEN_LIMIT = int(os.getenv("CHUNK_TOKEN_LIMIT", "500"))
+    HISTORY_TOKEN_RATIO = float(os.getenv("HISTORY_TOKEN_RATIO", "0.5"))
+
+    # Local BM25 re-ranking of the search hits against the question, off unless enabled since it changes the order
+    RERANK_ENABLED = os.getenv("RERANK_ENABLED", "false").lower() == "true"
+    RERANK_MIN_RELATIVE_SCORE = float(os.getenv("RERANK_MIN_RELATIVE_SCORE", "0"))
+
+    # Streaming: deltas are coalesced up to this many bytes or seconds, and idle streams get a heartbeat
+    STREAM_MAX_FRAME_BYTES = int(os.getenv("STREAM_MAX_FRAME_BYTES", "2048"))
+    STREAM_MAX_FRAME_DELAY = float(os.getenv("STREAM_MAX_FRAME_DELAY", "0.05"))
+    STREAM_HEARTBEAT_INTERVAL = float(os.getenv("STREAM_HEARTBEAT_INTERVAL", "15"))
+
+    # Azure OpenAI token is refreshed this many seconds before it expires, minus a random jitter
+    OPENAI_TOKEN_REFRESH_MARGIN = float(os.getenv("OPENAI_TOKEN_REFRESH_MARGIN", "300"))
+    OPENAI_TOKEN_REFRESH_JITTER = float(os.getenv("OPENAI_TOKEN_REFRESH_JITTER", "60"))
+
+    # Share one upstream call between concurrent requests doing identical rewrite, search, content fetch or answer calls
+    REQUEST_COALESCING = os.getenv("REQUEST_COALESCING", "true").lower() == "true"
+
+    # Admission control per worker: chat requests processed at once (0 = unlimited), and how many may wait for a slot,
+    # for how long and how many of them per user
+    CHAT_MAX_IN_FLIGHT = int(os.getenv("CHAT_MAX_IN_FLIGHT", "32"))
+    CHAT_MAX_QUEUE = int(os.getenv("CHAT_MAX_QUEUE", "64"))
+    CHAT_QUEUE_TIMEOUT = float(os.getenv("CHAT_QUEUE_TIMEOUT", "30"))
+    CHAT_MAX_QUEUE_PER_USER = int(os.getenv("CHAT_MAX_QUEUE_PER_USER", "4"))
+
+    # /chat/batch: items accepted per request, and items of a batch answered at once
+    CHAT_BATCH_MAX_ITEMS = int(os.getenv("CHAT_BATCH_MAX_ITEMS", "500"))
+    CHAT_BATCH_CONCURRENCY = int(os.getenv("CHAT_BATCH_CONCURRENCY", "4"))
+
+    # Server-side conversations, so clients can post only their new messages: "memory", "sqlite", "tiered" or
+    # "none" (clients always post the full history). Idle conversations expire, each keeps its last messages
+    CONVERSATION_STORE_BACKEND = os.getenv("CONVERSATION_STORE_BACKEND", "none")
+    CONVERSATION_STORE_PATH = os.getenv("CONVERSATION_STORE_PATH")
+    CONVERSATION_STORE_SIZE = int(os.getenv("CONVERSATION_STORE_SIZE", "10000"))
+    CONVERSATION_IDLE_TIMEOUT = float(os.getenv("CONVERSATION_IDLE_TIMEOUT", "1800"))
+    CONVERSATION_MAX_MESSAGES = int(os.getenv("CONVERSATION_MAX_MESSAGES", "100"))
+
+    # Local /metrics endpoint, independent of Application Insights. It is served without authentication and shows
+    # deployment hostnames and traffic, so it is off unless enabled (e.g. where only internal scrapers reach it)
+    METRICS_ENABLED = os.getenv("METRICS_ENABLED", "false").lower() == "true"
+
+    # Import the Graph SDK during startup instead of during the first request. Off by default: it moves the import
+    # cost to startup rather than saving it, which only pays off when the first request must not wait for it
+    STARTUP_WARMUP = os.getenv("STARTUP_WARMUP", "false").lower() == "true"
+    # Directory with tiktoken vocabulary files (e.g. cl100k_base.tiktoken), so workers don't download them
+    TIKTOKEN_VOCAB_DIR = os.getenv("TIKTOKEN_VOCAB_DIR")
+
+    startup_timer = current_app.config[CONFIG_STARTUP_TIMER]
+    set_vocabulary_dir(TIKTOKEN_VOCAB_DIR)
 
     # Use the current user identity to authenticate with Azure OpenAI, Cognitive Search and Blob Storage (no secrets needed,
     # just use 'az login' locally, and managed identity when deployed on Azure). If you need to use keys, use separate AzureKeyCredential instances with the
@@ -125,45 +382,327 @@ async def setup_clients():
     azure_credential = DefaultAzureCredential(exclude_shared_token_cache_credential=True)
 
     # Set up authentication helper
-    auth_helper = AuthenticationHelper(
-        use_authentication=AZURE_USE_AUTHENTICATION,
-        server_app_id=AZURE_SERVER_APP_ID,
-        server_app_secret=AZURE_SERVER_APP_SECRET,
-        client_app_id=AZURE_CLIENT_APP_ID,
-        tenant_id=AZURE_TENANT_ID,
-        token_cache_path=TOKEN_CACHE_PATH,
-    )
+    with startup_timer.measure("authentication"):
+        auth_helper = AuthenticationHelper(
+            use_authentication=AZURE_USE_AUTHENTICATION,
+            server_app_id=AZURE_SERVER_APP_ID,
+            server_app_secret=AZURE_SERVER_APP_SECRET,
+            client_app_id=AZURE_CLIENT_APP_ID,
+            tenant_id=AZURE_TENANT_ID,
+            token_cache_path=TOKEN_CACHE_PATH,
+            msal_thread_pool_size=MSAL_THREAD_POOL_SIZE,
+            authority_host=AZURE_AUTHORITY_HOST,
+            token_cache=create_cache_backend(OBO_TOKEN_CACHE_BACKEND, OBO_TOKEN_CACHE_SIZE, OBO_TOKEN_CACHE_PATH),
+        )
 
     # Used by the OpenAI SDK
-    if OPENAI_HOST == "azure":
+    if OPENAI_HOST == "azure" and AZURE_OPENAI_KEY:
+        openai.api_type = "azure"
+        openai.api_base = AZURE_OPENAI_ENDPOINT
+        openai.api_version = "2023-07-01-preview"
+        openai.api_key = AZURE_OPENAI_KEY
+    elif OPENAI_HOST == "azure":
         openai.api_type = "azure_ad"
-        openai.api_base = f"https://{AZURE_OPENAI_SERVICE}.openai.azure.com"
+        openai.api_base = AZURE_OPENAI_ENDPOINT
         openai.api_version = "2023-07-01-preview"
-        openai_token = await azure_credential.get_token("https://cognitiveservices.azure.com/.default")
-        openai.api_key = openai_token.token
-        current_app.config[CONFIG_OPENAI_TOKEN] = openai_token
+        app = current_app._get_current_object()
+
+        def set_openai_token(openai_token):
+            openai.api_key = openai_token.token
+            app.config[CONFIG_OPENAI_TOKEN] = openai_token
+
+        token_refresher = TokenRefresher(
+            azure_credential,
+            "https://cognitiveservices.azure.com/.default",
+            on_refresh=set_openai_token,
+            refresh_margin=OPENAI_TOKEN_REFRESH_MARGIN,
+            jitter=OPENAI_TOKEN_REFRESH_JITTER,
+        )
+        with startup_timer.measure("openai_token"):
+            await token_refresher.start()
+        current_app.config[CONFIG_TOKEN_REFRESHER] = token_refresher
     else:
         openai.api_type = "openai"
         openai.api_key = OPENAI_API_KEY
         openai.organization = OPENAI_ORGANIZATION
 
+    deployment_scheduler = None
+    query_deployment_scheduler = None
+    if OPENAI_HOST == "azure":
+        if AZURE_OPENAI_DEPLOYMENTS:
+            deployments = parse_deployments(AZURE_OPENAI_DEPLOYMENTS)
+        else:
+            deployments = [
+                Deployment(
+                    name=AZURE_OPENAI_CHATGPT_DEPLOYMENT,
+                    endpoint=AZURE_OPENAI_ENDPOINT,
+                    api_key=AZURE_OPENAI_KEY,
+                    tpm=AZURE_OPENAI_CHATGPT_TPM,
+                    rpm=AZURE_OPENAI_CHATGPT_RPM,
+                )
+            ]
+        deployment_scheduler = DeploymentScheduler(
+            deployments, api_version=openai.api_version, max_wait=OPENAI_RATE_LIMIT_MAX_WAIT
+        )
+        # The rewrite gets its own scheduler only with its own deployments, so their quota is accounted separately
+        query_deployments = None
+        if AZURE_OPENAI_QUERY_DEPLOYMENTS:
+            query_deployments = parse_deployments(AZURE_OPENAI_QUERY_DEPLOYMENTS)
+        elif AZURE_OPENAI_QUERY_DEPLOYMENT:
+            query_deployments = [
+                Deployment(
+                    name=AZURE_OPENAI_QUERY_DEPLOYMENT,
+                    endpoint=AZURE_OPENAI_ENDPOINT,
+                    api_key=AZURE_OPENAI_KEY,
+                    tpm=AZURE_OPENAI_QUERY_TPM,
+                    rpm=AZURE_OPENAI_QUERY_RPM,
+                )
+            ]
+        elif AZURE_OPENAI_QUERY_MODEL != OPENAI_CHATGPT_MODEL:
+            # The rewrite would be sized for one model and sent to the answer's deployment of another
+            raise ValueError(
+                "AZURE_OPENAI_QUERY_MODEL requires AZURE_OPENAI_QUERY_DEPLOYMENT or AZURE_OPENAI_QUERY_DEPLOYMENTS"
+            )
+        if query_deployments:
+            query_deployment_scheduler = DeploymentScheduler(
+                query_deployments, api_version=openai.api_version, max_wait=OPENAI_RATE_LIMIT_MAX_WAIT
+            )
+
     current_app.config["TENANT_ID"] = AZURE_TENANT_ID
     current_app.config["CLIENT_ID"] = AZURE_SERVER_APP_ID
     current_app.config["APP_SECRET"] = AZURE_SERVER_APP_SECRET
     current_app.config[CONFIG_CREDENTIAL] = azure_credential
     current_app.config[CONFIG_AUTH_CLIENT] = auth_helper
-    current_app.config[CONFIG_CHAT_APPROACH] = ChatReadRetrieveReadApproach(
+    current_app.config[CONFIG_BATCH_MAX_ITEMS] = CHAT_BATCH_MAX_ITEMS
+    current_app.config[CONFIG_BATCH_CONCURRENCY] = CHAT_BATCH_CONCURRENCY
+    current_app.config[CONFIG_STREAM_WRITER] = NDJSONStreamWriter(
+        max_frame_bytes=STREAM_MAX_FRAME_BYTES,
+        max_frame_delay=STREAM_MAX_FRAME_DELAY,
+        heartbeat_interval=STREAM_HEARTBEAT_INTERVAL,
+    )
+
+    http_client_pool = HttpClientPool(
+        limit=HTTP_POOL_LIMIT,
+        limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+        keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+        dns_cache_ttl=HTTP_DNS_CACHE_TTL,
+    )
+    with startup_timer.measure("http_pool"):
+        await http_client_pool.open()
+        if HTTP_PREWARM:
+            await http_client_pool.prewarm(
+                openai_urls=(
+                    [
+                        state.deployment.endpoint
+                        for scheduler in (deployment_scheduler, query_deployment_scheduler)
+                        if scheduler is not None
+                        for state in scheduler.states
+                    ]
+                    if deployment_scheduler
+                    else [openai.api_base]
+                ),
+                graph_urls=[f"{GRAPH_ENDPOINT}/v1.0/"]
+            )
+    current_app.config[CONFIG_HTTP_CLIENT_POOL] = http_client_pool
+
+    graph_client_cache = GraphClientCache(
+        auth_helper,
+        max_size=GRAPH_CLIENT_CACHE_SIZE,
+        http_client=http_client_pool.graph_http_client,
+        graph_endpoint=GRAPH_ENDPOINT,
+    )
+    current_app.config[CONFIG_GRAPH_CLIENT_CACHE] = graph_client_cache
+
+    query_cache_backend = create_cache_backend(QUERY_CACHE_BACKEND, QUERY_CACHE_SIZE, QUERY_CACHE_PATH)
+    query_cache = QueryRewriteCache(query_cache_backend, ttl=QUERY_CACHE_TTL) if query_cache_backend is not None else None
+    current_app.config[CONFIG_QUERY_CACHE] = query_cache
+
+    search_cache_backend = create_cache_backend(SEARCH_CACHE_BACKEND, SEARCH_CACHE_SIZE, SEARCH_CACHE_PATH)
+    search_cache = (
+        SearchResultCache(search_cache_backend, ttl=SEARCH_CACHE_TTL) if search_cache_backend is not None else None
+    )
+    current_app.config[CONFIG_SEARCH_CACHE] = search_cache
+
+    conversation_store_backend = create_cache_backend(
+        CONVERSATION_STORE_BACKEND, CONVERSATION_STORE_SIZE, CONVERSATION_STORE_PATH
+    )
+    conversation_store = (
+        ConversationStore(
+            conversation_store_backend, idle_timeout=CONVERSATION_IDLE_TIMEOUT, max_messages=CONVERSATION_MAX_MESSAGES
+        )
+        if conversation_store_backend is not None
+        else None
+    )
+    current_app.config[CONFIG_CONVERSATION_STORE] = conversation_store
+
+    content_cache = (
+        ContentCache(CONTENT_CACHE_DIR, max_bytes=CONTENT_CACHE_MAX_MB * 1024 * 1024) if CONTENT_CACHE_DIR else None
+    )
+
+    metrics_registry = MetricsRegistry()
+    current_app.config[CONFIG_METRICS] = metrics_registry if METRICS_ENABLED else None
+    current_app.config[CONFIG_ADMISSION] = (
+        AdmissionController(
+            max_in_flight=CHAT_MAX_IN_FLIGHT,
+            max_queue=CHAT_MAX_QUEUE,
+            queue_timeout=CHAT_QUEUE_TIMEOUT,
+            max_queue_per_user=CHAT_MAX_QUEUE_PER_USER,
+            registry=metrics_registry,
+        )
+        if CHAT_MAX_IN_FLIGHT > 0
+        else None
+    )
+    if STARTUP_WARMUP:
+        with startup_timer.measure("import:msgraph"):
+            import_graph_sdk()
+    # The approach counts the tokens of its prompts when it is created, which loads the tokenizer vocabulary
+    with startup_timer.measure("tokenizer"):
+        get_encoding(OPENAI_CHATGPT_MODEL)
+        get_encoding(AZURE_OPENAI_QUERY_MODEL)
+    chat_approach = ChatReadRetrieveReadApproach(
         OPENAI_HOST,
         AZURE_OPENAI_CHATGPT_DEPLOYMENT,
         OPENAI_CHATGPT_MODEL,
+        graph_client_cache,
+        http_client_pool.openai_session,
+        query_cache,
+        GraphSearch(search_cache, page_size=SEARCH_PAGE_SIZE),
+        speculative_retrieval=SPECULATIVE_RETRIEVAL,
+        skip_rewrite_max_chars=SKIP_REWRITE_MAX_CHARS,
+        search_top=SEARCH_TOP,
+        search_entity_types=[value.strip() for value in SEARCH_ENTITY_TYPES.split(",") if value.strip()],
+        search_timeout=SEARCH_TIMEOUT or None,
+        content_fetcher=ContentFetcher(max_concurrency=CONTENT_FETCH_CONCURRENCY, content_cache=content_cache),
+        fetch_top=CONTENT_FETCH_TOP,
+        chunk_token_limit=CHUNK_TOKEN_LIMIT,
+        history_token_ratio=HISTORY_TOKEN_RATIO,
+        reranker=BM25Reranker() if RERANK_ENABLED else None,
+        rerank_min_relative_score=RERANK_MIN_RELATIVE_SCORE,
+        metrics=ChatMetrics(metrics_registry),
+        single_flight=SingleFlight() if REQUEST_COALESCING else None,
+        deployment_scheduler=deployment_scheduler,
+        conversation_store=conversation_store,
+        query_model=AZURE_OPENAI_QUERY_MODEL,
+        query_deployment=AZURE_OPENAI_QUERY_DEPLOYMENT,
+        query_deployment_scheduler=query_deployment_scheduler,
+    )
+    current_app.config[CONFIG_CHAT_APPROACH] = chat_approach
+    register_cache_metrics(
+        metrics_registry, chat_approach, auth_helper, query_cache, search_cache, conversation_store, content_cache
+    )
+    startup_timer.finish(metrics_registry)
+
+
+def register_cache_metrics(
+    registry: MetricsRegistry,
+    chat_approach: ChatReadRetrieveReadApproach,
+    auth_helper: AuthenticationHelper,
+    query_cache: Optional[QueryRewriteCache],
+    search_cache: Optional[SearchResultCache],
+    conversation_store: Optional[ConversationStore],
+    content_cache: Optional[ContentCache],
+):
+    # Exposes the counters the caches already keep, read at scrape time
+    def cache_lookups() -> dict[tuple[str, ...], float]:
+        stats = {
+            "obo_token": auth_helper.get_obo_cache_stats(),
+            "token_count": {"hits": token_count_cache.hits, "misses": token_count_cache.misses},
+        }
+        if query_cache is not None:
+            stats["query_rewrite"] = query_cache.get_stats()
+        if search_cache is not None:
+            stats["search_result"] = search_cache.get_stats()
+        if conversation_store is not None:
+            stats["conversation"] = conversation_store.get_stats()
+        if content_cache is not None:
+            stats["content"] = content_cache.get_stats()
+        values = {}
+        for cache, cache_stats in stats.items():
+            values[(cache, "hit")] = cache_stats["hits"]
+            values[(cache, "miss")] = cache_stats["misses"]
+        return values
+
+    registry.callback(
+        "chat_cache_lookups_total", "Cache lookups by cache and result", "counter", ("cache", "result"), cache_lookups
+    )
+    registry.callback(
+        "chat_retrieval_path_total",
+        "Requests by how their search query was obtained",
+        "counter",
+        ("path",),
+        lambda: {(path,): count for path, count in chat_approach.get_retrieval_path_stats().items()},
     )
+    # The query rewrite's deployments are listed along the answer's when it has its own
+    deployment_schedulers = [chat_approach.deployment_scheduler]
+    if chat_approach.query_deployment_scheduler is not chat_approach.deployment_scheduler:
+        deployment_schedulers.append(chat_approach.query_deployment_scheduler)
+    deployment_schedulers = [scheduler for scheduler in deployment_schedulers if scheduler is not None]
+    if deployment_schedulers:
+        for stat, metric_type, documentation in (
+            ("in_flight", "gauge", "Azure OpenAI calls waiting for a response"),
+            ("throttled", "counter", "429 responses"),
+            ("failed", "counter", "Server and connection errors"),
+            ("token_headroom", "gauge", "Share of the TPM burst budget available"),
+        ):
+            registry.callback(
+                f"chat_deployment_{stat}" + ("_total" if metric_type == "counter" else ""),
+                f"{documentation} per Azure OpenAI deployment",
+                metric_type,
+                ("deployment",),
+                lambda stat=stat: {
+                    (label,): stats[stat]
+                    for scheduler in deployment_schedulers
+                    for label, stats in scheduler.get_stats().items()
+                },
+            )
+    if chat_approach.single_flight is not None:
+        single_flight = chat_approach.single_flight
+        registry.callback(
+            "chat_coalesced_calls_total",
+            "Upstream calls by stage, made (leader) or joined while in flight (follower)",
+            "counter",
+            ("stage", "role"),
+            lambda: {
+                (stage, role): stats[role + "s"]
+                for stage, stats in single_flight.get_stats().items()
+                for role in ("leader", "follower")
+            },
+        )
+
+
+@bp.after_app_serving
+async def close_clients():
+    if CONFIG_TOKEN_REFRESHER in current_app.config:
+        await current_app.config[CONFIG_TOKEN_REFRESHER].stop()
+    await current_app.config[CONFIG_GRAPH_CLIENT_CACHE].close()
+    await current_app.config[CONFIG_HTTP_CLIENT_POOL].close()
+    if current_app.config[CONFIG_QUERY_CACHE] is not None:
+        await current_app.config[CONFIG_QUERY_CACHE].close()
+    if current_app.config[CONFIG_SEARCH_CACHE] is not None:
+        await current_app.config[CONFIG_SEARCH_CACHE].close()
+    if current_app.config[CONFIG_CONVERSATION_STORE] is not None:
+        await current_app.config[CONFIG_CONVERSATION_STORE].close()
+    await current_app.config[CONFIG_AUTH_CLIENT].close()
 
 
 def create_app():
+    startup_timer = StartupTimer()
+    # CPU time of the process so far, i.e. mostly importing this module and its dependencies: workers import
+    # the app after gunicorn forks them, and a forked process starts with no CPU time. The import:<package>
+    # entries are the share of the heavy packages in it.
+    startup_timer.record("imports", time.process_time())
+    for module, seconds in IMPORT_DURATIONS.items():
+        startup_timer.record(f"import:{module}", seconds)
     if os.getenv("APPLICATIONINSIGHTS_CONNECTION_STRING"):
-        configure_azure_monitor()
-        AioHttpClientInstrumentor().instrument()
+        # Only imported when Application Insights is used, the exporter takes a good part of the worker startup
+        with startup_timer.measure("import:azure.monitor.opentelemetry"):
+            from azure.monitor.opentelemetry import configure_azure_monitor
+            from opentelemetry.instrumentation.aiohttp_client import AioHttpClientInstrumentor
+        with startup_timer.measure("telemetry"):
+            configure_azure_monitor()
+            AioHttpClientInstrumentor().instrument()
     app = Quart(__name__)
+    app.config[CONFIG_STARTUP_TIMER] = startup_timer
     app.register_blueprint(bp)
     app.asgi_app = OpenTelemetryMiddleware(app.asgi_app)  # type: ignore[method-assign]
 
@@ -1,17 +1,37 @@
+import asyncio
 import json
 import logging
-from typing import Any, AsyncGenerator, Optional, Union
+import re
+import time
+import unicodedata
+from bisect import bisect_right
+from collections import Counter
+from itertools import accumulate
+from typing import Any, AsyncGenerator, Awaitable, Callable, Optional, Union
 
 import aiohttp
 import openai
-from msgraph.generated.search.query.query_post_request_body import QueryPostRequestBody
-from msgraph.generated.models.search_request import SearchRequest
-from msgraph.generated.models.entity_type import EntityType
-from msgraph.generated.models.search_query import SearchQuery
 from approaches.approach import Approach
+from core.admission import AdmissionTicket
+from core.authentication import AuthenticationHelper
 from core.messagebuilder import MessageBuilder
-from core.modelhelper import get_token_limit
-from core.graphclientbuilder import GraphClientBuilder
+from core.modelhelper import (
+    REPLY_PRIMING_TOKENS,
+    get_encoding,
+    get_token_limit,
+    num_tokens_from_messages,
+    num_tokens_from_text,
+)
+from core.graphclientbuilder import GraphClientCache
+from core.contentfetcher import ContentFetcher
+from core.conversationstore import ConversationNotFound, ConversationStore
+from core.deploymentscheduler import DeploymentScheduler
+from core.graphsearch import GraphSearch, SearchHit, SearchResultCache
+from core.metrics import ChatMetrics, MetricsRegistry
+from core.textsplitter import split_text
+from core.querycache import QueryRewriteCache
+from core.reranker import BM25Reranker
+from core.singleflight import SingleFlight, make_messages_key
 
 class ChatReadRetrieveReadApproach(Approach):
     # Chat roles
@@ -21,6 +41,21 @@ class ChatReadRetrieveReadApproach(Approach):
 
     NO_RESPONSE = "0"
 
+    # Maximum tokens of the generated search query and of the answer
+    QUERY_RESPONSE_TOKEN_LIMIT = 100
+    ANSWER_RESPONSE_TOKEN_LIMIT = 1024
+
+    # How the search query of a request was obtained
+    PATH_REWRITE = "rewrite"
+    PATH_SKIPPED_REWRITE = "skipped_rewrite"
+    PATH_SPECULATIVE_HIT = "speculative_hit"
+    PATH_SPECULATIVE_MISS = "speculative_miss"
+
+    # Questions ending a sentence are not keyword-like
+    SENTENCE_MARKS = re.compile(r"[?？!！。.]")
+    # Queries are compared by words and CJK character bigrams, Japanese has no separators between terms
+    QUERY_TOKENIZER = BM25Reranker()
+
     """
     Simple retrieve-then-read implementation, using the Cognitive Search and OpenAI APIs directly. It first retrieves
     top documents from search, then constructs a prompt with them, and then uses OpenAI to generate an completion
@@ -60,42 +95,112 @@ If you cannot generate a search query, return only the number 0.
         openai_host: str,
         chatgpt_deployment: Optional[str],  # Not needed for non-Azure OpenAI
         chatgpt_model: str,
+        graph_client_cache: GraphClientCache,
+        openai_session: aiohttp.ClientSession,
+        query_cache: Optional[QueryRewriteCache] = None,
+        graph_search: Optional[GraphSearch] = None,
+        speculative_retrieval: bool = False,
+        skip_rewrite_max_chars: int = 0,
+        near_equal_query_threshold: float = 0.8,
+        search_top: int = 5,
+        search_entity_types: Optional[list[str]] = None,
+        search_timeout: Optional[float] = None,
+        content_fetcher: Optional[ContentFetcher] = None,
+        fetch_top: int = 3,
+        chunk_token_limit: int = 500,
+        history_token_ratio: float = 0.5,
+        reranker: Optional[BM25Reranker] = None,
+        rerank_min_relative_score: float = 0.0,
+        metrics: Optional[ChatMetrics] = None,
+        single_flight: Optional[SingleFlight] = None,
+        deployment_scheduler: Optional[DeploymentScheduler] = None,
+        conversation_store: Optional[ConversationStore] = None,
+        query_model: Optional[str] = None,
+        query_deployment: Optional[str] = None,
+        query_deployment_scheduler: Optional[DeploymentScheduler] = None,
     ):
         self.openai_host = openai_host
         self.chatgpt_deployment = chatgpt_deployment
         self.chatgpt_model = chatgpt_model
+        self.graph_client_cache = graph_client_cache
+        self.openai_session = openai_session
+        self.query_cache = query_cache
+        self.graph_search = graph_search or GraphSearch()
+        # Search with the raw question while the query is being rewritten, and keep the results if the rewrite agrees
+        self.speculative_retrieval = speculative_retrieval
+        # Single-turn keyword-like questions up to this length are searched as is (0 disables)
+        self.skip_rewrite_max_chars = skip_rewrite_max_chars
+        self.near_equal_query_threshold = near_equal_query_threshold
+        self.retrieval_path_counts: Counter[str] = Counter()
+        # Number of hits to retrieve, and how many of the top ones get their full content fetched
+        self.search_top = search_top
+        # Graph entityType values, searched concurrently (one request per group of types Graph accepts together)
+        self.search_entity_types = search_entity_types or ["listItem"]
+        # Seconds each of those requests may take before the answer goes ahead without its hits
+        self.search_timeout = search_timeout
+        self.content_fetcher = content_fetcher
+        self.fetch_top = fetch_top
+        self.chunk_token_limit = chunk_token_limit
+        # Share of the answer prompt budget that history may use, the rest is left for sources
+        self.history_token_ratio = history_token_ratio
+        # Local re-ranking of the hits against the question, hits scoring below the ratio of the best one are dropped
+        self.reranker = reranker
+        self.rerank_min_relative_score = rerank_min_relative_score
+        self.metrics = metrics or ChatMetrics(MetricsRegistry())
+        # Concurrent requests doing identical rewrite, search, content fetch or answer calls share one upstream call
+        self.single_flight = single_flight
+        # Spreads the calls over a pool of Azure OpenAI deployments, chatgpt_deployment is not used when set
+        self.deployment_scheduler = deployment_scheduler
+        # Keeps the history server-side, so clients can post only their new messages
+        self.conversation_store = conversation_store
         self.chatgpt_token_limit = get_token_limit(chatgpt_model)
+        # The query rewrite only returns a few keywords, it can go to a smaller and faster model and deployment
+        # than the answer. Each stage's prompt is sized for the token limit of its own model
+        self.query_model = query_model or chatgpt_model
+        self.query_deployment = query_deployment or chatgpt_deployment
+        self.query_deployment_scheduler = query_deployment_scheduler or deployment_scheduler
+        self.query_token_limit = get_token_limit(self.query_model)
+        # History token counts are counted with the answer model, they are reused for the rewrite when both share a tokenizer
+        self.query_shares_encoding = get_encoding(self.query_model).name == get_encoding(chatgpt_model).name
+
+        # The fixed prompts never change, count their tokens once instead of on every request
+        self.query_prompt_token_count = self.count_prompt_tokens(
+            self.SYSTEM, self.query_prompt_template, self.query_model
+        )
+        self.system_message_token_count = self.count_prompt_tokens(self.SYSTEM, self.system_message_chat_conversation)
+        self.query_few_shots_token_counts = [
+            self.count_prompt_tokens(shot["role"], shot["content"], self.query_model)
+            for shot in self.query_prompt_few_shots
+        ]
+        # Most the sources can take of the answer prompt, with the shortest possible history
+        self.source_token_budget = (
+            self.chatgpt_token_limit - self.ANSWER_RESPONSE_TOKEN_LIMIT - self.system_message_token_count
+        )
+
+    def count_prompt_tokens(self, role: str, content: str, model: Optional[str] = None) -> int:
+        return num_tokens_from_messages(
+            {"role": role, "content": MessageBuilder.normalize_content(content)}, model or self.chatgpt_model
+        )
 
     async def run_simple_chat(
         self,
         history: list[dict[str, str]],
         obo_token,
         should_stream: bool = False,
+        history_token_counts: Optional[list[int]] = None,
     ) -> tuple:
-        # Step.1 ユーザーの入力からクエリを作成する
         original_user_query = history[-1]["content"]
-        user_query_request = "Generate search query for: " + original_user_query
-        
-        query_messages = self.get_messages_from_history(
-            system_prompt=self.query_prompt_template,
-            model_id=self.chatgpt_model,
-            history=history,
-            user_content=user_query_request,
-            max_tokens=self.chatgpt_token_limit - len(user_query_request),
-            few_shots=self.query_prompt_few_shots,
-        )
-
         chatgpt_args = {"deployment_id": self.chatgpt_deployment} if self.openai_host == "azure" else {}
-        chat_completion = await openai.ChatCompletion.acreate(
-            **chatgpt_args,
-            model=self.chatgpt_model,
-            messages=query_messages,
-            temperature=0.0,
-            max_tokens=100,  # Setting too low risks malformed JSON, setting too high may affect performance
-            n=1
-        )
+        query_args = {"deployment_id": self.query_deployment} if self.openai_host == "azure" else {}
 
-        generated_query = chat_completion["choices"][0]["message"]["content"]
+        # Step1. ユーザーの入力からクエリを作成する
+        # Step2. クエリを使ってGraphを検索する
+        client = await self.graph_client_cache.get_client(obo_token)
+        cache_scope = AuthenticationHelper.get_cache_scope(obo_token)
+        generated_query, hits, retrieval_path = await self.retrieve(
+            client, cache_scope, history, query_args, history_token_counts
+        )
+        self.retrieval_path_counts[retrieval_path] += 1
 
         if generated_query == self.NO_RESPONSE: 
             # TODO: クエリがない場合は通常の会話をする
@@ -111,27 +216,8 @@ If you cannot generate a search query, return only the number 0.
             }
             return ({}, query_not_found_msg)
 
-        #print("Generated_query:"+generated_query)
-
-        # Step2. クエリを使ってGraphを検索する
-        client = GraphClientBuilder().get_client(obo_token)
-
-        request_body = QueryPostRequestBody(
-            requests=[
-                SearchRequest(
-                    entity_types=[EntityType.ListItem],
-                    query=SearchQuery(
-                        query_string=generated_query
-                    ),
-                    size=1 #取得するページのサイズ。いっぱい取得してもtoken上限で使わないので1でいい
-                )
-            ]
-        )
-        
-        search_result = await client.search.query.post(body = request_body)
-        
         #search_resultがない場合は、クエリ生成したクエリを返す
-        if search_result.value[0].hits_containers[0].total == 0:
+        if not hits:
             source_not_found_msg ={
                 'choices':[
                     {
@@ -144,66 +230,356 @@ If you cannot generate a search query, return only the number 0.
             }
             return ({}, source_not_found_msg)
 
-        #print(search_result)
-        #ここではsummaryをソースにしているが、文章量によってはコンテンツ別にデータを取ったほうがいいかもしれない
-        results = [
-                hit.resource.id + ": " + hit.summary
-                for hit in search_result.value[0].hits_containers[0].hits
-        ]
-        content = "\n".join(results)
+        if self.reranker is not None:
+            with self.metrics.stage("rerank"):
+                order = self.reranker.rerank(
+                    original_user_query,
+                    [f"{hit.name} {hit.summary}" for hit in hits],
+                    self.rerank_min_relative_score,
+                )
+            hits = [hits[i] for i in order]
 
-        citaion_source = [
-            {
-                "id": hit.resource.id,
-                "web_url": hit.resource.web_url,
-                "hit_id": hit.hit_id,
-                "name": hit.resource.name or hit.resource.web_url.split("/")[-1]
-            } for hit in search_result.value[0].hits_containers[0].hits
-        ]
+        with self.metrics.stage("content_fetch"):
+            # Content is fetched with the user's permissions, so like searches it is only shared per user assertion
+            sources_key = json.dumps([cache_scope, [hit.id for hit in hits]], ensure_ascii=False)
+            sources = await self.coalesce("content_fetch", sources_key, lambda: self.get_sources(client, hits))
 
         # Step3. Graphから取得した結果をから回答を生成する
-        response_token_limit = 1024
+        response_token_limit = self.ANSWER_RESPONSE_TOKEN_LIMIT
         messages_token_limit = self.chatgpt_token_limit - response_token_limit
-        answer_messages = self.get_messages_from_history(
-            system_prompt=self.system_message_chat_conversation,
-            model_id=self.chatgpt_model,
-            history=history,
-            user_content=original_user_query + "\n\nSources:\n" + content,
-            max_tokens=messages_token_limit,
-        )
+        with self.metrics.stage("prompt_assembly"):
+            message_builder = self.build_messages(
+                system_prompt=self.system_message_chat_conversation,
+                model_id=self.chatgpt_model,
+                history=history,
+                user_content=original_user_query + "\n\nSources:\n",
+                max_tokens=int(messages_token_limit * self.history_token_ratio),
+                system_token_count=self.system_message_token_count,
+                history_token_counts=history_token_counts,
+            )
+            used_hits = self.pack_sources(message_builder, sources, messages_token_limit)
+        answer_messages = message_builder.messages
+        prompt_tokens = message_builder.token_count + REPLY_PRIMING_TOKENS
 
+        citaion_source = [hit.to_citation() for hit in used_hits]
         extra_info = {
             "data_points": citaion_source,
+            "retrieval_path": retrieval_path,
         }
 
-        chat_coroutine = await openai.ChatCompletion.acreate(
-            **chatgpt_args,
-            model=self.chatgpt_model,
-            messages=answer_messages,
-            temperature=0,
-            max_tokens=response_token_limit,
-            n=1,
-            stream=should_stream,
-        )
-        
+        async def create_answer_stream() -> AsyncGenerator[dict, None]:
+            started = time.perf_counter()
+            chat_coroutine = await self.create_chat_completion(
+                chatgpt_args,
+                prompt_tokens,
+                self.deployment_scheduler,
+                model=self.chatgpt_model,
+                messages=answer_messages,
+                temperature=0,
+                max_tokens=response_token_limit,
+                n=1,
+                stream=True,
+            )
+            return self.measure_answer_stream(chat_coroutine, started, prompt_tokens)
+
+        async def create_answer() -> Any:
+            chat_completion = await self.create_chat_completion(
+                chatgpt_args,
+                prompt_tokens,
+                self.deployment_scheduler,
+                model=self.chatgpt_model,
+                messages=answer_messages,
+                temperature=0,
+                max_tokens=response_token_limit,
+                n=1,
+            )
+            self.observe_usage("answer", chat_completion, prompt_tokens)
+            return chat_completion
+
+        answer_key = make_messages_key(self.chatgpt_model, answer_messages)
+        if should_stream:
+            if self.single_flight is None:
+                return (extra_info, await create_answer_stream())
+            # Every subscriber gets the whole stream, also when it joins after the first tokens
+            return (extra_info, self.single_flight.stream("answer", answer_key, create_answer_stream))
+
+        with self.metrics.stage("answer"):
+            chat_coroutine = await self.coalesce("answer", answer_key, create_answer)
         return (extra_info, chat_coroutine)
 
+    async def coalesce(self, stage: str, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        if self.single_flight is None:
+            return await fn()
+        return await self.single_flight.do(stage, key, fn)
+
+    async def measure_answer_stream(
+        self, chat_coroutine: AsyncGenerator, started: float, prompt_tokens: int
+    ) -> AsyncGenerator[dict, None]:
+        # Time to first token and total duration are measured from the request, so they include the queueing upstream
+        span = self.metrics.start_span("answer_stream")
+        completion = []
+        first_token = True
+        try:
+            async for event in chat_coroutine:
+                for choice in event["choices"]:
+                    content = (choice.get("delta") or {}).get("content")
+                    if content:
+                        if first_token:
+                            first_token = False
+                            self.metrics.observe_stage("answer_ttft", time.perf_counter() - started)
+                            span.add_event("first_token")
+                        completion.append(content)
+                yield event
+        finally:
+            self.metrics.observe_stage("answer_stream", time.perf_counter() - started)
+            # The streaming API reports no usage, count the completion locally
+            completion_tokens = num_tokens_from_text("".join(completion), self.chatgpt_model)
+            self.metrics.observe_tokens("answer", prompt_tokens, completion_tokens)
+            span.set_attribute("chat.completion_tokens", completion_tokens)
+            span.end()
+
+    async def create_chat_completion(
+        self,
+        chatgpt_args: dict[str, Any],
+        prompt_tokens: int,
+        deployment_scheduler: Optional[DeploymentScheduler],
+        **kwargs: Any,
+    ) -> Any:
+        # prompt_tokens is the local count of the messages, used for the rate limit accounting of the deployments
+        if deployment_scheduler is not None:
+            return await deployment_scheduler.create(prompt_tokens, **kwargs)
+        return await openai.ChatCompletion.acreate(**chatgpt_args, **kwargs)
+
+    def observe_usage(self, call: str, chat_completion: Any, prompt_tokens: int, model: Optional[str] = None):
+        # Prefers the usage reported by the service over the local counts
+        usage = chat_completion.get("usage") or {}
+        prompt_tokens = usage.get("prompt_tokens", prompt_tokens)
+        completion_tokens = usage.get("completion_tokens")
+        if completion_tokens is None:
+            content = chat_completion["choices"][0]["message"]["content"] or ""
+            completion_tokens = num_tokens_from_text(content, model or self.chatgpt_model)
+        self.metrics.observe_tokens(call, prompt_tokens, completion_tokens)
+
     
+    async def retrieve(
+        self,
+        client,
+        cache_scope: str,
+        history: list[dict[str, str]],
+        chatgpt_args: dict[str, Any],
+        history_token_counts: Optional[list[int]] = None,
+    ) -> tuple[str, list[SearchHit], str]:
+        # Returns the search query, its hits and which retrieval path was taken
+        original_user_query = history[-1]["content"]
+
+        if self.should_skip_rewrite(history):
+            query = original_user_query.strip()
+            return query, await self.search(client, cache_scope, query), self.PATH_SKIPPED_REWRITE
+
+        query_messages, query_prompt_tokens = self.get_query_messages(history, history_token_counts)
+        if not self.speculative_retrieval:
+            generated_query = await self.generate_search_query(query_messages, query_prompt_tokens, chatgpt_args)
+            if generated_query == self.NO_RESPONSE:
+                return generated_query, [], self.PATH_REWRITE
+            return generated_query, await self.search(client, cache_scope, generated_query), self.PATH_REWRITE
+
+        speculative_search = asyncio.create_task(self.search(client, cache_scope, original_user_query))
+        try:
+            generated_query = await self.generate_search_query(query_messages, query_prompt_tokens, chatgpt_args)
+        except BaseException:
+            self.discard_task(speculative_search)
+            raise
+        if generated_query == self.NO_RESPONSE:
+            self.discard_task(speculative_search)
+            return generated_query, [], self.PATH_SPECULATIVE_MISS
+        if self.is_near_equal_query(generated_query, original_user_query):
+            return generated_query, await speculative_search, self.PATH_SPECULATIVE_HIT
+        self.discard_task(speculative_search)
+        return generated_query, await self.search(client, cache_scope, generated_query), self.PATH_SPECULATIVE_MISS
+
+    def get_query_messages(
+        self, history: list[dict[str, str]], history_token_counts: Optional[list[int]] = None
+    ) -> tuple[list, int]:
+        # Returns the messages of the rewrite call and their prompt token count
+        user_query_request = "Generate search query for: " + history[-1]["content"]
+        message_builder = self.build_messages(
+            system_prompt=self.query_prompt_template,
+            model_id=self.query_model,
+            history=history,
+            user_content=user_query_request,
+            max_tokens=self.query_token_limit - self.QUERY_RESPONSE_TOKEN_LIMIT,
+            few_shots=self.query_prompt_few_shots,
+            system_token_count=self.query_prompt_token_count,
+            few_shots_token_counts=self.query_few_shots_token_counts,
+            history_token_counts=history_token_counts if self.query_shares_encoding else None,
+        )
+        return message_builder.messages, message_builder.token_count + REPLY_PRIMING_TOKENS
+
+    async def search(self, client, cache_scope: str, query: str) -> list[SearchHit]:
+        # Search results are trimmed to what the user may see, so only searches of the same user are coalesced
+        entity_types = self.search_entity_types
+        key = SearchResultCache.make_key(
+            cache_scope, entity_types, unicodedata.normalize("NFC", query), self.search_top
+        )
+        with self.metrics.stage("graph_search"):
+            return await self.coalesce(
+                "graph_search",
+                key,
+                lambda: self.graph_search.search(
+                    client,
+                    cache_scope,
+                    query,
+                    entity_types=entity_types,
+                    size=self.search_top,
+                    timeout=self.search_timeout,
+                    is_enough=self.fills_source_budget,
+                ),
+            )
+
+    def fills_source_budget(self, hits: list[SearchHit]) -> bool:
+        # Estimated prompt tokens of the hits as sources: a chunk for those whose content is fetched, the summary
+        # for the others. Once the estimate reaches the budget more hits can't make it into the prompt.
+        fetched = min(len(hits), self.fetch_top) if self.content_fetcher is not None else 0
+        tokens = fetched * self.chunk_token_limit + sum(
+            num_tokens_from_text(f"{hit.id}: {hit.summary}\n", self.chatgpt_model) for hit in hits[fetched:]
+        )
+        return tokens >= self.source_token_budget
+
+    async def get_sources(self, client, hits: list[SearchHit]) -> list[tuple[SearchHit, list[str]]]:
+        # Full content for the top hits (fetched concurrently), the search summary for the rest, split into chunks
+        texts = [hit.summary for hit in hits]
+        if self.content_fetcher is not None and self.fetch_top > 0:
+            texts[: self.fetch_top] = await self.content_fetcher.fetch_all(client, hits[: self.fetch_top])
+        return [
+            (hit, split_text(MessageBuilder.normalize_content(text), self.chatgpt_model, self.chunk_token_limit))
+            for hit, text in zip(hits, texts)
+        ]
+
+    def pack_sources(
+        self, message_builder: MessageBuilder, sources: list[tuple[SearchHit, list[str]]], max_tokens: int
+    ) -> list[SearchHit]:
+        """
+        Appends source chunks to the last (user) message until the prompt reaches max_tokens.
+        Chunks are taken breadth-first: the first chunk of every hit in ranking order, then the second ones, etc.
+        Returns the hits that made it into the prompt.
+        """
+        user_index = len(message_builder.messages) - 1
+        user_message = message_builder.messages[user_index]
+        remaining_tokens = max_tokens - message_builder.token_count - REPLY_PRIMING_TOKENS
+
+        candidates = []
+        for depth in range(max((len(chunks) for _, chunks in sources), default=0)):
+            for rank, (hit, chunks) in enumerate(sources):
+                if depth < len(chunks):
+                    candidates.append((rank, depth, hit, f"{hit.id}: {chunks[depth]}\n"))
+        selected = []
+        for candidate in candidates:
+            line_tokens = num_tokens_from_text(candidate[3], self.chatgpt_model)
+            if line_tokens <= remaining_tokens:
+                selected.append(candidate)
+                remaining_tokens -= line_tokens
+
+        # Keep the chunks of a hit together and in ranking order, then make sure the joined text really fits,
+        # since tokens can merge across line boundaries
+        selected.sort(key=lambda candidate: (candidate[0], candidate[1]))
+        prefix = user_message["content"]
+        while True:
+            content = prefix + "".join(candidate[3] for candidate in selected).rstrip("\n")
+            message_builder.set_message_content(user_index, content)
+            if message_builder.token_count + REPLY_PRIMING_TOKENS <= max_tokens or not selected:
+                break
+            selected.pop()
+
+        used_hits = []
+        for _, _, hit, _ in selected:
+            if hit not in used_hits:
+                used_hits.append(hit)
+        return used_hits
+
+    @staticmethod
+    def discard_task(task: asyncio.Task):
+        # Cancels a task whose result is no longer needed without leaving an unretrieved exception behind
+        task.cancel()
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+    def should_skip_rewrite(self, history: list[dict[str, str]]) -> bool:
+        # Without earlier turns there is nothing for the rewrite to resolve, and a short keyword list is already a query
+        if self.skip_rewrite_max_chars <= 0 or len(history) != 1:
+            return False
+        question = history[-1]["content"].strip()
+        return (
+            0 < len(question) <= self.skip_rewrite_max_chars
+            and not self.SENTENCE_MARKS.search(question)
+        )
+
+    def get_query_terms(self, query: str) -> set[str]:
+        return set(self.QUERY_TOKENIZER.tokenize(query))
+
+    def is_near_equal_query(self, query: str, other_query: str) -> bool:
+        terms = self.get_query_terms(query)
+        other_terms = self.get_query_terms(other_query)
+        if not terms or not other_terms:
+            return False
+        similarity = len(terms & other_terms) / len(terms | other_terms)
+        return similarity >= self.near_equal_query_threshold
+
+    def get_retrieval_path_stats(self) -> dict[str, int]:
+        return dict(self.retrieval_path_counts)
+
+    async def generate_search_query(
+        self, query_messages: list[dict[str, str]], prompt_tokens: int, chatgpt_args: dict[str, Any]
+    ) -> str:
+        with self.metrics.stage("query_rewrite") as span:
+            return await self.coalesce(
+                "query_rewrite",
+                make_messages_key(self.query_model, query_messages),
+                lambda: self._generate_search_query(query_messages, prompt_tokens, chatgpt_args, span),
+            )
+
+    async def _generate_search_query(
+        self, query_messages: list[dict[str, str]], prompt_tokens: int, chatgpt_args: dict[str, Any], span
+    ) -> str:
+        if self.query_cache is not None:
+            cached_query = await self.query_cache.get(self.query_model, query_messages)
+            span.set_attribute("chat.cache_hit", cached_query is not None)
+            if cached_query is not None:
+                return cached_query
+
+        chat_completion = await self.create_chat_completion(
+            chatgpt_args,
+            prompt_tokens,
+            self.query_deployment_scheduler,
+            model=self.query_model,
+            messages=query_messages,
+            temperature=0.0,
+            max_tokens=self.QUERY_RESPONSE_TOKEN_LIMIT,  # Setting too low risks malformed JSON, setting too high may affect performance
+            n=1
+        )
+        generated_query = chat_completion["choices"][0]["message"]["content"]
+        self.observe_usage("query_rewrite", chat_completion, prompt_tokens, self.query_model)
+
+        if self.query_cache is not None:
+            await self.query_cache.set(self.query_model, query_messages, generated_query)
+        return generated_query
+
     async def run_without_streaming(
         self,
         history: list[dict[str, str]],
         overrides: dict[str, Any],
         obo_token,
         session_state: Any = None,
+        history_token_counts: Optional[list[int]] = None,
     ) -> dict[str, Any]:
         extra_info, chat_coroutine = await self.run_simple_chat(
-            history, obo_token, should_stream=False
+            history, obo_token, should_stream=False, history_token_counts=history_token_counts
         )
 
         #extra_info, chat_coroutine = await self.run_until_final_call(
         #    history, overrides, auth_claims, should_stream=False
         #)
+        # The completion may be shared with coalesced requests, so copy what is modified
         chat_resp = dict(chat_coroutine)
+        chat_resp["choices"] = [dict(choice) for choice in chat_resp["choices"]]
         chat_resp["choices"][0]["context"] = extra_info
         chat_resp["choices"][0]["session_state"] = session_state
         return chat_resp
@@ -214,9 +590,12 @@ If you cannot generate a search query, return only the number 0.
         overrides: dict[str, Any],
         obo_token,
         session_state: Any = None,
+        history_token_counts: Optional[list[int]] = None,
     ) -> AsyncGenerator[dict, None]:
+        # The generator is consumed outside of run(), so set the session in the context it runs in
+        openai.aiosession.set(self.openai_session)
         extra_info, chat_coroutine = await self.run_simple_chat(
-            history, overrides, should_stream=True
+            history, obo_token, should_stream=True, history_token_counts=history_token_counts
         )
         yield {
             "choices": [
@@ -231,7 +610,21 @@ If you cannot generate a search query, return only the number 0.
             "object": "chat.completion.chunk",
         }
 
-        async for event in await chat_coroutine:
+        if isinstance(chat_coroutine, dict):
+            # Canned reply (no query or no sources), send it as a single delta
+            yield {
+                "choices": [
+                    {
+                        "delta": {"content": chat_coroutine["choices"][0]["message"]["content"]},
+                        "finish_reason": "stop",
+                        "index": 0,
+                    }
+                ],
+                "object": "chat.completion.chunk",
+            }
+            return
+
+        async for event in chat_coroutine:
             # "2023-07-01-preview" API version has a bug where first response has empty choices
             if event["choices"]:
                 yield event
@@ -241,14 +634,149 @@ If you cannot generate a search query, return only the number 0.
     ) -> Union[dict[str, Any], AsyncGenerator[dict[str, Any], None]]:
         overrides = context.get("overrides", {})
         obo_token = context.get("obo_token", {})
+        if self.conversation_store is None and not context.get("delta"):
+            if stream is False:
+                # Workaround for: https://github.com/openai/openai-python/issues/371
+                # The session is the worker-wide pool, it is closed when the app stops serving
+                openai.aiosession.set(self.openai_session)
+                response = await self.run_without_streaming(messages, overrides, obo_token, session_state)
+                return response
+            else:
+                return self.run_with_streaming(messages, overrides, obo_token, session_state)
+
+        user_id = AuthenticationHelper.get_cache_scope(obo_token)
+        history, token_counts, session_state = await self.open_conversation(
+            user_id, messages, session_state, context.get("delta", False)
+        )
         if stream is False:
-            # Workaround for: https://github.com/openai/openai-python/issues/371
-            async with aiohttp.ClientSession() as s:
-                openai.aiosession.set(s)
-                response = await self.run_without_streaming(messages, overrides,obo_token, session_state)
+            openai.aiosession.set(self.openai_session)
+            response = await self.run_without_streaming(history, overrides, obo_token, session_state, token_counts)
+            reply = response["choices"][0]["message"]["content"] or ""
+            await self.save_conversation(user_id, session_state, history, token_counts, reply)
             return response
-        else:
-            return self.run_with_streaming(messages, overrides, obo_token, session_state)
+        return self.save_streamed_conversation(
+            self.run_with_streaming(history, overrides, obo_token, session_state, token_counts),
+            user_id,
+            session_state,
+            history,
+            token_counts,
+        )
+
+    async def open_conversation(
+        self, user_id: str, messages: list[dict], session_state: Any, delta: bool
+    ) -> tuple[list[dict[str, str]], list[int], dict[str, Any]]:
+        """
+        Returns the normalized history with its token counts and the session_state of the answer.
+        With delta, messages are the new messages of the conversation session_state refers to, otherwise
+        they are the whole history and start (or replace) a stored conversation.
+        """
+        new_messages = [
+            {"role": message["role"], "content": MessageBuilder.normalize_content(message["content"])}
+            for message in messages
+        ]
+        new_token_counts = [num_tokens_from_messages(message, self.chatgpt_model) for message in new_messages]
+        if not delta:
+            # The answer will be the next message
+            return new_messages, new_token_counts, ConversationStore.new_session_state(len(new_messages) + 1)
+        if self.conversation_store is None:
+            raise ConversationNotFound("Conversations are not stored, post the full history")
+        stored_messages, stored_token_counts = await self.conversation_store.load(user_id, session_state)
+        next_session_state = {
+            "conversation_id": session_state["conversation_id"],
+            "turn": session_state["turn"] + len(new_messages) + 1,
+        }
+        return stored_messages + new_messages, stored_token_counts + new_token_counts, next_session_state
+
+    async def save_conversation(
+        self,
+        user_id: str,
+        session_state: dict[str, Any],
+        history: list[dict[str, str]],
+        token_counts: list[int],
+        reply: str,
+    ):
+        message = {"role": self.ASSISTANT, "content": MessageBuilder.normalize_content(reply)}
+        await self.conversation_store.save(
+            user_id,
+            session_state,
+            history + [message],
+            token_counts + [num_tokens_from_messages(message, self.chatgpt_model)],
+        )
+
+    async def save_streamed_conversation(
+        self,
+        events: AsyncGenerator[dict[str, Any], None],
+        user_id: str,
+        session_state: dict[str, Any],
+        history: list[dict[str, str]],
+        token_counts: list[int],
+    ) -> AsyncGenerator[dict[str, Any], None]:
+        # Only a complete answer is stored; after an aborted one the client's next delta is refused
+        reply = []
+        async for event in events:
+            for choice in event["choices"]:
+                content = (choice.get("delta") or {}).get("content")
+                if content:
+                    reply.append(content)
+            yield event
+        await self.save_conversation(user_id, session_state, history, token_counts, "".join(reply))
+
+    async def run_batch(
+        self,
+        items: list[dict[str, Any]],
+        context: dict[str, Any] = {},
+        max_concurrency: int = 4,
+        ticket: Optional[AdmissionTicket] = None,
+        admit: Optional[Callable[[], Awaitable[AdmissionTicket]]] = None,
+    ) -> AsyncGenerator[dict[str, Any], None]:
+        """
+        Answers many conversations of the same user, e.g. a set of evaluation questions. Each item has "messages"
+        and optionally "id" and "session_state". At most max_concurrency items are in flight at once, and they
+        share the user's Graph client, the caches and coalescing like concurrent /chat requests do.
+        With admission control, every item holds a slot while it runs like a /chat request: the first item uses
+        ticket (the slot the batch was admitted with), the others wait for one from admit, so a batch doesn't
+        put more upstream load on the worker than its in-flight limit allows.
+        One result is yielded per item as soon as it is done, so in completion order: {"index", "id"} plus
+        either "response" (the non-streaming chat completion) or "error". A failed item doesn't stop the others.
+        """
+        # The generator is consumed outside of the request, so set the session in the context the workers copy
+        openai.aiosession.set(self.openai_session)
+        overrides = context.get("overrides", {})
+        obo_token = context.get("obo_token", {})
+        pending = iter(enumerate(items))
+        results: asyncio.Queue[dict[str, Any]] = asyncio.Queue()
+
+        async def worker(ticket: Optional[AdmissionTicket]):
+            # Workers take the next item when they are done, so a slow item doesn't hold up a whole group
+            for index, item in pending:
+                result = {"index": index, "id": item.get("id")}
+                try:
+                    if ticket is None and admit is not None:
+                        ticket = await admit()
+                    result["response"] = await self.run_without_streaming(
+                        item["messages"], overrides, obo_token, item.get("session_state")
+                    )
+                except Exception as e:
+                    logging.exception("Exception in batch item %d", index)
+                    result["error"] = str(e)
+                finally:
+                    # The next item queues for a slot again, behind the requests of other users
+                    if ticket is not None:
+                        ticket.release()
+                        ticket = None
+                results.put_nowait(result)
+
+        workers = [
+            asyncio.create_task(worker(ticket if i == 0 else None)) for i in range(min(max_concurrency, len(items)))
+        ]
+        try:
+            for _ in range(len(items)):
+                yield await results.get()
+        finally:
+            # The client went away or the batch is done, either way nothing is left to wait for
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
 
     def get_messages_from_history(
         self,
@@ -258,27 +786,69 @@ If you cannot generate a search query, return only the number 0.
         user_content: str,
         max_tokens: int,
         few_shots=[],
+        system_token_count: Optional[int] = None,
+        few_shots_token_counts: Optional[list[int]] = None,
     ) -> list:
-        message_builder = MessageBuilder(system_prompt, model_id)
+        return self.build_messages(
+            system_prompt,
+            model_id,
+            history,
+            user_content,
+            max_tokens,
+            few_shots,
+            system_token_count,
+            few_shots_token_counts,
+        ).messages
+
+    def build_messages(
+        self,
+        system_prompt: str,
+        model_id: str,
+        history: list[dict[str, str]],
+        user_content: str,
+        max_tokens: int,
+        few_shots=[],
+        system_token_count: Optional[int] = None,
+        few_shots_token_counts: Optional[list[int]] = None,
+        history_token_counts: Optional[list[int]] = None,
+    ) -> MessageBuilder:
+        message_builder = MessageBuilder(system_prompt, model_id, system_token_count)
 
         # Add examples to show the chat what responses we want. It will try to mimic any responses and make sure they match the rules laid out in the system message.
-        for shot in few_shots:
-            message_builder.append_message(shot.get("role"), shot.get("content"))
+        for i, shot in enumerate(few_shots):
+            shot_token_count = few_shots_token_counts[i] if few_shots_token_counts else None
+            message_builder.append_message(
+                shot.get("role"), shot.get("content"), index=i + 1, token_count=shot_token_count
+            )
 
         append_index = len(few_shots) + 1
-
         message_builder.append_message(self.USER, user_content, index=append_index)
-        total_token_count = message_builder.count_tokens_for_message(message_builder.messages[-1])
 
-        newest_to_oldest = list(reversed(history[:-1]))
-        for message in newest_to_oldest:
-            potential_message_count = message_builder.count_tokens_for_message(message)
-            if (total_token_count + potential_message_count) > max_tokens:
-                logging.debug("Reached max tokens of %d, history will be truncated", max_tokens)
-                break
-            message_builder.append_message(message["role"], message["content"], index=append_index)
-            total_token_count += potential_message_count
-        return message_builder.messages
+        # max_tokens is the budget of the whole prompt, including the tokens that prime the reply
+        remaining_tokens = max_tokens - message_builder.token_count - REPLY_PRIMING_TOKENS
+
+        # Count every past message once (memoized across turns), then find how many of the newest ones fit
+        # with a binary search over their cumulative token counts, newest first.
+        # history_token_counts are given when the history is already normalized and counted (stored conversations)
+        if history_token_counts is not None:
+            past_messages = history[:-1]
+            token_counts = history_token_counts[:-1]
+        else:
+            past_messages = [
+                {"role": message["role"], "content": message_builder.normalize_content(message["content"])}
+                for message in history[:-1]
+            ]
+            token_counts = [message_builder.count_tokens_for_message(message) for message in past_messages]
+        newest_first_totals = list(accumulate(reversed(token_counts)))
+        fit_count = bisect_right(newest_first_totals, remaining_tokens)
+        if fit_count < len(past_messages):
+            logging.debug("Reached max tokens of %d, history will be truncated", max_tokens)
+
+        oldest_index = len(past_messages) - fit_count
+        message_builder.insert_messages(
+            past_messages[oldest_index:], token_counts[oldest_index:], index=append_index
+        )
+        return message_builder
 
     def get_search_query(self, chat_completion: dict[str, Any], user_query: str):
         response_message = chat_completion["choices"][0]["message"]
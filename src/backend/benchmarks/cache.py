@@ -0,0 +1,108 @@
+"""
+Benchmark of the cache backends under the gunicorn process model: several worker processes do get-or-compute
+on the same skewed key set, where a miss costs --miss-cost seconds (a search query rewrite or a Graph search).
+
+Run from src/backend:
+
+    python -m benchmarks.cache --workers 5 --ops 2000 --keys 1000
+    python -m benchmarks.cache --backends memory,tiered --miss-cost 0.2
+
+The in-process "memory" backend has the cheapest lookups but every worker computes each key itself, the shared
+"sqlite" and "tiered" backends pay for a file lookup but compute a key once per node. The shared store pays off
+when the misses it saves (misses per worker x workers) cost more than the added lookup time.
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+from typing import Optional
+
+from benchmarks.run import describe
+from core.cache import create_cache_backend
+
+# Size of a cached value, about one rewritten query plus a few search hits
+VALUE = {"query": "有給休暇 申請 方法", "hits": [{"id": str(i), "summary": "x" * 200} for i in range(5)]}
+
+
+def make_key_sequence(rng: random.Random, keys: int, ops: int, skew: float) -> list[str]:
+    # Zipf-like popularity: a few conversations and searches are repeated much more often than the rest
+    weights = [1 / (rank + 1) ** skew for rank in range(keys)]
+    return [f"key-{index}" for index in rng.choices(range(keys), weights=weights, k=ops)]
+
+
+async def run_worker(kind: str, path: Optional[str], args, seed: int) -> dict:
+    backend = create_cache_backend(kind, args.size, path)
+    keys = make_key_sequence(random.Random(seed), args.keys, args.ops, args.skew)
+    get_times, set_times = [], []
+    misses = 0
+    start = time.perf_counter()
+    for key in keys:
+        lookup = time.perf_counter()
+        value = await backend.get(key)
+        get_times.append(time.perf_counter() - lookup)
+        if value is None:
+            misses += 1
+            await asyncio.sleep(args.miss_cost)
+            store = time.perf_counter()
+            await backend.set(key, VALUE, args.ttl)
+            set_times.append(time.perf_counter() - store)
+    duration = time.perf_counter() - start
+    await backend.close()
+    return {"duration": duration, "misses": misses, "get_times": get_times, "set_times": set_times}
+
+
+def worker_main(kind: str, path: Optional[str], args, seed: int) -> dict:
+    return asyncio.run(run_worker(kind, path, args, seed))
+
+
+def run_backend(kind: str, args, work_dir: str) -> dict:
+    path = os.path.join(work_dir, f"{kind}.sqlite3") if kind != "memory" else None
+    with multiprocessing.get_context("spawn").Pool(args.workers) as pool:
+        results = pool.starmap(worker_main, [(kind, path, args, seed) for seed in range(args.workers)])
+    misses = sum(result["misses"] for result in results)
+    operations = args.workers * args.ops
+    return {
+        "hit_ratio": 1 - misses / operations,
+        "misses": misses,
+        "wall_time": max(result["duration"] for result in results),
+        "get": describe([value for result in results for value in result["get_times"]]),
+        "set": describe([value for result in results for value in result["set_times"]]),
+    }
+
+
+def print_report(report: dict[str, dict]):
+    print(f"{'backend':<10}{'hit ratio':>10}{'misses':>8}{'wall (s)':>10}{'get p50':>10}{'get p99':>10}{'set p50':>10}")
+    for kind, summary in report.items():
+        print(
+            f"{kind:<10}{summary['hit_ratio']:>10.1%}{summary['misses']:>8}{summary['wall_time']:>10.2f}"
+            f"{summary['get']['p50'] * 1e6:>9.0f}µ{summary['get']['p99'] * 1e6:>9.0f}µ"
+            f"{summary['set'].get('p50', 0) * 1e6:>9.0f}µ"
+        )
+
+
+def parse_args(argv: Optional[list[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backends", default="memory,sqlite,tiered", help="Comma-separated backends to compare")
+    parser.add_argument("--workers", type=int, default=5, help="Worker processes sharing the cache")
+    parser.add_argument("--ops", type=int, default=2000, help="Lookups per worker")
+    parser.add_argument("--keys", type=int, default=1000, help="Distinct keys")
+    parser.add_argument("--skew", type=float, default=1.0, help="Zipf exponent of the key popularity")
+    parser.add_argument("--size", type=int, default=1024, help="Entries kept by each cache")
+    parser.add_argument("--ttl", type=float, default=3600)
+    parser.add_argument("--miss-cost", type=float, default=0.05, help="Seconds to compute a missing value")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[list[str]] = None):
+    args = parse_args(argv)
+    with tempfile.TemporaryDirectory() as work_dir:
+        report = {kind: run_backend(kind, args, work_dir) for kind in args.backends.split(",")}
+    print_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,348 @@
+"""
+Local stand-ins for Azure OpenAI, Microsoft Entra ID and Microsoft Graph used by the benchmark harness.
+They implement just enough of each API for the backend to run end to end without network access.
+"""
+
+import asyncio
+import base64
+import datetime
+import ipaddress
+import json
+import time
+import uuid
+from collections import Counter, defaultdict, deque
+from dataclasses import dataclass, field
+
+from aiohttp import web
+
+QUERY_PROMPT_PREFIX = "Below is a history of previous conversations"
+
+
+@dataclass
+class FakeOpenAIConfig:
+    # Seconds before the first token (or the whole response when not streaming)
+    latency: float = 0.2
+    # Generated tokens per second after the first one
+    tokens_per_second: float = 200
+    # Tokens of an answer and of a generated search query
+    answer_tokens: int = 200
+    query_tokens: int = 4
+    # Requests per minute per deployment before answering 429 (0 = unlimited)
+    rpm: int = 0
+    # Latency of specific deployments (e.g. a smaller model's), the others use latency
+    deployment_latency: dict[str, float] = field(default_factory=dict)
+
+
+class FakeAzureOpenAI:
+    """
+    Chat completions for /openai/deployments/{deployment}/chat/completions, with SSE streaming.
+    Requests for the search query (recognized by the query prompt) get a short keyword answer.
+    """
+
+    def __init__(self, config: FakeOpenAIConfig):
+        self.config = config
+        self.calls: Counter[str] = Counter()
+        self.requests: defaultdict[str, deque[float]] = defaultdict(deque)
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_route("HEAD", "/", self.handle_ping)
+        app.router.add_post("/openai/deployments/{deployment}/chat/completions", self.handle_chat)
+        return app
+
+    async def handle_ping(self, request: web.Request) -> web.Response:
+        return web.Response()
+
+    def check_rate_limit(self, deployment: str) -> float:
+        # Sliding one-minute window, returns the seconds until the next request would be accepted
+        if not self.config.rpm:
+            return 0.0
+        now = time.monotonic()
+        window = self.requests[deployment]
+        while window and window[0] <= now - 60:
+            window.popleft()
+        if len(window) >= self.config.rpm:
+            return window[0] + 60 - now
+        window.append(now)
+        return 0.0
+
+    async def handle_chat(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        deployment = request.match_info["deployment"]
+        retry_after = self.check_rate_limit(deployment)
+        if retry_after:
+            self.calls[f"{deployment}:429"] += 1
+            return web.json_response(
+                {"error": {"code": "429", "message": "Requests to the deployment have exceeded the rate limit."}},
+                status=429,
+                headers={"retry-after": str(int(retry_after) + 1), "retry-after-ms": str(int(retry_after * 1000))},
+            )
+        messages = body["messages"]
+        is_query = messages[0]["content"].startswith(QUERY_PROMPT_PREFIX)
+        self.calls[f"{deployment}:{'query' if is_query else 'answer'}"] += 1
+
+        if is_query:
+            tokens = ["ヘルスプラン", " 有酸素運動", " 適用範囲", " 概要"][: self.config.query_tokens]
+        else:
+            tokens = [f" token{i}" for i in range(self.config.answer_tokens)]
+        prompt_tokens = sum(len(message["content"]) for message in messages) // 4
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+        interval = 1 / self.config.tokens_per_second
+        latency = self.config.deployment_latency.get(deployment, self.config.latency)
+
+        if not body.get("stream"):
+            await asyncio.sleep(latency + interval * (len(tokens) - 1))
+            return web.json_response(
+                {
+                    "id": completion_id,
+                    "object": "chat.completion",
+                    "created": created,
+                    "model": body.get("model", deployment),
+                    "choices": [
+                        {
+                            "index": 0,
+                            "finish_reason": "stop",
+                            "message": {"role": "assistant", "content": "".join(tokens).strip()},
+                        }
+                    ],
+                    "usage": {
+                        "prompt_tokens": prompt_tokens,
+                        "completion_tokens": len(tokens),
+                        "total_tokens": prompt_tokens + len(tokens),
+                    },
+                }
+            )
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        async def send(choices: list) -> None:
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": body.get("model", deployment),
+                "choices": choices,
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+
+        await asyncio.sleep(latency)
+        # Azure OpenAI sends a first chunk with empty choices (content filter results)
+        await send([])
+        await send([{"index": 0, "finish_reason": None, "delta": {"role": "assistant"}}])
+        for i, token in enumerate(tokens):
+            if i:
+                await asyncio.sleep(interval)
+            await send([{"index": 0, "finish_reason": None, "delta": {"content": token}}])
+        await send([{"index": 0, "finish_reason": "stop", "delta": {}}])
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+
+@dataclass
+class FakeGraphConfig:
+    # Seconds per search and per content request
+    search_latency: float = 0.15
+    content_latency: float = 0.05
+    token_latency: float = 0.05
+    # Hits returned per search (capped by the requested size)
+    hits: int = 10
+    # Characters of fetched document content
+    content_chars: int = 4000
+
+
+class FakeMicrosoftGraph:
+    """
+    Microsoft Entra ID token endpoint (with the OpenID configuration MSAL reads first) and the Graph
+    endpoints the backend calls: /search/query and list item fields / file content.
+    """
+
+    def __init__(self, config: FakeGraphConfig, tenant_id: str):
+        self.config = config
+        self.tenant_id = tenant_id
+        self.base_url = ""
+        self.calls: Counter[str] = Counter()
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/{tenant}/v2.0/.well-known/openid-configuration", self.handle_openid_configuration)
+        app.router.add_post("/{tenant}/oauth2/v2.0/token", self.handle_token)
+        app.router.add_route("HEAD", "/v1.0/", self.handle_ping)
+        app.router.add_post("/v1.0/search/query", self.handle_search)
+        app.router.add_get("/v1.0/sites/{site}/lists/{list}/items/{item}/fields", self.handle_fields)
+        app.router.add_get("/v1.0/sites/{site}/lists/{list}/items/{item}/driveItem/content", self.handle_content)
+        app.router.add_get("/v1.0/drives/{drive}/items/{item}/content", self.handle_content)
+        return app
+
+    async def handle_ping(self, request: web.Request) -> web.Response:
+        return web.Response()
+
+    async def handle_openid_configuration(self, request: web.Request) -> web.Response:
+        tenant = request.match_info["tenant"]
+        base = f"{self.base_url}/{tenant}"
+        return web.json_response(
+            {
+                "authorization_endpoint": f"{base}/oauth2/v2.0/authorize",
+                "token_endpoint": f"{base}/oauth2/v2.0/token",
+                "issuer": f"{base}/v2.0",
+            }
+        )
+
+    async def handle_token(self, request: web.Request) -> web.Response:
+        self.calls["token"] += 1
+        await request.post()
+        await asyncio.sleep(self.config.token_latency)
+        return web.json_response(
+            {"token_type": "Bearer", "access_token": f"graph-{uuid.uuid4().hex}", "expires_in": 3600}
+        )
+
+    async def handle_search(self, request: web.Request) -> web.Response:
+        self.calls["search"] += 1
+        body = await request.json()
+        search_request = body["requests"][0]
+        start = search_request.get("from") or 0
+        size = search_request.get("size") or 25
+        await asyncio.sleep(self.config.search_latency)
+        total = self.config.hits
+        query = search_request["query"]["queryString"]
+        entity_types = search_request.get("entityTypes") or ["listItem"]
+        self.calls["search:" + ",".join(entity_types)] += 1
+        if "message" in entity_types:
+            hits = [self.make_message_hit(i, query) for i in range(start, min(start + size, total))]
+        else:
+            # SharePoint types searched together: list items and their files interleaved, the same document twice
+            kinds = [kind for kind in ("listItem", "driveItem") if kind in entity_types] or ["listItem"]
+            hits = [
+                self.make_hit(i // len(kinds), query, kinds[i % len(kinds)])
+                for i in range(start, min(start + size, total))
+            ]
+        return web.json_response(
+            {
+                "value": [
+                    {
+                        "searchTerms": search_request["query"]["queryString"].split(),
+                        "hitsContainers": [
+                            {"hits": hits, "total": total, "moreResultsAvailable": start + size < total}
+                        ],
+                    }
+                ]
+            }
+        )
+
+    @staticmethod
+    def make_name(index: int) -> str:
+        # A third of the hits are text files (content download), a third Word documents (search summary) and
+        # a third items of a custom list (fields)
+        return [f"handbook-{index}.txt", f"policy-{index}.docx", f"notice-{index}"][index % 3]
+
+    def make_hit(self, index: int, query: str, kind: str = "listItem") -> dict:
+        name = self.make_name(index)
+        return {
+            "hitId": f"hit-{kind}-{index}",
+            "rank": index + 1,
+            "summary": f"<c0>{query}</c0> に関する社内規程 {index} の概要です。" * 3,
+            "resource": {
+                "@odata.type": f"#microsoft.graph.{kind}",
+                "id": f"{'item' if kind == 'listItem' else 'file'}-{index}",
+                "name": name,
+                "webUrl": f"https://contoso.sharepoint.com/sites/hr/Shared%20Documents/{name}",
+                "eTag": f'"{{{index:08d}-0000-0000-0000-000000000000}},1"',
+                "lastModifiedDateTime": "2024-04-01T09:00:00Z",
+                "parentReference": {"siteId": "site-1", "driveId": "drive-1"},
+                "sharepointIds": {"siteId": "site-1", "listId": "list-1", "listItemId": str(index + 1)},
+            },
+        }
+
+    def make_message_hit(self, index: int, query: str) -> dict:
+        return {
+            "hitId": f"hit-message-{index}",
+            "rank": index + 1,
+            "summary": f"<c0>{query}</c0> についての連絡 {index} です。" * 3,
+            "resource": {
+                "@odata.type": "#microsoft.graph.message",
+                "id": f"message-{index}",
+                "subject": f"RE: {query}",
+                "webLink": f"https://outlook.office365.com/owa/?ItemID=message-{index}",
+            },
+        }
+
+    def make_text(self, item: str) -> str:
+        sentence = f"これは文書 {item} の本文です。ヘルスプランと有酸素運動の適用範囲について説明します。"
+        return (sentence * (self.config.content_chars // len(sentence) + 1))[: self.config.content_chars]
+
+    async def handle_fields(self, request: web.Request) -> web.Response:
+        self.calls["fields"] += 1
+        await asyncio.sleep(self.config.content_latency)
+        item = request.match_info["item"]
+        name = self.make_name(int(item) - 1)
+        if "." not in name:
+            return web.json_response({"@odata.etag": '"1"', "Title": f"notice {item}", "Body": self.make_text(item)})
+        # Items of a document library only have the file's metadata columns
+        extension = name.rsplit(".", 1)[-1]
+        return web.json_response(
+            {
+                "@odata.etag": '"1"',
+                "FileLeafRef": name,
+                "Title": "",
+                "ContentType": "Document",
+                "DocIcon": extension,
+                "Modified": "2024-04-01T09:00:00Z",
+                "Created": "2024-03-01T09:00:00Z",
+                "_UIVersionString": "1.0",
+                "FileSizeDisplay": str(self.config.content_chars * 3),
+            }
+        )
+
+    async def handle_content(self, request: web.Request) -> web.Response:
+        self.calls["content"] += 1
+        await asyncio.sleep(self.config.content_latency)
+        return web.Response(body=self.make_text(request.match_info["item"]).encode("utf-8"), content_type="text/plain")
+
+
+def encode_segment(data: dict) -> str:
+    return base64.urlsafe_b64encode(json.dumps(data).encode()).decode().rstrip("=")
+
+
+def create_user_assertion(oid: str, tid: str, lifetime: int = 3600) -> str:
+    # An unsigned JWT, the backend only reads its claims and the fake token endpoint does not validate it
+    claims = {"oid": oid, "tid": tid, "aud": "api://benchmark", "exp": int(time.time()) + lifetime}
+    return f"{encode_segment({'alg': 'none', 'typ': 'JWT'})}.{encode_segment(claims)}."
+
+
+def create_self_signed_certificate(cert_path: str, key_path: str):
+    # MSAL only talks to https authorities, so the fake identity endpoint needs a certificate for 127.0.0.1
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from cryptography.x509.oid import NameOID
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "localhost")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(minutes=5))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .add_extension(
+            x509.SubjectAlternativeName(
+                [x509.DNSName("localhost"), x509.IPAddress(ipaddress.ip_address("127.0.0.1"))]
+            ),
+            critical=False,
+        )
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .sign(key, hashes.SHA256())
+    )
+    with open(cert_path, "wb") as f:
+        f.write(certificate.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, "wb") as f:
+        f.write(
+            key.private_bytes(
+                serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL, serialization.NoEncryption()
+            )
+        )
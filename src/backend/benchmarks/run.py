@@ -0,0 +1,493 @@
+"""
+End-to-end benchmark of the backend against local stand-ins for Azure OpenAI, Entra ID and Microsoft Graph.
+
+Run from src/backend:
+
+    python -m benchmarks.run --requests 200 --concurrency 20 --output results.json
+    python -m benchmarks.run --requests 200 --concurrency 20 --baseline results.json
+    python -m benchmarks.run --query-model gpt-4o-mini --query-openai-latency 0.08
+
+The app is started from create_app in a uvicorn subprocess, so the load generator and the fake servers
+do not share its event loop. Settings of the app can be changed with --env NAME=VALUE.
+tiktoken downloads its vocabulary on first use; set TIKTOKEN_CACHE_DIR to a directory that already holds it,
+or pass --env TIKTOKEN_VOCAB_DIR=<directory with cl100k_base.tiktoken>, to run without network access.
+
+The report ends with the model, mean latency, tokens and estimated cost of each model call (query_rewrite, answer).
+--query-model sends the query rewrite to its own deployment of that model, answered by the fake after
+--query-openai-latency; the prices are illustrative list prices per 1M tokens, override them with --price.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Optional
+
+import aiohttp
+from aiohttp import web
+
+from benchmarks.fakeservers import (
+    FakeAzureOpenAI,
+    FakeGraphConfig,
+    FakeMicrosoftGraph,
+    FakeOpenAIConfig,
+    create_self_signed_certificate,
+    create_user_assertion,
+)
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+TENANT_ID = "00000000-0000-0000-0000-000000000001"
+DEPLOYMENT = "chat"
+QUERY_DEPLOYMENT = "query"
+# Illustrative USD per 1M input and output tokens, see the Azure OpenAI pricing page for current ones
+PRICES = {
+    "gpt-35-turbo": (0.5, 1.5),
+    "gpt-35-turbo-16k": (3.0, 4.0),
+    "gpt-4": (30.0, 60.0),
+    "gpt-4-32k": (60.0, 120.0),
+    "gpt-4o": (2.5, 10.0),
+    "gpt-4o-mini": (0.15, 0.6),
+}
+QUESTIONS = [
+    "有給休暇の申請方法を教えてください",
+    "ヘルスプランの適用範囲は？",
+    "出張旅費の精算期限はいつまでですか",
+    "What does the Northwind Health Plus plan cover for eye exams?",
+    "リモートワーク規程の概要を教えて",
+    "育児休業は何か月まで取得できますか",
+]
+FOLLOW_UPS = ["それは派遣社員にも適用されますか？", "申請の締め切りは？", "Is there a deductible?"]
+
+
+@dataclass
+class RequestResult:
+    ok: bool
+    latency: float
+    ttft: Optional[float] = None
+    error: str = ""
+
+
+@dataclass
+class ModeSummary:
+    requests: int = 0
+    errors: int = 0
+    duration: float = 0.0
+    throughput: float = 0.0
+    latency: dict[str, float] = field(default_factory=dict)
+    ttft: dict[str, float] = field(default_factory=dict)
+    error_samples: list[str] = field(default_factory=list)
+
+
+def percentile(values: list[float], p: float) -> float:
+    # Nearest-rank percentile
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, min(len(ordered), round(p / 100 * len(ordered) + 0.5)))
+    return ordered[rank - 1]
+
+
+def describe(values: list[float]) -> dict[str, float]:
+    if not values:
+        return {}
+    return {
+        "mean": sum(values) / len(values),
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values),
+    }
+
+
+def summarize(results: list[RequestResult], duration: float) -> ModeSummary:
+    succeeded = [result for result in results if result.ok]
+    return ModeSummary(
+        requests=len(results),
+        errors=len(results) - len(succeeded),
+        duration=duration,
+        throughput=len(succeeded) / duration if duration else 0.0,
+        latency=describe([result.latency for result in succeeded]),
+        ttft=describe([result.ttft for result in succeeded if result.ttft is not None]),
+        error_samples=sorted({result.error for result in results if not result.ok})[:5],
+    )
+
+
+def make_messages(rng: random.Random, turns: int) -> list[dict[str, str]]:
+    messages = []
+    for _ in range(turns - 1):
+        messages.append({"role": "user", "content": rng.choice(QUESTIONS)})
+        messages.append({"role": "assistant", "content": "社内規程によると、申請はポータルから行います。[handbook-0.txt]"})
+    messages.append({"role": "user", "content": rng.choice(QUESTIONS if turns == 1 else FOLLOW_UPS)})
+    return messages
+
+
+async def send_chat(
+    session: aiohttp.ClientSession, url: str, assertion: str, messages: list[dict], stream: bool
+) -> RequestResult:
+    start = time.perf_counter()
+    ttft = None
+    try:
+        async with session.post(
+            url, json={"messages": messages, "stream": stream}, headers={"Authorization": f"Bearer {assertion}"}
+        ) as response:
+            if response.status != 200:
+                return RequestResult(False, time.perf_counter() - start, error=f"HTTP {response.status}")
+            if not stream:
+                body = await response.json()
+                if "error" in body:
+                    return RequestResult(False, time.perf_counter() - start, error=str(body["error"])[:200])
+                return RequestResult(True, time.perf_counter() - start)
+            async for line in response.content:
+                if not line.strip():
+                    continue
+                event = json.loads(line)
+                if "error" in event:
+                    return RequestResult(False, time.perf_counter() - start, error=str(event["error"])[:200])
+                if ttft is None and any((choice.get("delta") or {}).get("content") for choice in event.get("choices", [])):
+                    ttft = time.perf_counter() - start
+        return RequestResult(True, time.perf_counter() - start, ttft=ttft)
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        return RequestResult(False, time.perf_counter() - start, error=repr(e)[:200])
+
+
+async def send_batch(
+    session: aiohttp.ClientSession, url: str, assertion: str, conversations: list[list[dict]]
+) -> list[RequestResult]:
+    # The latency of an item is the time until its line arrives, the batch is sent once for all of them
+    start = time.perf_counter()
+    results: list[RequestResult] = []
+    try:
+        items = [{"id": str(i), "messages": messages} for i, messages in enumerate(conversations)]
+        async with session.post(url, json={"items": items}, headers={"Authorization": f"Bearer {assertion}"}) as response:
+            if response.status != 200:
+                return [RequestResult(False, time.perf_counter() - start, error=f"HTTP {response.status}")] * len(items)
+            async for line in response.content:
+                event = json.loads(line) if line.strip() else {}
+                if "index" not in event:
+                    continue
+                error = str(event.get("error", ""))[:200]
+                results.append(RequestResult(not error, time.perf_counter() - start, error=error))
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        results.append(RequestResult(False, time.perf_counter() - start, error=repr(e)[:200]))
+    missing = len(conversations) - len(results)
+    return results + [RequestResult(False, time.perf_counter() - start, error="no result for item")] * missing
+
+
+async def run_load(args, base_url: str, mode: str, seed: int) -> ModeSummary:
+    rng = random.Random(seed)
+    assertions = [create_user_assertion(f"user-{i:04d}", TENANT_ID) for i in range(args.users)]
+    workload = [(rng.choice(assertions), make_messages(rng, rng.randint(1, args.max_turns))) for _ in range(args.requests)]
+    queue: asyncio.Queue = asyncio.Queue()
+    for item in workload:
+        queue.put_nowait(item)
+    results: list[RequestResult] = []
+
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+
+        async def worker():
+            while not queue.empty():
+                assertion, messages = queue.get_nowait()
+                if mode != "batch":
+                    results.append(await send_chat(session, f"{base_url}/chat", assertion, messages, mode == "stream"))
+                    continue
+                # A batch is the user's next batch_size conversations, as a script evaluating questions would send
+                conversations = [messages]
+                while len(conversations) < args.batch_size and not queue.empty():
+                    conversations.append(queue.get_nowait()[1])
+                results.extend(await send_batch(session, f"{base_url}/chat/batch", assertion, conversations))
+
+        start = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(args.concurrency)])
+        duration = time.perf_counter() - start
+    return summarize(results, duration)
+
+
+async def start_site(app: web.Application, ssl_context: Optional[ssl.SSLContext] = None) -> tuple[web.AppRunner, int]:
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0, ssl_context=ssl_context)
+    await site.start()
+    return runner, site._server.sockets[0].getsockname()[1]  # type: ignore[union-attr]
+
+
+def get_free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def wait_until_ready(process: subprocess.Popen, base_url: str, timeout: float):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"The app exited with code {process.returncode} during startup")
+            try:
+                async with session.get(f"{base_url}/auth_setup") as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"The app did not start within {timeout} seconds")
+
+
+async def fetch_metrics(base_url: str) -> str:
+    # The app's /metrics, one worker's view when --workers > 1
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"{base_url}/metrics") as response:
+            if response.status != 200:
+                return ""
+            return await response.text()
+
+
+def parse_histogram(text: str, name: str) -> dict[tuple[str, ...], tuple[float, float]]:
+    # Sum and count of a histogram by its label values
+    sums: dict[tuple[str, ...], float] = {}
+    counts: dict[tuple[str, ...], float] = {}
+    for line in text.splitlines():
+        match = re.match(rf"{name}_(sum|count){{(.*)}} (\S+)$", line)
+        if match:
+            labels = tuple(re.findall(r'="([^"]*)"', match.group(2)))
+            (sums if match.group(1) == "sum" else counts)[labels] = float(match.group(3))
+    return {labels: (sums[labels], counts.get(labels, 0.0)) for labels in sums}
+
+
+def get_stage_means(text: str) -> dict[str, float]:
+    # Mean duration per stage
+    stages = parse_histogram(text, "chat_stage_duration_seconds")
+    return {stage: total / count for (stage,), (total, count) in stages.items() if count}
+
+
+def get_model_calls(text: str, args) -> dict[str, dict]:
+    # Model, calls, mean tokens and estimated cost of each model call of the pipeline
+    tokens = parse_histogram(text, "chat_tokens")
+    models = {"query_rewrite": args.query_model or args.model, "answer": args.model}
+    prices = {**PRICES, **dict(parse_price(value) for value in args.price)}
+    calls = {}
+    for call, model in models.items():
+        prompt_sum, count = tokens.get((call, "prompt"), (0.0, 0.0))
+        completion_sum, _ = tokens.get((call, "completion"), (0.0, 0.0))
+        if not count:
+            continue
+        summary = {
+            "model": model,
+            "calls": int(count),
+            "prompt_tokens": prompt_sum / count,
+            "completion_tokens": completion_sum / count,
+            "cost_per_1k_calls": None,
+        }
+        if model in prices:
+            input_price, output_price = prices[model]
+            summary["cost_per_1k_calls"] = (
+                summary["prompt_tokens"] * input_price + summary["completion_tokens"] * output_price
+            ) / 1000
+        calls[call] = summary
+    return calls
+
+
+def parse_price(value: str) -> tuple[str, tuple[float, float]]:
+    # MODEL=INPUT,OUTPUT in USD per 1M tokens
+    model, _, prices = value.partition("=")
+    input_price, _, output_price = prices.partition(",")
+    return model, (float(input_price), float(output_price))
+
+
+def build_app_env(args, openai_url: str, graph_url: str, cert_path: str, work_dir: str) -> dict[str, str]:
+    env = dict(os.environ)
+    env.update(
+        {
+            "OPENAI_HOST": "azure",
+            "AZURE_OPENAI_ENDPOINT": openai_url,
+            "AZURE_OPENAI_KEY": "benchmark",
+            "AZURE_OPENAI_CHATGPT_DEPLOYMENT": DEPLOYMENT,
+            "AZURE_OPENAI_CHATGPT_MODEL": args.model,
+            "AZURE_USE_AUTHENTICATION": "true",
+            "AZURE_SERVER_APP_ID": "benchmark-server",
+            "AZURE_SERVER_APP_SECRET": "benchmark-secret",
+            "AZURE_CLIENT_APP_ID": "benchmark-client",
+            "AZURE_TENANT_ID": TENANT_ID,
+            "AZURE_AUTHORITY_HOST": graph_url,
+            "GRAPH_ENDPOINT": graph_url,
+            "TOKEN_CACHE_PATH": os.path.join(work_dir, "token_cache.bin"),
+            # The report reads the stage timings and model calls from /metrics
+            "METRICS_ENABLED": "true",
+            # MSAL (requests) and the Graph client (httpx) have to trust the fake's self-signed certificate
+            "REQUESTS_CA_BUNDLE": cert_path,
+            "SSL_CERT_FILE": cert_path,
+        }
+    )
+    if args.deployments > 1:
+        env["AZURE_OPENAI_DEPLOYMENTS"] = json.dumps(
+            [{"endpoint": openai_url, "deployment": f"{DEPLOYMENT}-{i}", "rpm": args.openai_rpm} for i in range(args.deployments)]
+        )
+    if args.query_model:
+        env["AZURE_OPENAI_QUERY_MODEL"] = args.query_model
+        env["AZURE_OPENAI_QUERY_DEPLOYMENT"] = QUERY_DEPLOYMENT
+    for item in args.env:
+        name, _, value = item.partition("=")
+        env[name] = value
+    return env
+
+
+async def run_benchmark(args) -> dict:
+    openai_fake = FakeAzureOpenAI(
+        FakeOpenAIConfig(
+            latency=args.openai_latency,
+            tokens_per_second=args.openai_tokens_per_second,
+            answer_tokens=args.answer_tokens,
+            rpm=args.openai_rpm,
+            deployment_latency=(
+                {QUERY_DEPLOYMENT: args.query_openai_latency} if args.query_openai_latency is not None else {}
+            ),
+        )
+    )
+    graph_fake = FakeMicrosoftGraph(
+        FakeGraphConfig(search_latency=args.graph_latency, content_latency=args.graph_latency / 3, hits=args.hits),
+        TENANT_ID,
+    )
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        cert_path = os.path.join(work_dir, "cert.pem")
+        key_path = os.path.join(work_dir, "key.pem")
+        create_self_signed_certificate(cert_path, key_path)
+        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_context.load_cert_chain(cert_path, key_path)
+
+        openai_runner, openai_port = await start_site(openai_fake.create_app())
+        graph_runner, graph_port = await start_site(graph_fake.create_app(), ssl_context)
+        graph_url = f"https://127.0.0.1:{graph_port}"
+        graph_fake.base_url = graph_url
+
+        port = get_free_port()
+        base_url = f"http://127.0.0.1:{port}"
+        command = [sys.executable, "-m", "uvicorn", "app:create_app", "--factory"]
+        command += ["--host", "127.0.0.1", "--port", str(port), "--workers", str(args.workers), "--log-level", "warning"]
+        env = build_app_env(args, f"http://127.0.0.1:{openai_port}", graph_url, cert_path, work_dir)
+        process = subprocess.Popen(command, cwd=BACKEND_DIR, env=env)
+        try:
+            await wait_until_ready(process, base_url, args.startup_timeout)
+            modes = ["stream", "nostream"] if args.mode == "both" else [args.mode]
+            results = {}
+            for i, mode in enumerate(modes):
+                if args.warmup:
+                    await run_load(argparse.Namespace(**{**vars(args), "requests": args.warmup}), base_url, mode, -1)
+                results[mode] = asdict(await run_load(args, base_url, mode, args.seed + i))
+            metrics = await fetch_metrics(base_url)
+        finally:
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+            await openai_runner.cleanup()
+            await graph_runner.cleanup()
+
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "config": {name: value for name, value in vars(args).items() if name not in ("output", "baseline")},
+        "results": results,
+        "stage_means": get_stage_means(metrics),
+        "model_calls": get_model_calls(metrics, args),
+        "upstream_calls": {**dict(openai_fake.calls), **dict(graph_fake.calls)},
+    }
+
+
+def print_report(report: dict, baseline: Optional[dict] = None):
+    for mode, summary in report["results"].items():
+        base = (baseline or {}).get("results", {}).get(mode)
+        print(f"\n[{mode}] {summary['requests']} requests, {summary['errors']} errors, {summary['duration']:.2f}s")
+        if base:
+            print(f"  {'':<22}{'current':>10}{'baseline':>10}{'change':>9}")
+        rows = [("throughput (req/s)", summary["throughput"], base["throughput"] if base else None)]
+        for metric in ("latency", "ttft"):
+            for name, value in summary[metric].items():
+                rows.append((f"{metric} {name} (ms)", value * 1000, base[metric].get(name, 0) * 1000 if base else None))
+        for label, value, base_value in rows:
+            line = f"  {label:<22}{value:>10.1f}"
+            if base_value:
+                line += f"{base_value:>10.1f}{(value - base_value) / base_value:>+9.1%}"
+            print(line)
+        for error in summary["error_samples"]:
+            print(f"  error: {error}")
+    if report.get("stage_means"):
+        print("\nmean stage duration (ms, all modes incl. warmup):")
+        for stage, seconds in report["stage_means"].items():
+            print(f"  {stage:<22}{seconds * 1000:>10.1f}")
+    if report.get("model_calls"):
+        print("\nmodel calls (all modes incl. warmup, cost in USD from illustrative prices):")
+        print(f"  {'call':<16}{'model':<18}{'calls':>7}{'mean (ms)':>11}{'prompt':>9}{'compl.':>8}{'$/1k calls':>12}")
+        for call, summary in report["model_calls"].items():
+            # Streamed answers are measured as answer_stream
+            stage_means = report.get("stage_means", {})
+            mean = stage_means.get(call, stage_means.get(f"{call}_stream", 0.0))
+            cost = summary["cost_per_1k_calls"]
+            print(
+                f"  {call:<16}{summary['model']:<18}{summary['calls']:>7}{mean * 1000:>11.1f}"
+                f"{summary['prompt_tokens']:>9.0f}{summary['completion_tokens']:>8.0f}"
+                + (f"{cost:>12.4f}" if cost is not None else f"{'-':>12}")
+            )
+    print(f"\nupstream calls: {json.dumps(report['upstream_calls'], ensure_ascii=False)}")
+
+
+def parse_args(argv: Optional[list[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=["stream", "nostream", "both", "batch"], default="both")
+    parser.add_argument("--requests", type=int, default=100, help="Requests per mode")
+    parser.add_argument("--concurrency", type=int, default=10, help="Concurrent requests (batches in batch mode)")
+    parser.add_argument("--batch-size", type=int, default=20, help="Conversations per /chat/batch request")
+    parser.add_argument("--warmup", type=int, default=10, help="Unmeasured requests sent before each mode")
+    parser.add_argument("--users", type=int, default=20, help="Distinct signed-in users the requests come from")
+    parser.add_argument("--max-turns", type=int, default=3, help="Maximum user turns in a conversation")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes")
+    parser.add_argument("--timeout", type=float, default=120, help="Per-request timeout in seconds")
+    parser.add_argument("--startup-timeout", type=float, default=60)
+    parser.add_argument("--model", default="gpt-35-turbo", help="Model of the answer (AZURE_OPENAI_CHATGPT_MODEL)")
+    parser.add_argument("--query-model", help="Model of the query rewrite, on its own deployment (default: --model)")
+    parser.add_argument("--openai-latency", type=float, default=0.2, help="Seconds to the first token")
+    parser.add_argument(
+        "--query-openai-latency", type=float, help="Seconds to the first token of the query rewrite deployment"
+    )
+    parser.add_argument(
+        "--price", action="append", default=[], metavar="MODEL=IN,OUT", help="USD per 1M input and output tokens"
+    )
+    parser.add_argument("--openai-tokens-per-second", type=float, default=200)
+    parser.add_argument("--answer-tokens", type=int, default=200)
+    parser.add_argument("--openai-rpm", type=int, default=0, help="Requests per minute per deployment before 429")
+    parser.add_argument("--deployments", type=int, default=1, help="Azure OpenAI deployments in the pool")
+    parser.add_argument("--graph-latency", type=float, default=0.15, help="Seconds per search request")
+    parser.add_argument("--hits", type=int, default=10, help="Search hits available per query")
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE", help="Extra app setting")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", help="Compare with the results in this JSON file")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[list[str]] = None):
+    args = parse_args(argv)
+    report = asyncio.run(run_benchmark(args))
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+import asyncio
+import math
+import time
+from collections import Counter, OrderedDict, deque
+
+from core.metrics import STAGE_DURATION_BUCKETS, MetricsRegistry
+
+# Weight of the latest request in the moving average of how long a request holds its slot
+SERVICE_TIME_SMOOTHING = 0.2
+
+
+class AdmissionRejected(Exception):
+    # The request was not admitted; status_code is 429 (the user is over their share) or 503 (the worker is saturated)
+    def __init__(self, message: str, status_code: int, retry_after: float):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class AdmissionTicket:
+    # A slot held by an admitted request, released exactly once however the request ends
+    def __init__(self, controller: "AdmissionController"):
+        self.controller = controller
+        self.admitted = time.monotonic()
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.controller.release(time.monotonic() - self.admitted)
+
+
+class AdmissionController:
+    """
+    Limits the chat requests a worker processes at once. Requests over max_in_flight wait in a bounded queue,
+    one queue per user served round-robin, so a user sending many requests at once only delays their own.
+    A request is rejected right away with 503 when the queue is full and with 429 when its user already has
+    max_queue_per_user requests waiting; one that waits longer than queue_timeout is rejected with 503.
+    Rejections carry a Retry-After estimated from the recent time requests hold their slot.
+    """
+
+    def __init__(
+        self,
+        max_in_flight: int,
+        max_queue: int,
+        queue_timeout: float,
+        max_queue_per_user: int,
+        registry: MetricsRegistry,
+    ):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.max_queue_per_user = max_queue_per_user
+        self.in_flight = 0
+        self.queued = 0
+        # Waiting requests per user, in the order the users get their next turn
+        self._queues: OrderedDict[str, deque[asyncio.Future]] = OrderedDict()
+        self.service_time = 1.0
+        self.rejected: Counter[str] = Counter()
+        self.wait_time = registry.histogram(
+            "chat_admission_wait_seconds", "Time chat requests waited for a slot", STAGE_DURATION_BUCKETS
+        )
+        registry.callback(
+            "chat_admission_in_flight", "Chat requests being processed", "gauge", (), lambda: {(): self.in_flight}
+        )
+        registry.callback(
+            "chat_admission_queue_depth", "Chat requests waiting for a slot", "gauge", (), lambda: {(): self.queued}
+        )
+        registry.callback(
+            "chat_admission_rejected_total",
+            "Chat requests rejected by reason",
+            "counter",
+            ("reason",),
+            lambda: {(reason,): count for reason, count in self.rejected.items()},
+        )
+
+    def get_retry_after(self) -> float:
+        # Time for the slots to turn over enough to serve everybody waiting now
+        return max(1.0, math.ceil(self.service_time * (self.queued + 1) / self.max_in_flight))
+
+    def reject(self, reason: str, message: str, status_code: int):
+        self.rejected[reason] += 1
+        raise AdmissionRejected(message, status_code, self.get_retry_after())
+
+    async def acquire(self, user_id: str) -> AdmissionTicket:
+        if self.in_flight < self.max_in_flight and not self.queued:
+            self.in_flight += 1
+            self.wait_time.observe(0.0)
+            return AdmissionTicket(self)
+        if self.queued >= self.max_queue:
+            self.reject("queue_full", "The server is busy, please retry later", 503)
+        user_queue = self._queues.get(user_id)
+        if user_queue is not None and len(user_queue) >= self.max_queue_per_user:
+            self.reject("user_queue_full", "Too many concurrent requests, please retry later", 429)
+
+        future = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(user_id, deque()).append(future)
+        self.queued += 1
+        start = time.monotonic()
+        try:
+            # wait() leaves the future alone on timeout, so a slot handed over at the last moment isn't lost
+            await asyncio.wait((future,), timeout=self.queue_timeout)
+        except asyncio.CancelledError:
+            if future.done():
+                self.release_unused()
+            else:
+                self.remove(user_id, future)
+            raise
+        if not future.done():
+            self.remove(user_id, future)
+            self.reject("timeout", "The server is busy, please retry later", 503)
+        self.wait_time.observe(time.monotonic() - start)
+        return AdmissionTicket(self)
+
+    def remove(self, user_id: str, future: asyncio.Future):
+        future.cancel()
+        user_queue = self._queues[user_id]
+        user_queue.remove(future)
+        if not user_queue:
+            del self._queues[user_id]
+        self.queued -= 1
+
+    def release(self, held: float):
+        self.service_time += SERVICE_TIME_SMOOTHING * (held - self.service_time)
+        self.release_unused()
+
+    def release_unused(self):
+        self.in_flight -= 1
+        self.dispatch()
+
+    def dispatch(self):
+        while self.in_flight < self.max_in_flight and self._queues:
+            user_id, user_queue = next(iter(self._queues.items()))
+            future = user_queue.popleft()
+            if user_queue:
+                # Round-robin: the user's next request waits until every other waiting user had a turn
+                self._queues.move_to_end(user_id)
+            else:
+                del self._queues[user_id]
+            self.queued -= 1
+            self.in_flight += 1
+            future.set_result(None)
+
@@ -1,17 +1,29 @@
 # Refactored from https://github.com/Azure-Samples/ms-identity-python-on-behalf-of
 
+import asyncio
+import base64
+import hashlib
+import json
 import logging
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from tempfile import TemporaryDirectory
 from typing import Any, Optional
+from urllib.parse import urlparse
 
+from azure.core.credentials import AccessToken
+from azure.identity.aio import OnBehalfOfCredential
 from msal import ConfidentialClientApplication
+from msal.authority import WELL_KNOWN_AUTHORITY_HOSTS
 from msal_extensions import (
     FilePersistence,
     PersistedTokenCache,
     build_encrypted_persistence,
 )
 
+from core.cache import CacheBackend
+
 
 # AuthError is raised when the authentication token sent by the client UI cannot be parsed or there is an authentication error accessing the graph API
 class AuthError(Exception):
@@ -22,6 +34,9 @@ class AuthError(Exception):
 
 class AuthenticationHelper:
     scope: str = "https://graph.microsoft.com/.default"
+    # Exchanged tokens are kept in token_cache until this many seconds before they expire, so a cached token
+    # is still good for a while after it is handed out
+    TOKEN_CACHE_MARGIN = 600
 
     def __init__(
         self,
@@ -31,13 +46,25 @@ class AuthenticationHelper:
         client_app_id: Optional[str],
         tenant_id: Optional[str],
         token_cache_path: Optional[str] = None,
+        msal_thread_pool_size: int = 4,
+        authority_host: str = "https://login.microsoftonline.com",
+        token_cache: Optional[CacheBackend] = None,
     ):
         self.use_authentication = use_authentication
         self.server_app_id = server_app_id
         self.server_app_secret = server_app_secret
         self.client_app_id = client_app_id
         self.tenant_id = tenant_id
-        self.authority = f"https://login.microsoftonline.com/{tenant_id}"
+        self.authority_host = authority_host
+        self.authority = f"{authority_host.rstrip('/')}/{tenant_id}"
+        # On-Behalf-Of tokens by user assertion and scopes; a backend shared by the workers shares the exchanges too
+        self.token_cache = token_cache
+        # Number of On-Behalf-Of tokens served from token_cache vs. exchanged with Microsoft Entra ID
+        self.obo_cache_hits = 0
+        self.obo_cache_misses = 0
+        self.confidential_client: Optional[ConfidentialClientApplication] = None
+        # MSAL is synchronous (HTTP calls and file locking on the persisted cache), so it runs on its own threads
+        self.msal_executor = ThreadPoolExecutor(max_workers=msal_thread_pool_size, thread_name_prefix="msal")
 
         if self.use_authentication:
             self.token_cache_path = token_cache_path
@@ -54,6 +81,8 @@ class AuthenticationHelper:
                 authority=self.authority,
                 client_credential=server_app_secret,
                 token_cache=PersistedTokenCache(persistence),
+                # Instance discovery only knows the public and sovereign clouds
+                instance_discovery=urlparse(authority_host).hostname in WELL_KNOWN_AUTHORITY_HOSTS,
             )
 
     def get_auth_setup_for_client(self) -> dict[str, Any]:
@@ -109,4 +138,117 @@ class AuthenticationHelper:
             raise AuthError({"code": "invalid_header", "description": "Authorization header must be Bearer token"}, 401)
 
         token = parts[1]
-        return token
\ No newline at end of file
+        return token
+
+    def create_obo_credential(self, user_assertion: str):
+        # Returns an async token credential for Graph clients acting on behalf of the signed-in user
+        if self.confidential_client is None:
+            return OnBehalfOfCredential(
+                tenant_id=self.tenant_id,
+                authority=self.authority_host,
+                client_id=self.server_app_id,
+                client_secret=self.server_app_secret,
+                user_assertion=user_assertion,
+            )
+        return MsalOnBehalfOfCredential(self, user_assertion)
+
+    @staticmethod
+    def make_token_cache_key(user_assertion: str, scopes: list[str]) -> str:
+        # MSAL's acquire_token_on_behalf_of always calls Microsoft Entra ID, it never reads its token cache,
+        # so exchanged tokens are cached here by the exact assertion (never by its unvalidated claims)
+        payload = json.dumps([AuthenticationHelper.get_cache_scope(user_assertion), sorted(scopes)])
+        return "obo:" + hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    async def acquire_token_on_behalf_of(self, user_assertion: str, scopes: list[str]) -> dict[str, Any]:
+        if self.confidential_client is None:
+            raise AuthError({"code": "authentication_disabled", "description": "Authentication is not enabled"}, 401)
+        cache_key = None
+        if self.token_cache is not None:
+            cache_key = self.make_token_cache_key(user_assertion, scopes)
+            cached = await self.token_cache.get(cache_key)
+            if cached is not None:
+                self.obo_cache_hits += 1
+                return {"access_token": cached["access_token"], "expires_in": int(cached["expires_on"] - time.time())}
+        self.obo_cache_misses += 1
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(
+            self.msal_executor, self.confidential_client.acquire_token_on_behalf_of, user_assertion, scopes
+        )
+        if "access_token" not in result:
+            raise AuthError(
+                {"code": result.get("error", "obo_failed"), "description": result.get("error_description", "")}, 401
+            )
+        expires_in = int(result.get("expires_in", 0))
+        if cache_key is not None and expires_in > self.TOKEN_CACHE_MARGIN:
+            await self.token_cache.set(
+                cache_key,
+                {"access_token": result["access_token"], "expires_on": time.time() + expires_in},
+                expires_in - self.TOKEN_CACHE_MARGIN,
+            )
+        return result
+
+    def get_obo_cache_stats(self) -> dict[str, int]:
+        return {"hits": self.obo_cache_hits, "misses": self.obo_cache_misses}
+
+    async def close(self):
+        self.msal_executor.shutdown(wait=False)
+        if self.token_cache is not None:
+            await self.token_cache.close()
+
+    @staticmethod
+    def get_cache_scope(token: str) -> str:
+        # Scopes per-user caches to the exact assertion. Its claims are not validated here, so a cache keyed by them
+        # would hand one user's permission-trimmed results to anyone presenting a forged token with their oid.
+        return "assertion:" + hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def get_token_claims(token: str) -> dict[str, Any]:
+        # Reads the claims of a JWT without validating it. Only use the result for cache bookkeeping,
+        # the token itself is validated by Microsoft Entra ID during the On-Behalf-Of exchange.
+        try:
+            payload = token.split(".")[1]
+            payload += "=" * (-len(payload) % 4)
+            return json.loads(base64.urlsafe_b64decode(payload))
+        except (IndexError, ValueError):
+            return {}
+
+
+class MsalOnBehalfOfCredential:
+    """
+    Async token credential (the azure.core protocol used by the Graph SDK) that exchanges the user assertion
+    through AuthenticationHelper, i.e. through its token cache and the MSAL confidential client.
+    """
+
+    # Refresh the in-memory token this many seconds before it expires
+    REFRESH_MARGIN = 300
+
+    def __init__(self, auth_helper: AuthenticationHelper, user_assertion: str):
+        self.auth_helper = auth_helper
+        self.user_assertion = user_assertion
+        self._tokens: dict[tuple[str, ...], AccessToken] = {}
+        # Concurrent Graph requests of one user (e.g. a search per entity type) wait for a single exchange
+        self._lock = asyncio.Lock()
+
+    async def get_token(self, *scopes: str, **kwargs: Any) -> AccessToken:
+        token = self._tokens.get(scopes)
+        if token is not None and token.expires_on > time.time() + self.REFRESH_MARGIN:
+            return token
+        async with self._lock:
+            token = self._tokens.get(scopes)
+            if token is not None and token.expires_on > time.time() + self.REFRESH_MARGIN:
+                return token
+            result = await self.auth_helper.acquire_token_on_behalf_of(self.user_assertion, list(scopes))
+            token = AccessToken(result["access_token"], int(time.time()) + int(result.get("expires_in", 0)))
+            self._tokens[scopes] = token
+            return token
+
+    async def close(self):
+        # Kiota closes async credentials after every token request, so the memoized tokens are kept;
+        # they are dropped together with the credential when GraphClientCache evicts it.
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
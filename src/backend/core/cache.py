@@ -0,0 +1,188 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Optional
+
+
+class CacheBackend(ABC):
+    """
+    Async key/value store with per-entry TTL used by the backend caches.
+    Values must be JSON serializable so that every backend can store them.
+    """
+
+    @abstractmethod
+    async def get(self, key: str) -> Optional[Any]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def set(self, key: str, value: Any, ttl: float):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class MemoryCache(CacheBackend):
+    # In-process LRU, private to the worker
+
+    def __init__(self, max_size: int = 1024):
+        self.max_size = max_size
+        self._entries: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+
+    async def get(self, key: str) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at <= time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: Any, ttl: float):
+        self._entries[key] = (time.time() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SqliteCache(CacheBackend):
+    """
+    LRU stored in a local sqlite file, so every gunicorn worker on the node shares the same entries.
+    sqlite calls are blocking, they run on the default thread pool. The file is memory-mapped and in WAL mode,
+    so workers read concurrently; a worker that can't get the write lock within busy_timeout treats the call
+    as a miss (or skips the write) instead of failing the request.
+    Eviction runs every max_size / 100 writes of a worker, the file can briefly hold more than max_size entries.
+    """
+
+    # Reads move an entry up the LRU at most once per this many seconds, so most reads don't write
+    ACCESS_RESOLUTION = 1.0
+
+    def __init__(self, path: str, max_size: int = 10000, busy_timeout: float = 1.0, mmap_size: int = 64 * 1024 * 1024):
+        self.path = path
+        self.max_size = max_size
+        self.evict_interval = max(1, max_size // 100)
+        self._writes = 0
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection = sqlite3.connect(path, timeout=busy_timeout, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(f"PRAGMA mmap_size={int(mmap_size)}")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, expires_at REAL, accessed_at REAL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at)")
+
+    async def get(self, key: str) -> Optional[Any]:
+        entry = await self.get_entry(key)
+        return entry[0] if entry is not None else None
+
+    async def get_entry(self, key: str) -> Optional[tuple[Any, float]]:
+        # Value and expiry time of the entry
+        return await asyncio.to_thread(self._get, key)
+
+    async def set(self, key: str, value: Any, ttl: float):
+        await asyncio.to_thread(self._set, key, json.dumps(value, ensure_ascii=False), ttl)
+
+    async def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def _get(self, key: str) -> Optional[tuple[Any, float]]:
+        now = time.time()
+        with self._lock:
+            try:
+                row = self._connection.execute(
+                    "SELECT value, expires_at, accessed_at FROM cache WHERE key = ?", (key,)
+                ).fetchone()
+                if row is None:
+                    return None
+                if row[1] <= now:
+                    self._connection.execute("DELETE FROM cache WHERE key = ?", (key,))
+                    return None
+                if now - row[2] >= self.ACCESS_RESOLUTION:
+                    self._connection.execute("UPDATE cache SET accessed_at = ? WHERE key = ?", (now, key))
+            except sqlite3.OperationalError:
+                # Another worker holds the write lock
+                logging.warning("Cache %s is busy, treating %s as a miss", self.path, key, exc_info=True)
+                return None
+        return json.loads(row[0]), row[1]
+
+    def _set(self, key: str, value: str, ttl: float):
+        now = time.time()
+        with self._lock:
+            try:
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                    (key, value, now + ttl, now),
+                )
+                self._writes += 1
+                if self._writes % self.evict_interval == 0:
+                    self._evict(now)
+            except sqlite3.OperationalError:
+                logging.warning("Cache %s is busy, not storing %s", self.path, key, exc_info=True)
+
+    def _evict(self, now: float):
+        self._connection.execute("DELETE FROM cache WHERE expires_at <= ?", (now,))
+        self._connection.execute(
+            "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_size,),
+        )
+
+
+class TieredCache(CacheBackend):
+    """
+    Per-worker MemoryCache in front of a SqliteCache: hot entries are read from the worker's memory, and an entry
+    stored by one worker is found by the others in the shared file. Local copies expire with the shared entry.
+    """
+
+    def __init__(self, shared: SqliteCache, local_size: int = 1024):
+        self.shared = shared
+        self.local = MemoryCache(max_size=local_size)
+
+    async def get(self, key: str) -> Optional[Any]:
+        value = await self.local.get(key)
+        if value is not None:
+            return value
+        entry = await self.shared.get_entry(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        await self.local.set(key, value, expires_at - time.time())
+        return value
+
+    async def set(self, key: str, value: Any, ttl: float):
+        await self.local.set(key, value, ttl)
+        await self.shared.set(key, value, ttl)
+
+    async def close(self):
+        await self.shared.close()
+
+
+def create_cache_backend(kind: str, max_size: int, path: Optional[str] = None) -> Optional[CacheBackend]:
+    # kind is one of "memory", "sqlite", "tiered" or "none"
+    kind = kind.lower()
+    if kind == "none":
+        return None
+    if kind == "memory":
+        return MemoryCache(max_size=max_size)
+    if kind in ("sqlite", "tiered"):
+        if not path:
+            raise ValueError(f"A cache path is required for the {kind} cache backend")
+        if kind == "sqlite":
+            return SqliteCache(path, max_size=max_size)
+        return TieredCache(SqliteCache(path, max_size=max_size), local_size=max_size)
+    raise ValueError(f"Unknown cache backend: {kind}")
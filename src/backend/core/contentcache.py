@@ -0,0 +1,114 @@
+import asyncio
+import hashlib
+import logging
+import mmap
+import os
+import tempfile
+import time
+from typing import Any, Optional
+
+
+class ContentCache:
+    """
+    Extracted text of documents in a local directory, shared by the workers of a node and by users.
+    Entries are keyed by the resource and its version (the eTag or last modification time reported in the search
+    hit), so an unchanged document is never downloaded again and a changed one misses and is fetched anew.
+    The cache is only looked up for hits of the user's own search, which Microsoft Search trims to what the user
+    can access, so sharing the text doesn't widen access.
+    Entries are plain UTF-8 files read through mmap. Once the directory holds more than max_bytes, the least
+    recently read entries are removed; file writes are atomic, so concurrent workers never read a partial entry.
+    """
+
+    # Reads move an entry up the LRU (its mtime) at most once per this many seconds
+    ACCESS_RESOLUTION = 60.0
+    # The directory is scanned for eviction after a worker wrote this share of max_bytes
+    EVICTION_SCAN_RATIO = 0.1
+
+    def __init__(self, directory: str, max_bytes: int = 512 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._written = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def get_path(self, resource_key: str, version: str) -> str:
+        # Older versions of a document are never read again, they age out through the LRU
+        key_hash = hashlib.sha256(f"{resource_key}\n{version}".encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, f"{key_hash}.txt")
+
+    async def get(self, resource_key: str, version: str) -> Optional[str]:
+        text = await asyncio.to_thread(self._read, self.get_path(resource_key, version))
+        if text is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return text
+
+    async def set(self, resource_key: str, version: str, text: str):
+        await asyncio.to_thread(self._write, self.get_path(resource_key, version), text)
+
+    def get_stats(self) -> dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def _read(self, path: str) -> Optional[str]:
+        try:
+            with open(path, "rb") as f:
+                stat = os.fstat(f.fileno())
+                if stat.st_size == 0:
+                    return None
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    text = str(data, "utf-8")
+            if time.time() - stat.st_mtime >= self.ACCESS_RESOLUTION:
+                os.utime(path)
+            return text
+        except FileNotFoundError:
+            # Not cached, or evicted by another worker in the meantime
+            return None
+
+    def _write(self, path: str, text: str):
+        data = text.encode("utf-8")
+        descriptor, temporary_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(descriptor, "wb") as f:
+                f.write(data)
+            os.replace(temporary_path, path)
+        except OSError:
+            logging.warning("Failed to store content in %s", path, exc_info=True)
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            return
+        self._written += len(data)
+        if self._written >= self.max_bytes * self.EVICTION_SCAN_RATIO:
+            self._written = 0
+            self._evict()
+
+    def _evict(self):
+        entries = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".txt"):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
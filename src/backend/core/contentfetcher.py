@@ -0,0 +1,108 @@
+import asyncio
+import html
+import logging
+import re
+from typing import TYPE_CHECKING, Optional
+
+from core.contentcache import ContentCache
+from core.graphsearch import SearchHit
+
+if TYPE_CHECKING:
+    from msgraph import GraphServiceClient
+
+# Files whose bytes can be used as text without a document parser
+TEXT_EXTENSIONS = {".txt", ".md", ".csv", ".tsv", ".json", ".xml", ".html", ".htm"}
+HTML_EXTENSIONS = {".html", ".htm"}
+HTML_TAGS = re.compile(r"<(script|style)[^>]*>.*?</\1>|<[^>]+>", re.DOTALL | re.IGNORECASE)
+WHITESPACE_RUNS = re.compile(r"[ \t\r\f\v]+")
+
+
+class ContentFetcher:
+    """
+    Fetches the text of search hits from Microsoft Graph with the caller's client, so the same permissions
+    as the search apply. List items without a file contribute their column values, and text-like files their body.
+    Other files (e.g. .pdf or .docx in a document library) and hits whose content cannot be fetched or extracted
+    fall back to the search summary.
+    With a content cache, the text of a hit whose version (eTag) is already cached is not fetched again.
+    """
+
+    def __init__(
+        self, max_concurrency: int = 4, max_content_chars: int = 100_000, content_cache: Optional[ContentCache] = None
+    ):
+        self.max_concurrency = max_concurrency
+        self.max_content_chars = max_content_chars
+        self.content_cache = content_cache
+
+    async def fetch_all(self, client: "GraphServiceClient", hits: list[SearchHit]) -> list[str]:
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def fetch_with_limit(hit: SearchHit) -> str:
+            async with semaphore:
+                return await self.fetch(client, hit)
+
+        return await asyncio.gather(*[fetch_with_limit(hit) for hit in hits])
+
+    async def fetch(self, client: "GraphServiceClient", hit: SearchHit) -> str:
+        # The hit comes from the user's own search, so the user may read a cached copy of its content
+        use_cache = self.content_cache is not None and bool(hit.version)
+        if use_cache:
+            text = await self.content_cache.get(self.get_resource_key(hit), hit.version)
+            if text is not None:
+                return text
+        try:
+            text = await self.fetch_text(client, hit)
+        except Exception:
+            logging.warning("Failed to fetch content of %s, using the search summary", hit.web_url, exc_info=True)
+            text = ""
+        if not text:
+            return hit.summary
+        text = text[: self.max_content_chars]
+        if use_cache:
+            await self.content_cache.set(self.get_resource_key(hit), hit.version, text)
+        return text
+
+    async def fetch_text(self, client: "GraphServiceClient", hit: SearchHit) -> str:
+        extension = self.get_extension(hit)
+        if hit.resource_type == "listItem" and hit.site_id and hit.list_id:
+            item = client.sites.by_site_id(hit.site_id).lists.by_list_id(hit.list_id).items.by_list_item_id(hit.item_id)
+            if extension in TEXT_EXTENSIONS:
+                return self.decode(await item.drive_item.content.get(), extension)
+            if extension:
+                # The fields of a document library item are file metadata (FileLeafRef, DocIcon, ...), not content
+                return ""
+            fields = await item.fields.get()
+            return self.fields_to_text(fields.additional_data if fields else {})
+        if hit.resource_type == "driveItem" and hit.drive_id and extension in TEXT_EXTENSIONS:
+            content = await client.drives.by_drive_id(hit.drive_id).items.by_drive_item_id(hit.item_id).content.get()
+            return self.decode(content, extension)
+        return ""
+
+    def get_resource_key(self, hit: SearchHit) -> str:
+        # Where the content is read from, and how much of it is kept
+        return "\n".join(
+            [hit.resource_type, hit.site_id, hit.list_id, hit.drive_id, hit.item_id, str(self.max_content_chars)]
+        )
+
+    @staticmethod
+    def get_extension(hit: SearchHit) -> str:
+        name = hit.name or hit.web_url
+        return "." + name.rsplit(".", 1)[-1].lower() if "." in name else ""
+
+    @staticmethod
+    def decode(content: bytes, extension: str) -> str:
+        if not content:
+            return ""
+        text = content.decode("utf-8-sig", errors="replace")
+        if extension in HTML_EXTENSIONS:
+            text = html.unescape(HTML_TAGS.sub(" ", text))
+        return WHITESPACE_RUNS.sub(" ", text).strip()
+
+    @staticmethod
+    def fields_to_text(fields: dict) -> str:
+        # Column values, without OData annotations and SharePoint system columns (which start with "_" or "@")
+        lines = []
+        for key, value in fields.items():
+            if key.startswith(("@", "_", "odata")) or not isinstance(value, str) or not value.strip():
+                continue
+            lines.append(f"{key}: {value.strip()}")
+        return "\n".join(lines)
@@ -0,0 +1,73 @@
+import hashlib
+import json
+import secrets
+from typing import Any
+
+from core.cache import CacheBackend
+
+
+class ConversationNotFound(Exception):
+    # Only the new messages were posted but the stored conversation is gone (expired, evicted or out of date)
+    pass
+
+
+class ConversationStore:
+    """
+    Server-side history of the conversations, so clients can post only their new messages (a delta) along with
+    the session_state of the last answer. Messages are kept NFC-normalized with their token counts, so a turn
+    only tokenizes what is new. Entries expire idle_timeout after their last turn and keep the last
+    max_messages messages; the backend bounds how many conversations are kept.
+    session_state is {"conversation_id", "turn"}: turn counts the messages of the conversation, so a delta
+    posted against a stored conversation that is behind or ahead of the client (an aborted answer, an entry
+    another worker updated) is refused with ConversationNotFound and the client posts the full history again.
+    Entries are scoped to the user assertion like the search results, another user's lookup of the same id misses;
+    after a token renewal the client posts the full history once and continues from the new session_state.
+    """
+
+    def __init__(self, backend: CacheBackend, idle_timeout: float = 1800, max_messages: int = 100):
+        self.backend = backend
+        self.idle_timeout = idle_timeout
+        self.max_messages = max_messages
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(user_id: str, conversation_id: str) -> str:
+        payload = json.dumps([user_id, conversation_id], ensure_ascii=False, separators=(",", ":"))
+        return "conversation:" + hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def new_session_state(turn: int) -> dict[str, Any]:
+        return {"conversation_id": secrets.token_urlsafe(16), "turn": turn}
+
+    async def load(self, user_id: str, session_state: Any) -> tuple[list[dict[str, str]], list[int]]:
+        # Returns the stored messages and their token counts, or raises ConversationNotFound
+        if not isinstance(session_state, dict) or not isinstance(session_state.get("conversation_id"), str):
+            raise ConversationNotFound("session_state does not refer to a stored conversation")
+        record = await self.backend.get(self.make_key(user_id, session_state["conversation_id"]))
+        if record is None or record["turn"] != session_state.get("turn"):
+            self.misses += 1
+            raise ConversationNotFound("The conversation is not stored anymore, post the full history")
+        self.hits += 1
+        return record["messages"], record["token_counts"]
+
+    async def save(
+        self, user_id: str, session_state: dict[str, Any], messages: list[dict[str, str]], token_counts: list[int]
+    ):
+        record = {
+            "turn": session_state["turn"],
+            "messages": messages[-self.max_messages :],
+            "token_counts": token_counts[-self.max_messages :],
+        }
+        await self.backend.set(self.make_key(user_id, session_state["conversation_id"]), record, self.idle_timeout)
+
+    def get_stats(self) -> dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    async def close(self):
+        await self.backend.close()
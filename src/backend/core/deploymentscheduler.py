@@ -0,0 +1,260 @@
+import asyncio
+import json
+import logging
+import time
+from dataclasses import dataclass
+from typing import Any, Optional
+from urllib.parse import urlparse
+
+import openai
+
+# Azure OpenAI evaluates TPM/RPM over short windows, so a bucket holds this many seconds of its per-minute quota
+BURST_SECONDS = 10
+# Cooldown of a deployment after a 429 without retry-after, and after a server or connection error
+DEFAULT_RETRY_AFTER = 1.0
+ERROR_COOLDOWN = 5.0
+
+
+class RateLimitExceeded(Exception):
+    # No deployment can take the call within the wait budget; retry_after is a hint for the client
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+@dataclass
+class Deployment:
+    name: str
+    endpoint: str
+    api_key: Optional[str] = None
+    # Quota of the deployment, 0 means unknown: only 429 responses limit it
+    tpm: int = 0
+    rpm: int = 0
+
+    @property
+    def label(self) -> str:
+        # The same deployment name can exist on several resources
+        return f"{urlparse(self.endpoint).hostname}/{self.name}"
+
+
+def parse_deployments(value: str) -> list[Deployment]:
+    """
+    Parses a JSON list of deployments, e.g.
+    [{"endpoint": "https://aoai-east.openai.azure.com", "deployment": "chat", "tpm": 120000, "rpm": 720}, ...]
+    "key" is optional, deployments without one use the app's Azure OpenAI credential.
+    """
+    return [
+        Deployment(
+            name=item["deployment"],
+            endpoint=item["endpoint"].rstrip("/"),
+            api_key=item.get("key"),
+            tpm=int(item.get("tpm", 0)),
+            rpm=int(item.get("rpm", 0)),
+        )
+        for item in json.loads(value)
+    ]
+
+
+class TokenBucket:
+    """
+    Per-minute quota as a bucket refilled continuously, holding at most BURST_SECONDS worth of it.
+    A full bucket always admits, so a single call larger than the burst is delayed but not refused forever.
+    """
+
+    def __init__(self, per_minute: int):
+        self.per_minute = per_minute
+        self.rate = per_minute / 60
+        self.capacity = per_minute * BURST_SECONDS / 60
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    @property
+    def unlimited(self) -> bool:
+        return self.per_minute <= 0
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def can_consume(self, amount: float, now: float) -> bool:
+        if self.unlimited:
+            return True
+        self.refill(now)
+        return self.tokens >= min(amount, self.capacity)
+
+    def consume(self, amount: float, now: float):
+        if not self.unlimited:
+            self.refill(now)
+            self.tokens -= amount
+
+    def time_until(self, amount: float, now: float) -> float:
+        if self.unlimited:
+            return 0.0
+        self.refill(now)
+        return max(0.0, (min(amount, self.capacity) - self.tokens) / self.rate)
+
+    def headroom(self, now: float) -> float:
+        if self.unlimited:
+            return 1.0
+        self.refill(now)
+        return max(self.tokens, 0.0) / self.capacity
+
+
+class DeploymentState:
+    def __init__(self, deployment: Deployment):
+        self.deployment = deployment
+        self.token_bucket = TokenBucket(deployment.tpm)
+        self.request_bucket = TokenBucket(deployment.rpm)
+        self.cooldown_until = 0.0
+        self.in_flight = 0
+        self.throttled = 0
+        self.failed = 0
+
+    def ready_in(self, tokens: int, now: float) -> float:
+        return max(
+            self.cooldown_until - now,
+            self.token_bucket.time_until(tokens, now),
+            self.request_bucket.time_until(1, now),
+        )
+
+
+class DeploymentScheduler:
+    """
+    Spreads chat completion calls over a pool of Azure OpenAI deployments.
+    Each deployment has token buckets for its TPM and RPM quota, charged with the prompt tokens plus max_tokens
+    of every call (which is how Azure OpenAI accounts a request against TPM when it is admitted). A call goes to
+    the deployment with the most token headroom and the fewest calls in flight. A 429 puts the deployment on
+    hold for its retry-after and the call fails over to another one; server and connection errors do the same
+    with a short cooldown. When nothing is available within max_wait seconds, RateLimitExceeded is raised.
+    """
+
+    def __init__(
+        self,
+        deployments: list[Deployment],
+        api_version: str = "2023-07-01-preview",
+        max_wait: float = 10,
+        max_attempts: Optional[int] = None,
+    ):
+        if not deployments:
+            raise ValueError("At least one deployment is required")
+        self.states = [DeploymentState(deployment) for deployment in deployments]
+        self.api_version = api_version
+        self.max_wait = max_wait
+        self.max_attempts = max_attempts or 2 * len(deployments) + 1
+
+    def select(self, tokens: int, now: float) -> Optional[DeploymentState]:
+        candidates = [
+            state
+            for state in self.states
+            if state.cooldown_until <= now
+            and state.token_bucket.can_consume(tokens, now)
+            and state.request_bucket.can_consume(1, now)
+        ]
+        if not candidates:
+            return None
+        return max(candidates, key=lambda state: (state.token_bucket.headroom(now), -state.in_flight))
+
+    async def acquire(self, tokens: int, deadline: float) -> DeploymentState:
+        while True:
+            now = time.monotonic()
+            state = self.select(tokens, now)
+            if state is not None:
+                state.token_bucket.consume(tokens, now)
+                state.request_bucket.consume(1, now)
+                state.in_flight += 1
+                return state
+            wait = min(state.ready_in(tokens, now) for state in self.states)
+            if now + wait > deadline:
+                raise RateLimitExceeded("All Azure OpenAI deployments are at their rate limit", retry_after=wait)
+            # Yield at least briefly so waiting callers don't spin when several wake up for the same capacity
+            await asyncio.sleep(max(wait, 0.01))
+
+    def release(self, state: DeploymentState):
+        state.in_flight -= 1
+
+    def hold(self, state: DeploymentState, seconds: float):
+        state.cooldown_until = max(state.cooldown_until, time.monotonic() + seconds)
+
+    @staticmethod
+    def get_retry_after(error: openai.error.OpenAIError) -> float:
+        headers = {key.lower(): value for key, value in (error.headers or {}).items()}
+        try:
+            if "retry-after-ms" in headers:
+                return float(headers["retry-after-ms"]) / 1000
+            if "retry-after" in headers:
+                return float(headers["retry-after"])
+        except ValueError:
+            pass
+        return DEFAULT_RETRY_AFTER
+
+    def get_call_args(self, state: DeploymentState) -> dict[str, Any]:
+        deployment = state.deployment
+        # Without a key of its own, the deployment uses the process-wide credential (key or refreshed AAD token)
+        return {
+            "deployment_id": deployment.name,
+            "api_base": deployment.endpoint,
+            "api_type": "azure" if deployment.api_key else openai.api_type,
+            "api_key": deployment.api_key or openai.api_key,
+            "api_version": self.api_version,
+        }
+
+    async def create(self, prompt_tokens: int, **kwargs: Any) -> Any:
+        """
+        Calls openai.ChatCompletion.acreate on a deployment of the pool. kwargs are the usual acreate arguments
+        without deployment_id; max_tokens is counted towards the TPM budget together with prompt_tokens.
+        """
+        tokens = prompt_tokens + kwargs.get("max_tokens", 0)
+        deadline = time.monotonic() + self.max_wait
+        last_error: Optional[Exception] = None
+        for _ in range(self.max_attempts):
+            state = await self.acquire(tokens, deadline)
+            try:
+                return await openai.ChatCompletion.acreate(**self.get_call_args(state), **kwargs)
+            except openai.error.RateLimitError as e:
+                state.throttled += 1
+                retry_after = self.get_retry_after(e)
+                logging.warning("Deployment %s is throttled for %.1fs", state.deployment.label, retry_after)
+                self.hold(state, retry_after)
+                last_error = e
+            except (
+                openai.error.APIConnectionError,
+                openai.error.ServiceUnavailableError,
+                openai.error.Timeout,
+                openai.error.TryAgain,
+            ) as e:
+                self.fail_over(state, e)
+                last_error = e
+            except openai.error.APIError as e:
+                if e.http_status is not None and e.http_status < 500:
+                    raise
+                self.fail_over(state, e)
+                last_error = e
+            finally:
+                # Streamed calls count as in flight until the response starts, their tokens stay in the buckets
+                self.release(state)
+
+        if not isinstance(last_error, openai.error.RateLimitError):
+            raise last_error  # type: ignore[misc]
+        now = time.monotonic()
+        retry_after = min(state.ready_in(tokens, now) for state in self.states)
+        raise RateLimitExceeded(
+            f"Azure OpenAI is throttled on every deployment: {last_error}",
+            retry_after=max(retry_after, DEFAULT_RETRY_AFTER),
+        )
+
+    def fail_over(self, state: DeploymentState, error: Exception):
+        state.failed += 1
+        logging.warning("Deployment %s failed, failing over: %s", state.deployment.label, error)
+        self.hold(state, ERROR_COOLDOWN)
+
+    def get_stats(self) -> dict[str, dict[str, float]]:
+        now = time.monotonic()
+        return {
+            state.deployment.label: {
+                "in_flight": state.in_flight,
+                "throttled": state.throttled,
+                "failed": state.failed,
+                "token_headroom": state.token_bucket.headroom(now),
+            }
+            for state in self.states
+        }
@@ -1,15 +1,133 @@
-from msgraph import GraphServiceClient
-from azure.identity.aio import OnBehalfOfCredential
-from quart import current_app
 import asyncio
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, Optional
 
+import httpx
 
-class GraphClientBuilder: 
-    def get_client(self, obo_token: str, scopes=['https://graph.microsoft.com/.default']):
-        credential = OnBehalfOfCredential(
-            tenant_id=current_app.config["TENANT_ID"] ,
-            client_id=current_app.config["CLIENT_ID"],
-            client_secret=current_app.config["APP_SECRET"],
-            user_assertion=obo_token)
-        graph_client = GraphServiceClient(credential, scopes)
-        return graph_client
+from core.authentication import AuthenticationHelper
+
+if TYPE_CHECKING:
+    from msgraph import GraphServiceClient
+
+GRAPH_SCOPES = ["https://graph.microsoft.com/.default"]
+
+
+def import_graph_sdk():
+    # The Graph SDK takes a noticeable share of the worker startup, so it is imported when the first client
+    # is created, or ahead of the first request by calling this during startup
+    import msgraph  # noqa: F401
+    from kiota_authentication_azure import azure_identity_authentication_provider  # noqa: F401
+    from msgraph.generated.models import entity_type, search_query, search_request  # noqa: F401
+    from msgraph.generated.search.query import query_post_request_body  # noqa: F401
+
+
+@dataclass
+class CachedGraphClient:
+    client: "GraphServiceClient"
+    credential: Any
+    expires_on: float
+
+
+class GraphClientCache:
+    """
+    Keeps one Graph client (and its On-Behalf-Of credential) per user assertion so the token exchange
+    and the HTTP connections are reused across requests. Credentials come from AuthenticationHelper,
+    which performs the exchange through the MSAL persisted token cache.
+    Entries are keyed by a hash of the user assertion, expire together with the assertion, and the least
+    recently used entry is closed when the cache grows beyond max_size.
+    When http_client is given, every Graph client sends its requests through that shared connection pool.
+    """
+
+    # Used when the assertion has no readable "exp" claim
+    DEFAULT_TTL = 300
+    # Stop handing out a client shortly before the assertion expires
+    EXPIRY_MARGIN = 60
+
+    def __init__(
+        self,
+        auth_helper: AuthenticationHelper,
+        max_size: int = 256,
+        scopes: list[str] = GRAPH_SCOPES,
+        http_client: Optional[httpx.AsyncClient] = None,
+        graph_endpoint: str = "https://graph.microsoft.com",
+    ):
+        self.auth_helper = auth_helper
+        self.max_size = max_size
+        self.scopes = scopes
+        self.http_client = http_client
+        self.graph_endpoint = graph_endpoint.rstrip("/")
+        self._entries: OrderedDict[str, CachedGraphClient] = OrderedDict()
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def cache_key(obo_token: str) -> str:
+        return hashlib.sha256(obo_token.encode("utf-8")).hexdigest()
+
+    def get_expiry(self, obo_token: str) -> float:
+        expires_on = AuthenticationHelper.get_token_claims(obo_token).get("exp")
+        if not isinstance(expires_on, (int, float)):
+            return time.time() + self.DEFAULT_TTL
+        return expires_on - self.EXPIRY_MARGIN
+
+    async def get_client(self, obo_token: str) -> "GraphServiceClient":
+        key = self.cache_key(obo_token)
+        evicted: list[CachedGraphClient] = []
+        async with self._lock:
+            now = time.time()
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires_on <= now:
+                evicted.append(self._entries.pop(key))
+                entry = None
+            if entry is None:
+                # Entries of users who stopped sending requests would otherwise hold their credential until
+                # they are the least recently used, sweep them whenever a client is created
+                expired = [cached_key for cached_key, cached in self._entries.items() if cached.expires_on <= now]
+                evicted.extend(self._entries.pop(cached_key) for cached_key in expired)
+                credential = self.auth_helper.create_obo_credential(obo_token)
+                entry = CachedGraphClient(
+                    client=self.create_graph_client(credential),
+                    credential=credential,
+                    expires_on=self.get_expiry(obo_token),
+                )
+                self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                evicted.append(self._entries.popitem(last=False)[1])
+        for stale in evicted:
+            await self.close_entry(stale)
+        return entry.client
+
+    def create_graph_client(self, credential) -> "GraphServiceClient":
+        from kiota_authentication_azure.azure_identity_authentication_provider import (
+            AzureIdentityAuthenticationProvider,
+        )
+        from msgraph import GraphRequestAdapter, GraphServiceClient
+
+        auth_provider = AzureIdentityAuthenticationProvider(credential, scopes=self.scopes)
+        if self.http_client is None:
+            request_adapter = GraphRequestAdapter(auth_provider)
+        else:
+            request_adapter = GraphRequestAdapter(auth_provider, client=self.http_client)
+        request_adapter.base_url = f"{self.graph_endpoint}/v1.0"
+        return GraphServiceClient(request_adapter=request_adapter)
+
+    async def close_entry(self, entry: CachedGraphClient):
+        try:
+            # Only the credential belongs to the entry, the HTTP client is shared by all Graph clients
+            await entry.credential.close()
+        except Exception:
+            logging.exception("Failed to close evicted Graph client")
+
+    async def close(self):
+        async with self._lock:
+            evicted = list(self._entries.values())
+            self._entries.clear()
+        for stale in evicted:
+            await self.close_entry(stale)
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -0,0 +1,290 @@
+import asyncio
+import hashlib
+import json
+import logging
+from dataclasses import asdict, dataclass
+from typing import TYPE_CHECKING, Any, AsyncGenerator, Callable, Optional
+
+from core.cache import CacheBackend
+
+if TYPE_CHECKING:
+    from msgraph import GraphServiceClient
+
+# Entity types Microsoft Search accepts together in one request; any other type is searched on its own.
+# Types are the Graph entityType values, the SDK enum is only imported when a request is built.
+COMBINABLE_ENTITY_TYPES = [
+    {"driveItem", "listItem", "list", "site", "drive"},
+    {"message", "chatMessage"},
+]
+
+
+@dataclass
+class SearchHit:
+    # The fields of a Graph search hit used to build the prompt and the citations
+    id: str
+    web_url: str
+    hit_id: str
+    name: str
+    summary: str
+    # Where the resource lives, used to fetch its content ("listItem", "driveItem", ...)
+    resource_type: str = ""
+    site_id: str = ""
+    list_id: str = ""
+    drive_id: str = ""
+    item_id: str = ""
+    # eTag (or last modification time) of the resource, identifies its content in the content cache
+    version: str = ""
+
+    @classmethod
+    def from_graph_hit(cls, hit) -> "SearchHit":
+        resource = hit.resource
+        # Messages have a web_link and a subject instead of a web_url and a name
+        web_url = getattr(resource, "web_url", None) or getattr(resource, "web_link", None) or ""
+        name = (
+            getattr(resource, "name", None)
+            or getattr(resource, "subject", None)
+            or getattr(resource, "display_name", None)
+        )
+        parent_reference = getattr(resource, "parent_reference", None)
+        sharepoint_ids = getattr(resource, "sharepoint_ids", None)
+        last_modified = getattr(resource, "last_modified_date_time", None)
+        return cls(
+            id=resource.id,
+            web_url=web_url,
+            hit_id=hit.hit_id,
+            name=name or web_url.split("/")[-1],
+            summary=hit.summary or "",
+            resource_type=(resource.odata_type or "").rsplit(".", 1)[-1],
+            site_id=(sharepoint_ids and sharepoint_ids.site_id) or (parent_reference and parent_reference.site_id) or "",
+            list_id=(sharepoint_ids and sharepoint_ids.list_id) or "",
+            drive_id=(parent_reference and parent_reference.drive_id) or "",
+            item_id=(sharepoint_ids and sharepoint_ids.list_item_id) or resource.id,
+            version=getattr(resource, "e_tag", None) or (last_modified.isoformat() if last_modified else ""),
+        )
+
+    def to_citation(self) -> dict[str, str]:
+        return {"id": self.id, "web_url": self.web_url, "hit_id": self.hit_id, "name": self.name}
+
+
+class SearchResultCache:
+    """
+    Short-lived cache of search hits. Microsoft Search trims results by the caller's permissions,
+    so every entry is scoped to a single user assertion (AuthenticationHelper.get_cache_scope)
+    and is never shared with another one.
+    """
+
+    def __init__(self, backend: CacheBackend, ttl: float = 60):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(scope: str, entity_types: list[str], query_string: str, size: int) -> str:
+        payload = json.dumps(
+            [scope, sorted(entity_types), query_string, size],
+            ensure_ascii=False,
+            separators=(",", ":"),
+        )
+        return "search:" + hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    async def get(self, key: str) -> Optional[list[SearchHit]]:
+        records = await self.backend.get(key)
+        if records is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return [SearchHit(**record) for record in records]
+
+    async def set(self, key: str, hits: list[SearchHit]):
+        await self.backend.set(key, [asdict(hit) for hit in hits], self.ttl)
+
+    def get_stats(self) -> dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    async def close(self):
+        await self.backend.close()
+
+
+def group_entity_types(entity_types: list[str]) -> list[list[str]]:
+    # One group per Microsoft Search request, in the order the types were configured
+    groups: list[list[str]] = []
+    for entity_type in entity_types:
+        for group in groups:
+            if any(entity_type in combinable and group[0] in combinable for combinable in COMBINABLE_ENTITY_TYPES):
+                group.append(entity_type)
+                break
+        else:
+            groups.append([entity_type])
+    return groups
+
+
+class GraphSearch:
+    """
+    Runs Microsoft Search queries through the Graph SDK and returns compact SearchHit records.
+    Results are paged lazily (from/size, page_size hits per request), so a caller that has enough hits
+    stops before the next page is requested.
+    """
+
+    def __init__(self, result_cache: Optional[SearchResultCache] = None, page_size: int = 25):
+        self.result_cache = result_cache
+        self.page_size = page_size
+
+    async def iter_pages(
+        self,
+        client: "GraphServiceClient",
+        query_string: str,
+        entity_types: list[str],
+        max_hits: int,
+    ) -> AsyncGenerator[list[SearchHit], None]:
+        # Pages of one Microsoft Search request. Each page is converted to SearchHit records right away,
+        # so the SDK models of a response are not kept while the caller works through its hits.
+        from msgraph.generated.models.entity_type import EntityType
+        from msgraph.generated.models.search_query import SearchQuery
+        from msgraph.generated.models.search_request import SearchRequest
+        from msgraph.generated.search.query.query_post_request_body import QueryPostRequestBody
+
+        offset = 0
+        while offset < max_hits:
+            request_body = QueryPostRequestBody(
+                requests=[
+                    SearchRequest(
+                        entity_types=[EntityType(entity_type) for entity_type in entity_types],
+                        query=SearchQuery(query_string=query_string),
+                        from_=offset,
+                        size=min(self.page_size, max_hits - offset),
+                    )
+                ]
+            )
+            search_result = await client.search.query.post(body=request_body)
+            containers = (search_result.value[0].hits_containers or []) if search_result and search_result.value else []
+            page = [SearchHit.from_graph_hit(hit) for container in containers for hit in container.hits or []]
+            more_results = any(container.more_results_available for container in containers)
+            del search_result, containers
+            if not page:
+                return
+            yield page
+            offset += len(page)
+            if not more_results:
+                return
+
+    async def iter_all(
+        self,
+        client: "GraphServiceClient",
+        query_string: str,
+        entity_types: list[str],
+        max_hits: int,
+        timeout: Optional[float] = None,
+        failed_groups: Optional[list[str]] = None,
+    ) -> AsyncGenerator[SearchHit, None]:
+        """
+        Hits of several entity types: one request per group of types Microsoft Search accepts together,
+        paged side by side. Every round requests the next page of each group concurrently and interleaves
+        them by rank, dropping hits already seen by resource id or URL (e.g. a file found both as a list item
+        and as a drive item). A group whose request fails, or whose pages take longer than timeout seconds
+        in total, is left out and its name appended to failed_groups; if every group fails before anything
+        was found, the first error is raised.
+        """
+        groups = {
+            ",".join(group): self.iter_pages(client, query_string, group, max_hits)
+            for group in group_entity_types(entity_types)
+        }
+        live = dict(groups)
+        loop = asyncio.get_running_loop()
+        # Seconds each group has spent waiting for its own pages, not for the other groups of a round
+        spent = dict.fromkeys(groups, 0.0)
+
+        async def next_page(name: str, pages: AsyncGenerator[list[SearchHit], None]) -> list[SearchHit]:
+            started = loop.time()
+            try:
+                return await asyncio.wait_for(
+                    pages.__anext__(), None if timeout is None else max(timeout - spent[name], 0)
+                )
+            finally:
+                spent[name] += loop.time() - started
+
+        seen: set[str] = set()
+        yielded = 0
+        succeeded = False
+        first_error: Optional[BaseException] = None
+        try:
+            while live:
+                results = await asyncio.gather(
+                    *[next_page(name, pages) for name, pages in live.items()], return_exceptions=True
+                )
+                round_pages = []
+                for name, result in zip(list(live), results):
+                    if isinstance(result, list):
+                        succeeded = True
+                        round_pages.append(result)
+                        continue
+                    del live[name]
+                    if isinstance(result, StopAsyncIteration):
+                        succeeded = True
+                    elif isinstance(result, asyncio.CancelledError):
+                        raise result
+                    else:
+                        logging.warning("Search of %s failed, answering without it: %r", name, result)
+                        first_error = first_error or result
+                        if failed_groups is not None:
+                            failed_groups.append(name)
+
+                for rank in range(max((len(page) for page in round_pages), default=0)):
+                    for page in round_pages:
+                        if rank >= len(page):
+                            continue
+                        hit = page[rank]
+                        if hit.id in seen or (hit.web_url and hit.web_url in seen):
+                            continue
+                        seen.update(key for key in (hit.id, hit.web_url) if key)
+                        yield hit
+                        yielded += 1
+                        if yielded >= max_hits:
+                            return
+            if not succeeded and first_error is not None:
+                raise first_error
+        finally:
+            for pages in groups.values():
+                await pages.aclose()
+
+    async def search(
+        self,
+        client: "GraphServiceClient",
+        scope: str,
+        query_string: str,
+        entity_types: list[str] = ["listItem"],
+        size: int = 1,
+        timeout: Optional[float] = None,
+        is_enough: Optional[Callable[[list[SearchHit]], bool]] = None,
+    ) -> list[SearchHit]:
+        """
+        Collects up to size hits of iter_all, stopping early once is_enough(hits) is true,
+        e.g. when the hits already fill the prompt's budget for sources.
+        """
+        cache_key = None
+        if self.result_cache is not None:
+            cache_key = self.result_cache.make_key(scope, entity_types, query_string, size)
+            cached_hits = await self.result_cache.get(cache_key)
+            if cached_hits is not None:
+                return cached_hits
+
+        hits: list[SearchHit] = []
+        failed_groups: list[str] = []
+        results = self.iter_all(client, query_string, entity_types, size, timeout, failed_groups)
+        try:
+            async for hit in results:
+                hits.append(hit)
+                if len(hits) >= size or (is_enough is not None and is_enough(hits)):
+                    break
+        finally:
+            await results.aclose()
+
+        # Hits missing a group that failed or timed out, and empty ones, are not cached: the next search tries again
+        if cache_key is not None and hits and not failed_groups:
+            await self.result_cache.set(cache_key, hits)
+        return hits
@@ -0,0 +1,77 @@
+import asyncio
+import logging
+from typing import Optional
+
+import aiohttp
+import httpx
+from msgraph_core import GraphClientFactory
+
+
+class HttpClientPool:
+    """
+    Owns the HTTP connection pools of a worker process: one aiohttp session used by the OpenAI SDK and
+    one httpx client used by the Microsoft Graph SDK. Both are created once in setup_clients and closed
+    when the app stops serving, so requests reuse warm keep-alive connections instead of opening new ones.
+    """
+
+    def __init__(
+        self,
+        limit: int = 100,
+        limit_per_host: int = 0,
+        keepalive_timeout: float = 30,
+        dns_cache_ttl: int = 300,
+        request_timeout: float = 120,
+    ):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.request_timeout = request_timeout
+        self.openai_session: Optional[aiohttp.ClientSession] = None
+        self.graph_http_client: Optional[httpx.AsyncClient] = None
+
+    async def open(self):
+        connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            keepalive_timeout=self.keepalive_timeout,
+            ttl_dns_cache=self.dns_cache_ttl,
+        )
+        self.openai_session = aiohttp.ClientSession(connector=connector)
+        self.graph_http_client = GraphClientFactory.create_with_default_middleware(
+            client=httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=self.limit,
+                    max_keepalive_connections=self.limit,
+                    keepalive_expiry=self.keepalive_timeout,
+                ),
+                timeout=httpx.Timeout(self.request_timeout),
+            )
+        )
+
+    async def prewarm(self, openai_urls: list[str], graph_urls: list[str]):
+        # Any response (even 401/404) means the DNS lookup, TCP connection and TLS handshake are done
+        # and the connection is parked in the pool for the first real request.
+        async def warm_openai(url: str):
+            async with self.openai_session.head(url, allow_redirects=False) as response:
+                await response.read()
+
+        async def warm_graph(url: str):
+            await self.graph_http_client.head(url)
+
+        results = await asyncio.gather(
+            *[warm_openai(url) for url in openai_urls],
+            *[warm_graph(url) for url in graph_urls],
+            return_exceptions=True,
+        )
+        for url, result in zip(openai_urls + graph_urls, results):
+            if isinstance(result, Exception):
+                logging.warning("Failed to pre-warm connection to %s: %s", url, result)
+
+    async def close(self):
+        if self.openai_session is not None:
+            await self.openai_session.close()
+            self.openai_session = None
+        if self.graph_http_client is not None:
+            await self.graph_http_client.aclose()
+            self.graph_http_client = None
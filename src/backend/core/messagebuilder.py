@@ -1,4 +1,5 @@
 import unicodedata
+from typing import Optional
 
 from .modelhelper import num_tokens_from_messages
 
@@ -13,17 +14,36 @@ class MessageBuilder:
     Methods:
         __init__(self, system_content: str, chatgpt_model: str): Initializes the MessageBuilder instance.
         append_message(self, role: str, content: str, index: int = 1): Appends a new message to the conversation.
+    Token counts that are already known (e.g. precomputed for fixed prompts) can be passed in to skip tokenizing.
     """
 
-    def __init__(self, system_content: str, chatgpt_model: str):
+    def __init__(self, system_content: str, chatgpt_model: str, system_token_count: Optional[int] = None):
         self.messages = [{"role": "system", "content": self.normalize_content(system_content)}]
         self.model = chatgpt_model
+        if system_token_count is None:
+            system_token_count = self.count_tokens_for_message(self.messages[0])
+        self.token_count = system_token_count
 
-    def append_message(self, role: str, content: str, index: int = 1):
-        self.messages.insert(index, {"role": role, "content": self.normalize_content(content)})
+    def append_message(self, role: str, content: str, index: int = 1, token_count: Optional[int] = None):
+        message = {"role": role, "content": self.normalize_content(content)}
+        if token_count is None:
+            token_count = self.count_tokens_for_message(message)
+        self.messages.insert(index, message)
+        self.token_count += token_count
+
+    def insert_messages(self, messages: list[dict[str, str]], token_counts: list[int], index: int = 1):
+        # Inserts already normalized messages in a single slice assignment
+        self.messages[index:index] = messages
+        self.token_count += sum(token_counts)
+
+    def set_message_content(self, index: int, content: str):
+        old_token_count = self.count_tokens_for_message(self.messages[index])
+        self.messages[index] = {"role": self.messages[index]["role"], "content": self.normalize_content(content)}
+        self.token_count += self.count_tokens_for_message(self.messages[index]) - old_token_count
 
     def count_tokens_for_message(self, message: dict[str, str]):
         return num_tokens_from_messages(message, self.model)
 
-    def normalize_content(self, content: str):
+    @staticmethod
+    def normalize_content(content: str):
         return unicodedata.normalize("NFC", content)
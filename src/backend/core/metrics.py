@@ -0,0 +1,163 @@
+import math
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Iterator, Optional, Sequence
+
+from opentelemetry import trace
+
+# Seconds, from a cached Graph search to a long streamed answer
+STAGE_DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Tokens per model call, up to the largest context windows
+TOKEN_COUNT_BUCKETS = (16, 64, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768, 131072)
+
+
+def format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+def escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(label_names: Sequence[str], label_values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{escape_label_value(value)}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, buckets: Sequence[float], label_names: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self.label_names = tuple(label_names)
+        # Per label values: counts per bucket (not cumulative), sum
+        self._series: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, *label_values: str):
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = ([0] * len(self.buckets), [0.0])
+        counts, total = series
+        counts[bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    def collect(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for label_values, (counts, total) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = format_labels(self.label_names, label_values, f'le="{format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.label_names, label_values)
+            lines.append(f"{self.name}_sum{labels} {format_value(total[0])}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class CallbackMetric:
+    """
+    Counter or gauge whose values are read at scrape time from statistics a component already keeps,
+    e.g. the hit and miss counts of the caches. The callback returns a value per tuple of label values.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        metric_type: str,
+        label_names: Sequence[str],
+        callback: Callable[[], dict[tuple[str, ...], float]],
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.metric_type = metric_type
+        self.label_names = tuple(label_names)
+        self.callback = callback
+
+    def collect(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        for label_values, value in sorted(self.callback().items()):
+            lines.append(f"{self.name}{format_labels(self.label_names, label_values)} {format_value(value)}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Minimal in-process metrics registry rendered in the Prometheus text exposition format, so /metrics works
+    without Application Insights or a Prometheus client library. Values are per worker process.
+    """
+
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self):
+        self._metrics: dict[str, object] = {}
+
+    def histogram(
+        self, name: str, documentation: str, buckets: Sequence[float], label_names: Sequence[str] = ()
+    ) -> Histogram:
+        metric = Histogram(name, documentation, buckets, label_names)
+        self._metrics[name] = metric
+        return metric
+
+    def callback(
+        self,
+        name: str,
+        documentation: str,
+        metric_type: str,
+        label_names: Sequence[str],
+        callback: Callable[[], dict[tuple[str, ...], float]],
+    ) -> CallbackMetric:
+        metric = CallbackMetric(name, documentation, metric_type, label_names, callback)
+        self._metrics[name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.collect())  # type: ignore[attr-defined]
+        return "\n".join(lines) + "\n"
+
+
+class ChatMetrics:
+    """
+    Per-stage latency and token usage of the chat approach. Every stage is an OpenTelemetry span (exported
+    when Application Insights is configured, a no-op otherwise) and an observation of chat_stage_duration_seconds.
+    """
+
+    def __init__(self, registry: MetricsRegistry):
+        self.registry = registry
+        self.tracer = trace.get_tracer(__name__)
+        self.stage_duration = registry.histogram(
+            "chat_stage_duration_seconds", "Duration of the stages of a chat request", STAGE_DURATION_BUCKETS, ("stage",)
+        )
+        self.tokens = registry.histogram(
+            "chat_tokens", "Prompt and completion tokens per model call", TOKEN_COUNT_BUCKETS, ("call", "kind")
+        )
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[trace.Span]:
+        # Failed and cancelled stages (e.g. a discarded speculative search) are recorded on the span only,
+        # so the histogram stays the latency of completed work
+        start = time.perf_counter()
+        with self.tracer.start_as_current_span(f"chat.{name}") as span:
+            yield span
+            self.stage_duration.observe(time.perf_counter() - start, name)
+
+    def start_span(self, name: str) -> trace.Span:
+        # For stages that span several steps of an async generator, where the current context can't be kept
+        return self.tracer.start_span(f"chat.{name}")
+
+    def observe_stage(self, name: str, seconds: float):
+        self.stage_duration.observe(seconds, name)
+
+    def observe_tokens(self, call: str, prompt_tokens: Optional[int], completion_tokens: Optional[int]):
+        if prompt_tokens is not None:
+            self.tokens.observe(prompt_tokens, call, "prompt")
+        if completion_tokens is not None:
+            self.tokens.observe(completion_tokens, call, "completion")
@@ -1,6 +1,18 @@
 from __future__ import annotations
 
+import base64
+import hashlib
+import logging
+import mmap
+import os
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Any, Optional
+
 import tiktoken
+from tiktoken.model import encoding_name_for_model
+from tiktoken_ext import openai_public
 
 # Ref: https://learn.microsoft.com/ja-jp/azure/ai-services/openai/concepts/models?utm_source=chatgpt.com&tabs=python-secure%2Cglobal-standard%2Cstandard-chat-completions#gpt-4-and-gpt-4-turbo-models
 MODELS_2_TOKEN_LIMITS = {
@@ -9,12 +21,56 @@ MODELS_2_TOKEN_LIMITS = {
     "gpt-35-turbo-16k": 16000,
     "gpt-3.5-turbo-16k": 16000,
     "gpt-4o": 128000,
+    "gpt-4o-mini": 128000,
     "gpt-4": 8100,
     "gpt-4-32k": 32000,
 }
 
 AOAI_2_OAI = {"gpt-35-turbo": "gpt-3.5-turbo", "gpt-35-turbo-16k": "gpt-3.5-turbo-16k"}
 
+# Every message is wrapped as <|start|>{role}\n{content}<|end|>\n, and every reply is primed with <|start|>assistant<|message|>
+# Ref: https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+TOKENS_PER_MESSAGE = 3
+REPLY_PRIMING_TOKENS = 3
+
+# Upper bound of memoized token counts kept per worker
+TOKEN_COUNT_CACHE_SIZE = 8192
+
+# Directory with <encoding name>.tiktoken vocabulary files, see set_vocabulary_dir
+vocabulary_dir: Optional[str] = None
+# Held while an encoding is built, see read_local_encoding
+encoding_lock = threading.Lock()
+
+
+class TokenCountCache:
+    """
+    Bounded LRU of token counts keyed by encoding name and a digest of the text, so long texts
+    (system prompts, history turns) are not kept alive just to be used as dictionary keys.
+    """
+
+    def __init__(self, max_size: int = TOKEN_COUNT_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._counts: OrderedDict[tuple[str, bytes], int] = OrderedDict()
+
+    def count(self, encoding: tiktoken.Encoding, text: str) -> int:
+        key = (encoding.name, hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest())
+        count = self._counts.get(key)
+        if count is not None:
+            self.hits += 1
+            self._counts.move_to_end(key)
+            return count
+        self.misses += 1
+        count = len(encoding.encode(text))
+        self._counts[key] = count
+        if len(self._counts) > self.max_size:
+            self._counts.popitem(last=False)
+        return count
+
+
+token_count_cache = TokenCountCache()
+
 
 def get_token_limit(model_id: str) -> int:
     if model_id not in MODELS_2_TOKEN_LIMITS:
@@ -34,15 +90,83 @@ def num_tokens_from_messages(message: dict[str, str], model: str) -> int:
         message = {'role': 'user', 'content': 'Hello, how are you?'}
         model = 'gpt-3.5-turbo'
         num_tokens_from_messages(message, model)
-        output: 11
+        output: 10
     """
-    encoding = tiktoken.encoding_for_model(get_oai_chatmodel_tiktok(model))
-    num_tokens = 2  # For "role" and "content" keys
+    encoding = get_encoding(model)
+    num_tokens = TOKENS_PER_MESSAGE
     for key, value in message.items():
-        num_tokens += len(encoding.encode(value))
+        num_tokens += token_count_cache.count(encoding, value)
     return num_tokens
 
 
+def num_tokens_from_text(text: str, model: str) -> int:
+    return token_count_cache.count(get_encoding(model), text)
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str) -> tiktoken.Encoding:
+    # tiktoken.encoding_for_model resolves the model name on every call, resolve it once per model
+    return load_encoding(encoding_name_for_model(get_oai_chatmodel_tiktok(model)))
+
+
+def set_vocabulary_dir(path: Optional[str]):
+    """
+    Makes the encodings load their vocabulary from <path>/<encoding name>.tiktoken (e.g. cl100k_base.tiktoken,
+    the file tiktoken downloads from openaipublic.blob.core.windows.net/encodings), so workers start without
+    network access or a populated TIKTOKEN_CACHE_DIR. Encodings without a file there are loaded by tiktoken.
+    """
+    global vocabulary_dir
+    vocabulary_dir = path
+    get_encoding.cache_clear()
+    load_encoding.cache_clear()
+
+
+@lru_cache(maxsize=None)
+def load_encoding(encoding_name: str) -> tiktoken.Encoding:
+    path = os.path.join(vocabulary_dir, f"{encoding_name}.tiktoken") if vocabulary_dir else None
+    with encoding_lock:
+        if encoding_name not in openai_public.ENCODING_CONSTRUCTORS or path is None or not os.path.exists(path):
+            if path is not None:
+                logging.warning(
+                    "No local vocabulary for %s in %s, loading it through tiktoken", encoding_name, vocabulary_dir
+                )
+            return tiktoken.get_encoding(encoding_name)
+        return tiktoken.Encoding(**read_local_encoding(encoding_name, path))
+
+
+def read_local_encoding(encoding_name: str, path: str) -> dict[str, Any]:
+    """
+    Returns the definition tiktoken_ext.openai_public gives for the encoding (pattern, special tokens, ...),
+    with the vocabulary read from path and checked against the hash openai_public expects for it.
+    The constructors load their vocabulary through load_tiktoken_bpe, which only reads local files when
+    blobfile is installed, so it is swapped for read_vocabulary while the constructor runs; callers hold
+    encoding_lock, so no other encoding is built in the meantime.
+    """
+
+    def load_local_vocabulary(blobpath: str, expected_hash: Optional[str] = None) -> dict[bytes, int]:
+        return read_vocabulary(path, expected_hash)
+
+    load_tiktoken_bpe = openai_public.load_tiktoken_bpe
+    openai_public.load_tiktoken_bpe = load_local_vocabulary
+    try:
+        return openai_public.ENCODING_CONSTRUCTORS[encoding_name]()
+    finally:
+        openai_public.load_tiktoken_bpe = load_tiktoken_bpe
+
+
+def read_vocabulary(path: str, expected_sha256: Optional[str] = None) -> dict[bytes, int]:
+    # The file is memory-mapped and parsed in place instead of being read into a buffer first,
+    # lines are "<base64 token> <rank>"
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        if expected_sha256 is not None and hashlib.sha256(data).hexdigest() != expected_sha256:
+            raise ValueError(f"{path} does not match the expected vocabulary")
+        ranks = {}
+        for line in iter(data.readline, b""):
+            token, rank = line.split()
+            ranks[base64.b64decode(token)] = int(rank)
+    return ranks
+
+
 def get_oai_chatmodel_tiktok(aoaimodel: str) -> str:
     message = "Expected Azure OpenAI ChatGPT model name"
     if aoaimodel == "" or aoaimodel is None:
@@ -0,0 +1,115 @@
+import asyncio
+import time
+from typing import Any, AsyncGenerator, AsyncIterator, Optional
+
+import orjson
+
+
+def dumps(obj: Any) -> bytes:
+    # orjson writes UTF-8 bytes directly (no ensure_ascii escaping of Japanese text) and is much faster than json
+    return orjson.dumps(obj)
+
+
+class NDJSONStreamWriter:
+    """
+    Serializes chat completion chunks as NDJSON frames.
+    Consecutive content deltas are coalesced into one frame until it reaches max_frame_bytes or the oldest
+    pending delta is max_frame_delay seconds old. The first content delta is sent right away so the time to
+    first token is unchanged. Upstream is read one event ahead of what the client has accepted, so a slow
+    client slows down reading instead of buffering the whole answer. When nothing has been sent for
+    heartbeat_interval seconds an empty object is sent to keep proxies from closing the idle stream.
+    """
+
+    HEARTBEAT = b"{}\n"
+
+    def __init__(self, max_frame_bytes: int = 2048, max_frame_delay: float = 0.05, heartbeat_interval: float = 15):
+        self.max_frame_bytes = max_frame_bytes
+        self.max_frame_delay = max_frame_delay
+        self.heartbeat_interval = heartbeat_interval
+
+    @staticmethod
+    def get_content_delta(event: Any) -> Optional[str]:
+        # Returns the content of a chunk that only carries a content delta, None for anything else
+        if not isinstance(event, dict):
+            return None
+        choices = event.get("choices")
+        if not choices or len(choices) != 1 or "context" in choices[0] or choices[0].get("finish_reason") is not None:
+            return None
+        delta = choices[0].get("delta") or {}
+        if set(delta.keys()) != {"content"} or not isinstance(delta["content"], str):
+            return None
+        return delta["content"]
+
+    @staticmethod
+    def with_content(event: dict, content: str) -> dict:
+        choice = dict(event["choices"][0])
+        choice["delta"] = {"content": content}
+        return {**event, "choices": [choice]}
+
+    async def frames(self, events: AsyncIterator[Any]) -> AsyncGenerator[bytes, None]:
+        pending_event: Optional[dict] = None
+        pending_content: list[str] = []
+        pending_bytes = 0
+        pending_since = 0.0
+        sent_content = False
+        last_sent = time.monotonic()
+
+        def flush() -> bytes:
+            nonlocal pending_event, pending_content, pending_bytes, last_sent
+            frame = dumps(self.with_content(pending_event, "".join(pending_content))) + b"\n"
+            pending_event, pending_content, pending_bytes = None, [], 0
+            last_sent = time.monotonic()
+            return frame
+
+        iterator = events.__aiter__()
+        next_event = asyncio.ensure_future(iterator.__anext__())
+        try:
+            while True:
+                now = time.monotonic()
+                if pending_event is not None:
+                    timeout = max(0.0, pending_since + self.max_frame_delay - now)
+                else:
+                    timeout = max(0.0, last_sent + self.heartbeat_interval - now)
+                done, _ = await asyncio.wait({next_event}, timeout=timeout)
+                if not done:
+                    if pending_event is not None:
+                        yield flush()
+                    else:
+                        last_sent = time.monotonic()
+                        yield self.HEARTBEAT
+                    continue
+
+                try:
+                    event = next_event.result()
+                except StopAsyncIteration:
+                    break
+                next_event = asyncio.ensure_future(iterator.__anext__())
+
+                content = self.get_content_delta(event)
+                if content is None:
+                    if pending_event is not None:
+                        yield flush()
+                    last_sent = time.monotonic()
+                    yield dumps(event) + b"\n"
+                    continue
+                if not sent_content:
+                    sent_content = True
+                    last_sent = time.monotonic()
+                    yield dumps(event) + b"\n"
+                    continue
+                if pending_event is None:
+                    pending_event = event
+                    pending_since = time.monotonic()
+                pending_content.append(content)
+                pending_bytes += len(content.encode("utf-8"))
+                if pending_bytes >= self.max_frame_bytes:
+                    yield flush()
+
+            if pending_event is not None:
+                yield flush()
+        finally:
+            if not next_event.done():
+                next_event.cancel()
+                await asyncio.wait({next_event})
+            if hasattr(iterator, "aclose"):
+                await iterator.aclose()
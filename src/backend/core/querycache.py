@@ -0,0 +1,48 @@
+import hashlib
+import json
+import unicodedata
+from typing import Optional
+
+from core.cache import CacheBackend
+
+
+class QueryRewriteCache:
+    """
+    Caches the search query generated by the LLM for a conversation.
+    The key is the model plus the NFC-normalized messages sent to the rewrite call, i.e. the history that fit
+    into the prompt and the new question, so a hit returns exactly what the same call would have produced.
+    """
+
+    def __init__(self, backend: CacheBackend, ttl: float = 3600):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(model: str, messages: list[dict[str, str]]) -> str:
+        normalized = [[message["role"], unicodedata.normalize("NFC", message["content"])] for message in messages]
+        payload = json.dumps([model, normalized], ensure_ascii=False, separators=(",", ":"))
+        return "query:" + hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    async def get(self, model: str, messages: list[dict[str, str]]) -> Optional[str]:
+        query = await self.backend.get(self.make_key(model, messages))
+        if query is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return query
+
+    async def set(self, model: str, messages: list[dict[str, str]], query: str):
+        await self.backend.set(self.make_key(model, messages), query, self.ttl)
+
+    def get_stats(self) -> dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    async def close(self):
+        await self.backend.close()
@@ -0,0 +1,76 @@
+import re
+import unicodedata
+from collections import Counter
+
+import numpy as np
+
+# Runs of Han, Hiragana, Katakana and Hangul characters have no word boundaries and are split into character n-grams
+CJK_RUN = re.compile("[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af]+")
+WORD = re.compile(r"\w+")
+
+
+class BM25Reranker:
+    """
+    Re-ranks search candidates against the user's question with Okapi BM25.
+    Latin text is tokenized by words and CJK text by overlapping character bigrams (single characters
+    for one-character runs), so Japanese questions match without a morphological analyzer.
+    Only the query terms are counted, so scoring ~50 candidates is a handful of small NumPy operations.
+    """
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75, ngram_size: int = 2):
+        self.k1 = k1
+        self.b = b
+        self.ngram_size = ngram_size
+
+    def tokenize(self, text: str) -> list[str]:
+        text = unicodedata.normalize("NFKC", text).casefold()
+        terms = []
+        position = 0
+        for match in CJK_RUN.finditer(text):
+            terms.extend(WORD.findall(text[position : match.start()]))
+            run = match.group()
+            if len(run) <= self.ngram_size:
+                terms.append(run)
+            else:
+                terms.extend(run[i : i + self.ngram_size] for i in range(len(run) - self.ngram_size + 1))
+            position = match.end()
+        terms.extend(WORD.findall(text[position:]))
+        return terms
+
+    def score(self, query: str, documents: list[str]) -> np.ndarray:
+        query_terms = list(dict.fromkeys(self.tokenize(query)))
+        if not documents or not query_terms:
+            return np.zeros(len(documents))
+
+        term_index = {term: i for i, term in enumerate(query_terms)}
+        term_frequencies = np.zeros((len(documents), len(query_terms)))
+        document_lengths = np.empty(len(documents))
+        for row, document in enumerate(documents):
+            terms = self.tokenize(document)
+            document_lengths[row] = len(terms)
+            for term, count in Counter(terms).items():
+                column = term_index.get(term)
+                if column is not None:
+                    term_frequencies[row, column] = count
+
+        document_frequencies = np.count_nonzero(term_frequencies, axis=0)
+        idf = np.log1p((len(documents) - document_frequencies + 0.5) / (document_frequencies + 0.5))
+        average_length = max(document_lengths.mean(), 1.0)
+        length_norm = self.k1 * (1 - self.b + self.b * document_lengths / average_length)
+        saturated = term_frequencies * (self.k1 + 1) / (term_frequencies + length_norm[:, None])
+        return saturated @ idf
+
+    def rerank(self, query: str, documents: list[str], min_relative_score: float = 0.0) -> list[int]:
+        """
+        Returns the indices of documents ordered by descending score (ties keep the search order).
+        Documents scoring below min_relative_score times the best score are dropped, the best one is always kept.
+        """
+        if not documents:
+            return []
+        scores = self.score(query, documents)
+        order = np.argsort(-scores, kind="stable")
+        best_score = scores[order[0]]
+        if best_score <= 0:
+            # Nothing matched lexically, keep the search order
+            return list(range(len(documents)))
+        return [int(i) for i in order if i == order[0] or scores[i] >= best_score * min_relative_score]
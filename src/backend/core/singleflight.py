@@ -0,0 +1,150 @@
+import asyncio
+import hashlib
+import json
+import unicodedata
+from collections import Counter
+from typing import Any, AsyncGenerator, AsyncIterator, Awaitable, Callable, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+def make_messages_key(model: str, messages: list[dict[str, str]]) -> str:
+    # Chat calls with the same model and NFC-normalized messages produce the same completion (temperature 0)
+    normalized = [[message["role"], unicodedata.normalize("NFC", message["content"])] for message in messages]
+    payload = json.dumps([model, normalized], ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class SharedCall:
+    # One in-flight call and the number of callers still waiting for it
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SharedStream:
+    """
+    An upstream stream read once by a background task and replayed to every subscriber.
+    Subscribers that join late first get the events already received, then follow live.
+    The upstream is cancelled when the last subscriber leaves before it has finished.
+    """
+
+    def __init__(self, source_factory: Callable[[], Awaitable[AsyncIterator[Any]]]):
+        self.events: list[Any] = []
+        self.error: Optional[BaseException] = None
+        self.done = False
+        # Set when the last subscriber left early, new callers must not join a stream that is being cancelled
+        self.abandoned = False
+        self.subscribers = 0
+        self._updated = asyncio.Event()
+        self.task = asyncio.create_task(self.pump(source_factory))
+
+    async def pump(self, source_factory: Callable[[], Awaitable[AsyncIterator[Any]]]):
+        source = None
+        try:
+            source = await source_factory()
+            async for event in source:
+                self.events.append(event)
+                self.notify()
+        except asyncio.CancelledError:
+            self.error = RuntimeError("The shared stream was cancelled")
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self.notify()
+            if source is not None and hasattr(source, "aclose"):
+                await source.aclose()
+
+    def notify(self):
+        self._updated.set()
+        self._updated = asyncio.Event()
+
+    async def subscribe(self) -> AsyncGenerator[Any, None]:
+        self.subscribers += 1
+        index = 0
+        try:
+            while True:
+                while index < len(self.events):
+                    yield self.events[index]
+                    index += 1
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await self._updated.wait()
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done:
+                self.abandoned = True
+                self.task.cancel()
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical work: while a call for a key is in flight, callers with the same key
+    wait for its result instead of starting their own. Nothing is kept once the call has finished, so this
+    only removes duplicate concurrent upstream calls and never serves stale results.
+    The work runs in its own task, so a caller that goes away does not cancel it for the others;
+    it is only cancelled when no caller is waiting for it any more.
+    """
+
+    def __init__(self):
+        self._calls: dict[str, SharedCall] = {}
+        self._streams: dict[str, SharedStream] = {}
+        # Per stage: calls that did the work and calls that joined one in flight
+        self.leaders: Counter[str] = Counter()
+        self.followers: Counter[str] = Counter()
+
+    async def do(self, stage: str, key: str, fn: Callable[[], Awaitable[T]]) -> T:
+        key = f"{stage}:{key}"
+        call = self._calls.get(key)
+        if call is None:
+            self.leaders[stage] += 1
+            call = SharedCall(asyncio.ensure_future(fn()))
+            self._calls[key] = call
+            call.task.add_done_callback(lambda _: self.forget_call(key, call))
+        else:
+            self.followers[stage] += 1
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        except asyncio.CancelledError:
+            if not call.task.done() and call.waiters == 1:
+                # Forget it right away so a caller arriving now starts a new call instead of joining a cancelled one
+                self.forget_call(key, call)
+                call.task.cancel()
+            raise
+        finally:
+            call.waiters -= 1
+
+    def forget_call(self, key: str, call: SharedCall):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+        if call.task.done():
+            # Mark the exception as retrieved, the waiters (if any are left) get it through the shield
+            call.task.cancelled() or call.task.exception()
+
+    def stream(
+        self, stage: str, key: str, source_factory: Callable[[], Awaitable[AsyncIterator[Any]]]
+    ) -> AsyncGenerator[Any, None]:
+        key = f"{stage}:{key}"
+        shared = self._streams.get(key)
+        if shared is None or shared.done or shared.abandoned:
+            self.leaders[stage] += 1
+            shared = SharedStream(source_factory)
+            self._streams[key] = shared
+            shared.task.add_done_callback(lambda _: self.forget_stream(key, shared))
+        else:
+            self.followers[stage] += 1
+        return shared.subscribe()
+
+    def forget_stream(self, key: str, shared: SharedStream):
+        if self._streams.get(key) is shared:
+            del self._streams[key]
+
+    def get_stats(self) -> dict[str, dict[str, int]]:
+        return {
+            stage: {"leaders": self.leaders[stage], "followers": self.followers[stage]}
+            for stage in self.leaders.keys() | self.followers.keys()
+        }
@@ -0,0 +1,70 @@
+import importlib
+import logging
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+from core.metrics import MetricsRegistry
+
+# Third-party packages that make up most of the import time of the app, in the order they are imported
+HEAVY_IMPORTS = [
+    "aiohttp",
+    "httpx",
+    "openai",
+    "msal",
+    "msal_extensions",
+    "azure.identity.aio",
+    "msgraph_core",
+    "quart",
+    "opentelemetry.instrumentation.asgi",
+    "tiktoken",
+    "numpy",
+]
+
+
+def import_timed(modules: list[str]) -> dict[str, float]:
+    # Imports the modules one at a time and returns the seconds each took. A module's time includes the
+    # dependencies it is the first to import, so shared ones are counted once, for the earliest module.
+    durations = {}
+    for module in modules:
+        start = time.perf_counter()
+        importlib.import_module(module)
+        durations[module] = time.perf_counter() - start
+    return durations
+
+
+class StartupTimer:
+    """
+    Records how long each step of a worker's startup takes (module imports, client setup, warm-up), so the cost
+    of the worker restarts gunicorn does every max_requests shows up in the logs and on /metrics.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.durations: dict[str, float] = {}
+
+    @contextmanager
+    def measure(self, component: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.durations[component] = self.durations.get(component, 0.0) + time.perf_counter() - start
+
+    def record(self, component: str, seconds: float):
+        self.durations[component] = self.durations.get(component, 0.0) + seconds
+
+    def finish(self, registry: MetricsRegistry):
+        # From the app being created to the worker being ready to serve, the imports come on top
+        self.durations["app_setup"] = time.perf_counter() - self.started
+        logging.info(
+            "Worker ready, %s",
+            ", ".join(f"{component} {seconds:.3f}s" for component, seconds in self.durations.items()),
+        )
+        registry.callback(
+            "app_startup_seconds",
+            "Time spent in each step of the worker startup",
+            "gauge",
+            ("component",),
+            lambda: {(component,): seconds for component, seconds in self.durations.items()},
+        )
@@ -0,0 +1,49 @@
+import re
+
+from core.modelhelper import num_tokens_from_text
+
+# Sentence ends (Japanese and Western punctuation) and line breaks are preferred chunk boundaries
+SENTENCE_ENDINGS = re.compile(r"(?<=[。．！？!?])|(?<=\.\s)|\n+")
+
+
+def split_text(text: str, model: str, max_tokens: int) -> list[str]:
+    """
+    Split text into chunks of at most max_tokens tokens, cutting at sentence ends where possible.
+    Sentences longer than max_tokens are cut by characters.
+    """
+    chunks: list[str] = []
+    current: list[str] = []
+    current_tokens = 0
+    for sentence in SENTENCE_ENDINGS.split(text):
+        sentence = sentence.strip()
+        if not sentence:
+            continue
+        sentence_tokens = num_tokens_from_text(sentence, model)
+        if sentence_tokens > max_tokens:
+            if current:
+                chunks.append(" ".join(current))
+                current, current_tokens = [], 0
+            chunks.extend(split_by_characters(sentence, model, max_tokens))
+            continue
+        if current_tokens + sentence_tokens > max_tokens:
+            chunks.append(" ".join(current))
+            current, current_tokens = [], 0
+        current.append(sentence)
+        # +1 for the space joining the sentences
+        current_tokens += sentence_tokens + 1
+    if current:
+        chunks.append(" ".join(current))
+    return chunks
+
+
+def split_by_characters(text: str, model: str, max_tokens: int) -> list[str]:
+    chunks = []
+    while text:
+        # Start from an estimate of the characters that fit and shrink until the piece is within the limit
+        tokens = num_tokens_from_text(text, model)
+        end = len(text) if tokens <= max_tokens else max(1, len(text) * max_tokens // tokens)
+        while end > 1 and num_tokens_from_text(text[:end], model) > max_tokens:
+            end = max(1, end * 9 // 10)
+        chunks.append(text[:end])
+        text = text[end:]
+    return chunks
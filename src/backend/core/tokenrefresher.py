@@ -0,0 +1,78 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Callable, Optional
+
+from azure.core.credentials import AccessToken
+
+
+class TokenRefresher:
+    """
+    Keeps an AAD access token fresh from a background task instead of on the request path.
+    The token is refreshed refresh_margin seconds plus a random jitter (drawn every cycle, so workers don't all
+    refresh at once) before it expires. A lock makes sure only one refresh is in flight; requests only wait for it when the
+    token has actually expired.
+    """
+
+    def __init__(
+        self,
+        credential,
+        scope: str,
+        on_refresh: Callable[[AccessToken], None],
+        refresh_margin: float = 300,
+        jitter: float = 60,
+        retry_interval: float = 10,
+    ):
+        self.credential = credential
+        self.scope = scope
+        self.on_refresh = on_refresh
+        self.refresh_margin = refresh_margin
+        self.jitter = jitter
+        self.retry_interval = retry_interval
+        self.token: Optional[AccessToken] = None
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        await self.refresh()
+        self._task = asyncio.create_task(self.refresh_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.wait({self._task})
+            self._task = None
+
+    def is_expired(self) -> bool:
+        return self.token is None or self.token.expires_on <= time.time()
+
+    async def ensure_valid(self):
+        # Fast path for requests: no await at all while the token is valid
+        if self.is_expired():
+            await self.refresh()
+
+    async def refresh(self, min_validity: float = 0):
+        async with self._lock:
+            # Another caller may have refreshed the token while this one was waiting for the lock
+            if self.token is not None and self.token.expires_on > time.time() + min_validity:
+                return
+            self.token = await self.credential.get_token(self.scope)
+            self.on_refresh(self.token)
+
+    async def refresh_loop(self):
+        while True:
+            # The jitter is drawn once per cycle and the token is refreshed as soon as it is due, so workers
+            # started together spread their refreshes over the jitter window
+            min_validity = self.refresh_margin + random.uniform(0, self.jitter)
+            expires_on = self.token.expires_on
+            await asyncio.sleep(max(expires_on - time.time() - min_validity, 0))
+            try:
+                await self.refresh(min_validity=min_validity)
+            except Exception:
+                logging.exception("Failed to refresh token for %s, retrying in %s seconds", self.scope, self.retry_interval)
+                await asyncio.sleep(self.retry_interval)
+                continue
+            if self.token.expires_on <= expires_on:
+                # The credential handed back the same token (e.g. from its own cache), ask again later
+                await asyncio.sleep(self.retry_interval)
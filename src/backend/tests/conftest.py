@@ -0,0 +1,48 @@
+import pytest
+import tiktoken
+
+from core import modelhelper
+
+# The required settings only, everything else keeps its default
+MINIMAL_ENV = {
+    "OPENAI_HOST": "azure",
+    "AZURE_OPENAI_SERVICE": "test-openai-service",
+    "AZURE_OPENAI_KEY": "test-key",
+    "AZURE_OPENAI_CHATGPT_DEPLOYMENT": "chat",
+    "AZURE_OPENAI_CHATGPT_MODEL": "gpt-35-turbo",
+}
+
+
+@pytest.fixture
+def offline_tokenizer(monkeypatch):
+    # A byte-level encoding, so tests neither download nor need the real vocabulary
+    def get_encoding(encoding_name: str) -> tiktoken.Encoding:
+        return tiktoken.Encoding(
+            name=encoding_name,
+            pat_str=r"\S+|\s+",
+            mergeable_ranks={bytes([i]): i for i in range(256)},
+            special_tokens={},
+        )
+
+    monkeypatch.setattr(tiktoken, "get_encoding", get_encoding)
+    modelhelper.set_vocabulary_dir(None)
+    yield
+    modelhelper.set_vocabulary_dir(None)
+
+
+@pytest.fixture
+def minimal_env(monkeypatch, offline_tokenizer):
+    for name, value in MINIMAL_ENV.items():
+        monkeypatch.setenv(name, value)
+    # Settings picked up from the developer's environment would not be the defaults
+    for name in (
+        "QUERY_CACHE_BACKEND",
+        "SEARCH_CACHE_BACKEND",
+        "CONVERSATION_STORE_BACKEND",
+        "METRICS_ENABLED",
+        "AZURE_OPENAI_QUERY_MODEL",
+        "AZURE_OPENAI_QUERY_DEPLOYMENT",
+        "AZURE_OPENAI_QUERY_DEPLOYMENTS",
+    ):
+        monkeypatch.delenv(name, raising=False)
+    return monkeypatch
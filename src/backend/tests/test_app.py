@@ -0,0 +1,80 @@
+import asyncio
+
+import pytest
+from quart.testing.app import LifespanError
+
+import app
+
+
+def run_app(check):
+    async def serve():
+        quart_app = app.create_app()
+        async with quart_app.test_app():
+            check(quart_app)
+
+    asyncio.run(serve())
+
+
+def test_default_caches_exist(minimal_env):
+    def check(quart_app):
+        assert quart_app.config[app.CONFIG_QUERY_CACHE] is not None
+        assert quart_app.config[app.CONFIG_CHAT_APPROACH].query_cache is quart_app.config[app.CONFIG_QUERY_CACHE]
+        assert quart_app.config[app.CONFIG_SEARCH_CACHE] is not None
+        graph_search = quart_app.config[app.CONFIG_CHAT_APPROACH].graph_search
+        assert graph_search.result_cache is quart_app.config[app.CONFIG_SEARCH_CACHE]
+
+    run_app(check)
+
+
+def test_memory_conversation_store(minimal_env):
+    minimal_env.setenv("CONVERSATION_STORE_BACKEND", "memory")
+
+    def check(quart_app):
+        conversation_store = quart_app.config[app.CONFIG_CONVERSATION_STORE]
+        assert conversation_store is not None
+        assert quart_app.config[app.CONFIG_CHAT_APPROACH].conversation_store is conversation_store
+
+    run_app(check)
+
+
+def test_metrics_disabled_by_default(minimal_env):
+    async def serve():
+        quart_app = app.create_app()
+        async with quart_app.test_app() as test_app:
+            response = await test_app.test_client().get("/metrics")
+            assert response.status_code == 404
+
+    asyncio.run(serve())
+
+
+def test_batch_rejects_invalid_max_concurrency(minimal_env):
+    async def serve():
+        quart_app = app.create_app()
+        async with quart_app.test_app() as test_app:
+            response = await test_app.test_client().post(
+                "/chat/batch",
+                json={"items": [{"messages": [{"role": "user", "content": "hi"}]}], "max_concurrency": "many"},
+                headers={"Authorization": "Bearer token"},
+            )
+            assert response.status_code == 400
+
+    asyncio.run(serve())
+
+
+def test_query_model_requires_query_deployment(minimal_env):
+    minimal_env.setenv("AZURE_OPENAI_QUERY_MODEL", "gpt-4o-mini")
+
+    with pytest.raises(LifespanError, match="AZURE_OPENAI_QUERY_DEPLOYMENT"):
+        run_app(lambda quart_app: None)
+
+
+def test_query_model_with_query_deployment(minimal_env):
+    minimal_env.setenv("AZURE_OPENAI_QUERY_MODEL", "gpt-4o-mini")
+    minimal_env.setenv("AZURE_OPENAI_QUERY_DEPLOYMENT", "query")
+
+    def check(quart_app):
+        approach = quart_app.config[app.CONFIG_CHAT_APPROACH]
+        assert approach.query_model == "gpt-4o-mini"
+        assert approach.query_deployment == "query"
+
+    run_app(check)
@@ -0,0 +1,57 @@
+import asyncio
+
+from core.authentication import AuthenticationHelper
+from core.cache import MemoryCache
+
+
+class FakeConfidentialClient:
+    def __init__(self):
+        self.exchanges = []
+
+    def acquire_token_on_behalf_of(self, user_assertion, scopes):
+        self.exchanges.append(user_assertion)
+        return {"access_token": f"graph-{len(self.exchanges)}", "expires_in": 3600}
+
+
+def create_auth_helper(token_cache):
+    auth_helper = AuthenticationHelper(
+        use_authentication=False,
+        server_app_id="server-app",
+        server_app_secret="secret",
+        client_app_id="client-app",
+        tenant_id="tenant",
+        token_cache=token_cache,
+    )
+    auth_helper.confidential_client = FakeConfidentialClient()
+    return auth_helper
+
+
+def test_obo_tokens_are_cached_by_assertion():
+    async def run():
+        auth_helper = create_auth_helper(MemoryCache())
+        scopes = [AuthenticationHelper.scope]
+        first = await auth_helper.acquire_token_on_behalf_of("assertion-a", scopes)
+        second = await auth_helper.acquire_token_on_behalf_of("assertion-a", scopes)
+        other = await auth_helper.acquire_token_on_behalf_of("assertion-b", scopes)
+        await auth_helper.close()
+        return auth_helper, first, second, other
+
+    auth_helper, first, second, other = asyncio.run(run())
+    assert second["access_token"] == first["access_token"]
+    assert 3000 < second["expires_in"] <= 3600
+    assert other["access_token"] != first["access_token"]
+    assert auth_helper.confidential_client.exchanges == ["assertion-a", "assertion-b"]
+    assert auth_helper.get_obo_cache_stats() == {"hits": 1, "misses": 2}
+
+
+def test_shared_backend_shares_exchanges_between_helpers():
+    async def run():
+        token_cache = MemoryCache()
+        worker_a, worker_b = create_auth_helper(token_cache), create_auth_helper(token_cache)
+        first = await worker_a.acquire_token_on_behalf_of("assertion", [AuthenticationHelper.scope])
+        second = await worker_b.acquire_token_on_behalf_of("assertion", [AuthenticationHelper.scope])
+        return worker_b, first, second
+
+    worker_b, first, second = asyncio.run(run())
+    assert second["access_token"] == first["access_token"]
+    assert worker_b.confidential_client.exchanges == []
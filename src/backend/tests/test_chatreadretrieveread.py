@@ -0,0 +1,58 @@
+import asyncio
+from types import SimpleNamespace
+
+from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
+from core.admission import AdmissionController
+from core.metrics import MetricsRegistry
+
+
+def test_batch_items_hold_admission_slots():
+    async def run():
+        admission = AdmissionController(
+            max_in_flight=2, max_queue=16, queue_timeout=5, max_queue_per_user=8, registry=MetricsRegistry()
+        )
+        running = 0
+        most_running = 0
+
+        async def run_without_streaming(messages, overrides, obo_token, session_state):
+            nonlocal running, most_running
+            running += 1
+            most_running = max(most_running, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+            return {"choices": []}
+
+        approach = SimpleNamespace(openai_session=None, run_without_streaming=run_without_streaming)
+        ticket = await admission.acquire("user")
+        batch = ChatReadRetrieveReadApproach.run_batch(
+            approach,
+            [{"messages": []} for _ in range(8)],
+            {"obo_token": "token"},
+            max_concurrency=4,
+            ticket=ticket,
+            admit=lambda: admission.acquire("user"),
+        )
+        results = [result async for result in batch]
+        return results, most_running, admission.in_flight
+
+    results, most_running, in_flight = asyncio.run(run())
+    assert sorted(result["index"] for result in results) == list(range(8))
+    assert all("response" in result for result in results)
+    # The batch asks for 4 items at once but the worker only admits 2 requests
+    assert most_running == 2
+    assert in_flight == 0
+
+
+def test_near_equal_query_compares_japanese_by_character_bigrams():
+    approach = SimpleNamespace(
+        QUERY_TOKENIZER=ChatReadRetrieveReadApproach.QUERY_TOKENIZER, near_equal_query_threshold=0.8
+    )
+    approach.get_query_terms = lambda query: ChatReadRetrieveReadApproach.get_query_terms(approach, query)
+
+    def is_near_equal(query, other_query):
+        return ChatReadRetrieveReadApproach.is_near_equal_query(approach, query, other_query)
+
+    assert is_near_equal("社内の福利厚生制度の申請方法", "社内の福利厚生制度の申請方法は")
+    assert not is_near_equal("社内の福利厚生制度の申請方法", "社内の出張旅費の精算方法")
+    assert is_near_equal("Expense Report Deadline", "expense report deadline")
+    assert not is_near_equal("expense report deadline", "travel policy")
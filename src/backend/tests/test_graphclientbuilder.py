@@ -0,0 +1,42 @@
+import asyncio
+from unittest import mock
+
+from core.graphclientbuilder import GraphClientCache
+
+
+class FakeCredential:
+    def __init__(self):
+        self.closed = False
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeAuthHelper:
+    def __init__(self):
+        self.credentials = []
+
+    def create_obo_credential(self, obo_token):
+        credential = FakeCredential()
+        self.credentials.append(credential)
+        return credential
+
+
+def test_expired_clients_are_closed_when_a_client_is_created():
+    auth_helper = FakeAuthHelper()
+    cache = GraphClientCache(auth_helper)
+    cache.create_graph_client = lambda credential: object()
+    expiries = {"first": 1000.0, "second": 5000.0}
+    cache.get_expiry = lambda obo_token: expiries[obo_token]
+
+    async def run():
+        with mock.patch("core.graphclientbuilder.time.time", return_value=500.0):
+            await cache.get_client("first")
+        with mock.patch("core.graphclientbuilder.time.time", return_value=2000.0):
+            await cache.get_client("second")
+
+    asyncio.run(run())
+    first_credential, second_credential = auth_helper.credentials
+    assert first_credential.closed
+    assert not second_credential.closed
+    assert len(cache) == 1
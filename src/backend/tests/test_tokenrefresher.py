@@ -0,0 +1,96 @@
+import asyncio
+import random
+
+from azure.core.credentials import AccessToken
+
+from core import tokenrefresher
+from core.tokenrefresher import TokenRefresher
+
+
+class FakeClock:
+    # time.time() and asyncio.sleep() of the refreshers, time only moves when advance() wakes the next sleeper
+
+    def __init__(self):
+        self.now = 1_000.0
+        self.sleepers: list[tuple[float, asyncio.Future]] = []
+        self.sleeps = 0
+
+    def time(self) -> float:
+        return self.now
+
+    async def sleep(self, delay: float):
+        self.sleeps += 1
+        future = asyncio.get_running_loop().create_future()
+        self.sleepers.append((self.now + max(delay, 0), future))
+        await future
+
+    async def advance(self, until: float, settle, max_wakeups: int = 1000):
+        for _ in range(max_wakeups):
+            await settle()
+            self.sleepers = [(wake, future) for wake, future in self.sleepers if not future.done()]
+            if not self.sleepers:
+                return
+            wake, future = min(self.sleepers, key=lambda sleeper: sleeper[0])
+            if wake > until:
+                return
+            self.now = max(self.now, wake)
+            future.set_result(None)
+        raise AssertionError(f"Still waking up after {max_wakeups} sleeps, at {self.now}")
+
+
+class FakeCredential:
+    def __init__(self, clock: FakeClock, lifetime: int):
+        self.clock = clock
+        self.lifetime = lifetime
+        self.tokens: list[tuple[float, int]] = []
+
+    async def get_token(self, scope: str) -> AccessToken:
+        expires_on = int(self.clock.now) + self.lifetime
+        self.tokens.append((self.clock.now, expires_on))
+        return AccessToken(f"token-{len(self.tokens)}", expires_on)
+
+
+def run_refreshers(monkeypatch, count: int, duration: float, lifetime: int, margin: float, jitter: float):
+    clock = FakeClock()
+    monkeypatch.setattr(tokenrefresher, "time", clock)
+    real_sleep = asyncio.sleep
+    credentials = [FakeCredential(clock, lifetime) for _ in range(count)]
+
+    async def settle():
+        for _ in range(20):
+            await real_sleep(0)
+
+    async def run():
+        refreshers = [
+            TokenRefresher(credential, "scope", lambda token: None, refresh_margin=margin, jitter=jitter)
+            for credential in credentials
+        ]
+        for refresher in refreshers:
+            await refresher.start()
+        monkeypatch.setattr(asyncio, "sleep", clock.sleep)
+        try:
+            await clock.advance(clock.now + duration, settle)
+        finally:
+            monkeypatch.setattr(asyncio, "sleep", real_sleep)
+            for refresher in refreshers:
+                await refresher.stop()
+
+    asyncio.run(run())
+    return clock, [credential.tokens for credential in credentials]
+
+
+def test_refreshes_once_per_cycle_within_the_jitter_window(monkeypatch):
+    random.seed(1)
+    clock, (tokens,) = run_refreshers(monkeypatch, count=1, duration=5, lifetime=3, margin=1, jitter=1)
+    # The initial token, then one refresh per cycle instead of polling until the margin is reached
+    assert 3 <= len(tokens) <= 5
+    assert clock.sleeps <= len(tokens) + 1
+    for (_, expires_on), (refreshed, _) in zip(tokens, tokens[1:]):
+        assert 1 <= expires_on - refreshed <= 2
+
+
+def test_workers_do_not_refresh_at_the_same_moment(monkeypatch):
+    random.seed(2)
+    clock, tokens = run_refreshers(monkeypatch, count=4, duration=2.5, lifetime=3, margin=1, jitter=1)
+    first_refreshes = {worker_tokens[1][0] for worker_tokens in tokens}
+    assert len(first_refreshes) == 4
@@ -61,4 +61,6 @@ export type ChatAppRequest = {
     context?: ChatAppRequestContext;
     stream?: boolean;
     session_state: any;
+    // messages only holds the new messages of the conversation stored by the server
+    delta?: boolean;
 };
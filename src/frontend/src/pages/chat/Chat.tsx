@@ -110,6 +110,8 @@ const Chat = () => {
                 { content: a[1].choices[0].message.content, role: "assistant" }
             ]));
 
+            // The server keeps the conversation when its session_state names one, then only the new question is sent
+            const sessionState = answers.length ? answers[answers.length - 1][1].choices[0].session_state : null;
             const request: ChatAppRequest = {
                 messages: [...messages, { content: question, role: "user" }],
                 stream: shouldStream,
@@ -127,10 +129,19 @@ const Chat = () => {
                     }
                 },
                 // ChatAppProtocol: Client must pass on any session state received from the server
-                session_state: answers.length ? answers[answers.length - 1][1].choices[0].session_state : null
+                session_state: sessionState
             };
 
-            const response = await chatApi(request, token?.accessToken);
+            let response: Response;
+            if (sessionState?.conversation_id) {
+                response = await chatApi({ ...request, messages: [{ content: question, role: "user" }], delta: true }, token?.accessToken);
+                // 409: the server doesn't have the conversation anymore, send the full history
+                if (response.status === 409) {
+                    response = await chatApi(request, token?.accessToken);
+                }
+            } else {
+                response = await chatApi(request, token?.accessToken);
+            }
             if (!response.body) {
                 throw Error("No response body");
             }